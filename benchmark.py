@@ -0,0 +1,494 @@
+"""
+Benchmarks for hackjohn against a local stand-in for the yosemite.org APIs
+
+The mock server serves synthetic responses for the trailhead and report
+endpoints (query.php?resource=trailheads and query.php?resource=report) and
+accepts any captcha response at captcha.php. Latency, timeouts, errors and
+session expiry can be injected, so the benchmarks exercise the same retry and
+reauthorization paths as the live site without spending captcha credits.
+
+Run all benchmarks with:
+
+    python benchmark.py
+
+Use --quick for a short run (as in CI) and --output to save the results as
+JSON, so numbers can be compared between commits.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+import pytz
+
+import config
+import hackjohn
+
+SESSION_COOKIE = "wildtrails_session"
+
+
+def make_trailheads(n_regions: int = 1, trailheads_per_region: int = 5) -> dict:
+    """
+    Return synthetic trailhead descriptions in the format of the trailhead
+    endpoint. The first region is "jm" with the real JMT trailhead ids and
+    Donohue exit quotas, and every other region has one exit quota (see
+    make_regions).
+    """
+    jmt = {
+        "j01a": ("Happy Isles->Sunrise/Merced Lake (pass through)", 6),
+        "j01b": ("Happy Isles->Little Yosemite Valley", 18),
+        "j03a": ("Glacier Point->Little Yosemite Valley", 6),
+        "j19": ("Sunrise Lakes", 9),
+        "j24b": ("Lyell Canyon", 21),
+    }
+    trailheads = {}
+    for region in range(n_regions):
+        for i in range(trailheads_per_region):
+            if region == 0 and i < len(jmt):
+                id_ = list(jmt)[i]
+                name, quota = jmt[id_]
+            else:
+                id_ = f"r{region:02d}t{i:02d}"
+                name, quota = f"Region {region} trailhead {i}", 10 + i
+            trailheads[id_] = {"id": id_, "wpsName": name, "region": region_id(region), "quota": quota}
+        if region > 0:
+            id_ = f"{region_id(region)}x"
+            trailheads[id_] = {"id": id_, "wpsName": f"Region {region} exit", "region": region_id(region), "quota": 30}
+    trailheads["d01"] = {"id": "d01", "wpsName": "Donohue Pass exit", "region": "jm", "quota": 20}
+    trailheads["d02"] = {"id": "d02", "wpsName": "Donohue Pass exit (Lyell Canyon)", "region": "jm", "quota": 15}
+    return trailheads
+
+
+def region_id(region: int) -> str:
+    return "jm" if region == 0 else f"r{region:02d}"
+
+
+def make_regions(n_regions: int = 1) -> dict:
+    """Return REGIONS (see config.py) for the trailheads of make_trailheads."""
+    regions = {"jm": {"default_exit": "d01", "exits": {"j24b": "d02"}}}
+    for region in range(1, n_regions):
+        regions[region_id(region)] = {"default_exit": f"{region_id(region)}x"}
+    return regions
+
+
+def make_report_values(trailheads: dict, year: int = 2021, seed: int = 0) -> List[dict]:
+    """
+    Return synthetic report values (one dict per date of the season) with
+    most trailheads fully reserved and a few open spaces.
+    """
+    rng = random.Random(seed)
+    values = []
+    day = date(year, 6, 15)
+    while day <= date(year, 9, 30):
+        row = {"date": day.isoformat()}
+        for id_, trailhead in trailheads.items():
+            quota = trailhead["quota"]
+            row[id_] = quota - rng.choice([0] * 12 + [1, 2])
+        values.append(row)
+        day += timedelta(days=1)
+    return values
+
+
+class MockState:
+    """Mutable behavior of the mock server, shared with the benchmarks."""
+
+    def __init__(self, n_regions: int = 1):
+        self.regions = make_regions(n_regions)
+        self.trailheads = make_trailheads(n_regions)
+        self.values = make_report_values(self.trailheads)
+        self.timestamp = datetime(2021, 7, 1, 10, 59)
+        self.latency = 0.0          # seconds added to every response
+        self.timeout_every = 0      # every nth request hangs for timeout_seconds (0 to disable)
+        self.timeout_seconds = 5.0
+        self.error_every = 0        # every nth request fails with HTTP 500 (0 to disable)
+        self.session_lifetime = None  # seconds until an authorized session expires
+        self.sessions = {}          # session token -> unix time when authorized
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def bump_timestamp(self):
+        """Move the report timestamp forward, as if the report was updated."""
+        self.timestamp += timedelta(minutes=1)
+
+    def report_body(self, region: str) -> bytes:
+        ids = [id_ for id_, trailhead in self.trailheads.items() if trailhead["region"] == region]
+        values = [{"date": row["date"], **{id_: row[id_] for id_ in ids}} for row in self.values]
+        return json.dumps({
+            "status": "ok",
+            "response": {"timestamp": self.timestamp.strftime("%Y-%m-%dT%H:%M:%S"), "values": values},
+        }).encode()
+
+    def trailheads_body(self) -> bytes:
+        return json.dumps({"status": "ok", "response": {"values": self.trailheads}}).encode()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Request handler for MockServer (the state is on the server)."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _inject_faults(self) -> bool:
+        """Apply latency, timeouts and errors. Returns False if the request failed."""
+        state = self.server.state
+        with state.lock:
+            state.requests += 1
+            n = state.requests
+        if state.latency:
+            time.sleep(state.latency)
+        if state.timeout_every and n % state.timeout_every == 0:
+            time.sleep(state.timeout_seconds)
+            self.close_connection = True  # the client has given up by now
+            return False
+        if state.error_every and n % state.error_every == 0:
+            self._send(500, b"internal server error")
+            return False
+        return True
+
+    def _send(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _is_authorized(self) -> bool:
+        state = self.server.state
+        cookies = dict(
+            cookie.strip().split("=", 1)
+            for cookie in self.headers.get("Cookie", "").split(";") if "=" in cookie
+        )
+        authorized_at = state.sessions.get(cookies.get(SESSION_COOKIE))
+        if authorized_at is None:
+            return False
+        return state.session_lifetime is None or time.time() - authorized_at < state.session_lifetime
+
+    def do_GET(self):
+        if not self._inject_faults():
+            return
+        state = self.server.state
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        resource = query.get("resource", [None])[0]
+        if not url.path.endswith("query.php") or resource not in ("report", "trailheads"):
+            self._send(404, b"{}")
+        elif not self._is_authorized():
+            self._send(200, json.dumps({"status": "unauthorized", "response": None}).encode())
+        elif resource == "report":
+            self._send(200, state.report_body(query.get("region", [None])[0]))
+        else:
+            self._send(200, state.trailheads_body())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._inject_faults():
+            return
+        if self.path.endswith("captcha.php"):
+            token = f"session-{random.getrandbits(64):x}"
+            self.server.state.sessions[token] = time.time()
+            self._send(200, b"{}", {"Set-Cookie": f"{SESSION_COOKIE}={token}; Path=/"})
+        else:
+            # stand-in for the Telegram and IFTTT endpoints
+            self._send(200, body or b"{}")
+
+
+class MockServer(ThreadingHTTPServer):
+    """Local stand-in for the yosemite.org APIs, running in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, state: MockState):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.state = state
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        threading.Thread(target=self.serve_forever, name="mock-server", daemon=True).start()
+
+
+@contextlib.contextmanager
+def mock_environment(state: MockState):
+    """
+    Point hackjohn at a MockServer with all files in a temporary directory,
+    and restore the configuration afterwards. The captcha solver is replaced
+    by a stand-in that returns immediately, since the mock server accepts any
+    captcha response. The configuration overrides are available as
+    server.config_overrides (e.g. to configure a hackjohn subprocess).
+    """
+    server = MockServer(state)
+    saved_config = dict(vars(config))
+    saved_solver = hackjohn.get_recaptcha_response
+    with tempfile.TemporaryDirectory() as directory:
+        server.config_overrides = {
+            "REPORT_ENDPOINT": f"{server.url}/query.php?resource=report&region={{region}}",
+            "REGIONS": state.regions,
+            "TRAILHEAD_ENDPOINT": f"{server.url}/query.php?resource=trailheads",
+            "RECAPTCHA_REQUEST_URL": f"{server.url}/captcha.php",
+            "TELEGRAM_URL": f"{server.url}/telegram",
+            "IFTTT_HOSTNAME": server.url,
+            "SESSION_STATE_FILE": f"{directory}/session.json",
+            "REPORT_STATE_FILE": f"{directory}/report-state.json",
+            "OUTPUT_PATH": f"{directory}/output.txt",
+            "TRAILHEAD_CACHE_FILE": f"{directory}/trailheads.json",
+            "SNAPSHOT_DATABASE": f"{directory}/snapshots.sqlite",
+            "METRICS_PROMETHEUS_FILE": f"{directory}/metrics.prom",
+            "METRICS_LOG_FILE": None,
+            "ENABLE_TELEGRAM": True,
+            "ENABLE_IFTTT": True,
+            "ENABLE_TWILIO": False,
+            "SUBSCRIPTIONS_FILE": None,
+            "API_REQUEST_BUDGET": 10 ** 6,  # measure hackjohn, not the budget
+            "API_BUDGET_FILE": f"{directory}/request-budget.json",
+        }
+        vars(config).update(server.config_overrides)
+        hackjohn.get_recaptcha_response = lambda api_key: "mock-recaptcha-response"
+        reset_hackjohn_state()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+            hackjohn.sessions = hackjohn.SessionManager()
+            hackjohn.get_recaptcha_response = saved_solver
+            vars(config).update(saved_config)
+            reset_hackjohn_state()
+
+
+def reset_hackjohn_state():
+    """Forget everything hackjohn remembers between polls in this process."""
+    hackjohn._last_report_seen.clear()
+    hackjohn._trailhead_cache.clear()
+    hackjohn._last_permits.clear()
+    hackjohn._subscription_index.clear()
+    hackjohn._snapshot_store = None
+    hackjohn.governor = hackjohn.RequestGovernor()
+    hackjohn.notification_queue = hackjohn.NotificationQueue()
+
+
+def measure(name: str, func: Callable, iterations: int, setup: Callable = None) -> dict:
+    """
+    Call func iterations times (after setup, which is not timed) and return
+    latency statistics in milliseconds and throughput in calls per second.
+    """
+    durations = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+    durations.sort()
+    result = {
+        "name": name,
+        "iterations": iterations,
+        "mean_ms": 1000 * statistics.mean(durations),
+        "p50_ms": 1000 * durations[len(durations) // 2],
+        "p95_ms": 1000 * durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+        "max_ms": 1000 * durations[-1],
+        "per_second": len(durations) / sum(durations),
+    }
+    print(
+        f"{name:<52} {result['mean_ms']:>9.3f} {result['p50_ms']:>9.3f} "
+        f"{result['p95_ms']:>9.3f} {result['max_ms']:>9.3f} {result['per_second']:>10.1f}"
+    )
+    return result
+
+
+def benchmark_api(iterations: int) -> List[dict]:
+    """Latency and throughput of get_json_from_api under injected faults."""
+    results = []
+    scenarios = [
+        ("get_json_from_api", {}),
+        ("get_json_from_api (20 ms latency)", {"latency": 0.02}),
+        ("get_json_from_api (10% errors)", {"error_every": 10}),
+        ("get_json_from_api (20% timeouts)", {"timeout_every": 5, "timeout_seconds": config.API_TIMEOUT_MAX + 0.5}),
+        ("get_json_from_api (session expires every 10 ms)", {"session_lifetime": 0.01}),
+    ]
+    for name, faults in scenarios:
+        state = MockState()
+        vars(state).update(faults)
+        with mock_environment(state):
+            with contextlib.redirect_stdout(io.StringIO()):
+                hackjohn.get_json_from_api(hackjohn.get_report_endpoint())  # authorize first
+            n = iterations if not faults.get("timeout_every") else max(iterations // 10, 10)
+            results.append(measure(name, lambda: hackjohn.get_json_from_api(hackjohn.get_report_endpoint()), n))
+    return results
+
+
+def benchmark_compute(iterations: int, region_counts: List[int]) -> List[dict]:
+    """Report decoding, find_available_permits and render_report for growing reports."""
+    results = []
+    timestamp = pytz.timezone("US/Pacific").localize(datetime(2021, 7, 1, 10, 59))
+    saved_regions = config.REGIONS
+    for n_regions in region_counts:
+        config.REGIONS = make_regions(n_regions)
+        trailheads = make_trailheads(n_regions)
+        values = make_report_values(trailheads)
+        raw_data = {"response": {"timestamp": "2021-07-01T10:59:00", "values": values}}
+        body = json.dumps(raw_data).encode()
+        jmt_report, _ = hackjohn._parse_jmt_report(raw_data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            permits = hackjohn.find_available_permits(jmt_report, timestamp, trailheads)
+        size = f"{n_regions} region{'s' if n_regions != 1 else ''}, {len(trailheads)} trailheads"
+        results.append(measure(
+            f"decode report ({size})",
+            lambda: hackjohn._parse_jmt_report(json.loads(body)),
+            iterations,
+        ))
+        results.append(measure(
+            f"find_available_permits ({size})",
+            lambda: hackjohn.find_available_permits(jmt_report, timestamp, trailheads),
+            iterations,
+        ))
+        results.append(measure(
+            f"render_report ({size})",
+            lambda: hackjohn.render_report(timestamp, permits, trailheads),
+            iterations,
+        ))
+    config.REGIONS = saved_regions
+    return results
+
+
+def benchmark_main(iterations: int) -> List[dict]:
+    """End-to-end main() (fetch, evaluate and notify) on an updated report."""
+    results = []
+    scenarios = [
+        ("main", 1, {}),
+        ("main (20 ms latency)", 1, {"latency": 0.02}),
+        ("main (10 regions, 20 ms latency)", 10, {"latency": 0.02}),
+    ]
+    for name, n_regions, faults in scenarios:
+        state = MockState(n_regions)
+        vars(state).update(faults)
+
+        def setup():
+            # a new report with a fresh opening, seen for the first time
+            state.bump_timestamp()
+            state.values = make_report_values(state.trailheads, seed=state.requests)
+            hackjohn._last_permits.clear()
+
+        with mock_environment(state):
+            with contextlib.redirect_stdout(io.StringIO()):
+                hackjohn.main()  # authorize and cache trailheads first
+            results.append(measure(name, hackjohn.main, iterations, setup=setup))
+            results.append(measure(f"{name}, report unchanged", hackjohn.main, iterations))
+    return results
+
+
+# imports of the original hackjohn.py (before any modules were deferred),
+# timed in a new process next to the import of hackjohn so that the two are
+# compared on the same machine and in the same run. Slow imports that a run
+# should only make when it needs them (see benchmark_startup): numpy and
+# sqlite3 are only needed once a new report is pulled, so a run with an
+# unchanged report must return before importing them.
+ORIGINAL_IMPORTS = (
+    "import pathlib, requests, json, datetime, pytz, twocaptcha, typing, warnings, pickle, tenacity, "
+    "twilio.rest, config"
+)
+DEFERRED_MODULES = ["aiohttp", "multiprocessing", "numpy", "sqlite3", "twilio", "twocaptcha"]
+
+# run in a fresh interpreter by benchmark_startup: configure hackjohn, import
+# it (or only the ORIGINAL_IMPORTS), optionally run a single poll, and report
+# on stderr how long the import took and which DEFERRED_MODULES were imported
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+if sys.argv[2] == "original":
+    exec(sys.argv[3])
+else:
+    import config
+    vars(config).update(json.loads(sys.argv[1]))
+    import hackjohn
+import_seconds = time.perf_counter() - start
+if sys.argv[2] == "poll":
+    hackjohn.main()
+imported = [module for module in sys.argv[4:] if module in sys.modules]
+print(json.dumps({"import_seconds": import_seconds, "imported": imported}), file=sys.stderr)
+"""
+
+
+def benchmark_startup(iterations: int) -> List[dict]:
+    """
+    Cold start of hackjohn in a new process: importing it, and a complete run
+    with saved cookies and an unchanged report (the common cron run). The
+    import time is reported next to that of the ORIGINAL_IMPORTS. Fails if
+    importing hackjohn or the run imports one of DEFERRED_MODULES.
+    """
+    results = []
+    with mock_environment(MockState()) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            hackjohn.main()  # save cookies, cache trailheads and write the output file
+        for name, mode in [("import original hackjohn.py modules (new process)", "original"),
+                           ("import hackjohn (new process)", "import"),
+                           ("hackjohn.py, saved cookies, no change (new process)", "poll")]:
+            reports = []
+
+            def run():
+                process = subprocess.run(
+                    [sys.executable, "-c", STARTUP_SCRIPT, json.dumps(server.config_overrides), mode,
+                     ORIGINAL_IMPORTS, *DEFERRED_MODULES],
+                    cwd=pathlib.Path(__file__).parent, capture_output=True, text=True, check=True,
+                )
+                reports.append(json.loads(process.stderr.strip().splitlines()[-1]))
+
+            result = measure(name, run, iterations)
+            result["import_ms"] = 1000 * statistics.mean(report["import_seconds"] for report in reports)
+            if mode != "original":
+                result["deferred_imported"] = sorted({
+                    module for report in reports for module in report["imported"]})
+            results.append(result)
+
+    original, *runs = results
+    import_ms = statistics.mean(result["import_ms"] for result in runs)
+    print(f"import hackjohn: {import_ms:.0f} ms "
+          f"({import_ms / original['import_ms']:.2f}x the {original['import_ms']:.0f} ms of the original imports)")
+    imported = sorted({module for result in runs for module in result["deferred_imported"]})
+    if imported:
+        raise SystemExit(f"startup imported modules that should be deferred: {', '.join(imported)}")
+    return results
+
+
+def run_benchmarks(quick: bool = False) -> List[dict]:
+    iterations = 20 if quick else 200
+    region_counts = [1, 10] if quick else [1, 10, 50]
+    print(f"{'benchmark':<52} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'per second':>10}")
+    results = []
+    results.extend(benchmark_startup(5 if quick else 20))
+    results.extend(benchmark_api(iterations))
+    results.extend(benchmark_compute(iterations, region_counts))
+    results.extend(benchmark_main(max(iterations // 10, 10)))
+    return results
+
+
+def parse_args(args: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations and smaller reports")
+    parser.add_argument("--output", type=pathlib.Path, help="write results to this JSON file")
+    return parser.parse_args(args)
+
+
+def main(quick: bool = False, output: pathlib.Path = None):
+    results = run_benchmarks(quick=quick)
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(**vars(parse_args()))
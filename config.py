@@ -25,6 +25,24 @@ EXCLUDE_TRAILHEADS = [
     # "Lyell Canyon",
 ]
 
+# Wilderness regions to watch (region codes of the yosemite.org report API).
+# Permits are limited by the entry quota of each trailhead and, for some
+# regions, by an exit quota: "default_exit" applies to every trailhead of the
+# region, except the trailheads listed in "exits" with their own exit quota.
+# Exit quotas are not trailheads. Optionally list "trailheads" (ids) to only
+# watch some of the region's trailheads. Each region costs one request per poll.
+REGIONS = {
+    "jm": {
+        "default_exit": "d01",       # Donohue Pass exit quota
+        "exits": {"j24b": "d02"},    # Lyell Canyon has its own Donohue Pass exit quota
+    },
+}
+
+# To notify a group, list each person's dates, trailheads and notification
+# channels in a JSON file (see load_subscriptions in hackjohn.py) and set its
+# path here. The report is pulled once for everyone.
+SUBSCRIPTIONS_FILE = None
+
 ## Telegram notification setup (optional)
 ENABLE_TELEGRAM = False
 TELEGRAM_TOKEN = "replace-with-personal-telegram-token"
@@ -63,6 +81,24 @@ import pathlib
 # files, set to None.
 OUTPUT_PATH = pathlib.Path("__file__").parent.joinpath("hackjohn-output.txt")
 
+# Keep a history of every pulled report (deduplicated by report update) in
+# this SQLite database. To disable the history, set to None.
+SNAPSHOT_DATABASE = pathlib.Path("__file__").parent.joinpath("hackjohn-snapshots.sqlite")
+
+# seconds to wait for another hackjohn process on this host (e.g. a worker of
+# the coordinated daemon) to release a lock on SNAPSHOT_DATABASE
+SNAPSHOT_DATABASE_TIMEOUT = 30
+
+# Append timings and counts for every pipeline stage as JSON lines to
+# METRICS_LOG_FILE, and write them in the Prometheus text format to
+# METRICS_PROMETHEUS_FILE after every poll. To disable either, set to None.
+METRICS_LOG_FILE = None
+METRICS_PROMETHEUS_FILE = pathlib.Path("__file__").parent.joinpath("hackjohn-metrics.prom")
+
+# approximate costs (in USD) used to track spend in the metrics
+CAPTCHA_COST = 0.003            # per 2Captcha recaptcha solve
+TWILIO_COST_PER_SEGMENT = 0.0079  # per SMS segment (up to SMS_MAX_LENGTH characters)
+
 # If the Report Date is before this day, suppress notification. You probably
 # do not need to change this setting unless you have disabled OUTPUT_PATH
 MIN_REPORT_DATE = "2019-01-01"
@@ -80,17 +116,96 @@ RECAPTCHA_RETRY_INTERVAL = 15  # in seconds
 # override CAPTCHA_API_KEY with environment variable if set (used by CI)
 CAPTCHA_API_KEY = os.environ.get("HACKJOHN_CAPTCHA_API_KEY") or CAPTCHA_API_KEY
 
-# save cookies to this file so they can be reused if still valid
-COOKIE_FILE = pathlib.Path("__file__").parent.joinpath(".cookies.pickle")
+# In daemon mode, solve a new captcha in the background once the cookies have
+# been used for SESSION_REFRESH_FRACTION of their expected lifetime. The lifetime
+# starts at SESSION_LIFETIME (in seconds). Whenever the cookies expire, and
+# whenever they are replaced without expiring, it moves by
+# SESSION_LIFETIME_SMOOTHING of the way to the observed lifetime (or back to
+# SESSION_LIFETIME), but never below SESSION_LIFETIME_MIN.
+SESSION_LIFETIME = 24 * 60 * 60
+SESSION_LIFETIME_MIN = 30 * 60
+SESSION_LIFETIME_SMOOTHING = 0.5
+SESSION_REFRESH_FRACTION = 0.75
+
+# save the authorized session (cookies, when the captcha was solved and the
+# observed session lifetime) to this file, so it is reused by later runs and
+# shared by pollers running at the same time
+SESSION_STATE_FILE = pathlib.Path("__file__").parent.joinpath(".session.json")
+
+# save the timestamp and HTTP cache validators (ETag/Last-Modified) of the last
+# report processed for each region to this file, so that later runs (e.g. from
+# cron) skip a report that has not changed. To disable, set to None.
+REPORT_STATE_FILE = pathlib.Path("__file__").parent.joinpath(".report-state.json")
+
+# While one poller solves a captcha, the others check its progress in the
+# session state every SESSION_SOLVE_CHECK_INTERVAL seconds, and take over if it
+# has not saved new cookies after SESSION_SOLVE_TIMEOUT seconds (e.g. because it
+# was stopped during the solve)
+SESSION_SOLVE_TIMEOUT = 10 * 60
+SESSION_SOLVE_CHECK_INTERVAL = 2
+
+# cache trailhead descriptions (names and quotas, which rarely change) in this
+# file for TRAILHEAD_CACHE_TTL seconds. To disable the on-disk cache, set to None.
+TRAILHEAD_CACHE_FILE = pathlib.Path("__file__").parent.joinpath(".trailheads.json")
+TRAILHEAD_CACHE_TTL = 7 * 24 * 60 * 60  # in seconds
+
+# how many times to try sending a notification on each channel
+NOTIFY_RETRY_ATTEMPTS = 3
+
+# In daemon mode, new permits for a channel that was notified less than
+# NOTIFY_COALESCE_WINDOW seconds ago are held and sent together in one message
+# (most urgent first) when the window is over, rather than as one message per
+# poll. The first notification is always sent right away, and failed messages
+# are retried when the window is over. Set to 0 to send every notification
+# right away (permits already sent are still not sent again, and failed
+# messages are retried with the next notification or when hackjohn exits).
+NOTIFY_COALESCE_WINDOW = 60
+
+# timeouts (in seconds) for requests to the yosemite.org APIs and to each
+# notification service, and sizes of the keep-alive connection pools. The API
+# timeout starts at API_TIMEOUT and then adapts to measured response times,
+# between API_TIMEOUT_MIN and API_TIMEOUT_MAX (see RequestGovernor).
+API_TIMEOUT = 2
+API_TIMEOUT_MIN = 1
+API_TIMEOUT_MAX = 15
+NOTIFY_TIMEOUTS = {"telegram": 10, "ifttt": 10, "twilio": 15}
+HTTP_POOL_CONNECTIONS = 4  # number of hosts with pooled connections per session
+HTTP_POOL_MAXSIZE = 8      # connections kept alive per host
+
+# pacing of requests to the yosemite.org APIs (see RequestGovernor). After
+# consecutive errors, requests wait a random time up to API_BACKOFF_BASE
+# seconds, doubled for each error, capped at API_BACKOFF_MAX. At most
+# API_REQUEST_BUDGET requests are made per minute, by all pollers on this host
+# together (they share the budget in API_BUDGET_FILE; set it to None for a
+# budget per process). The daemon polls up to API_ERROR_SLOWDOWN times less
+# often while requests are failing.
+API_BACKOFF_BASE = 1
+API_BACKOFF_MAX = 300
+API_REQUEST_BUDGET = 60
+API_BUDGET_FILE = pathlib.Path("__file__").parent.joinpath(".request-budget.json")
+API_ERROR_SLOWDOWN = 10
+API_HEALTH_SMOOTHING = 0.2  # weight of the latest request in the latency and error averages
 
 # API endpoints
-JMT_REPORT_ENDPOINT = "https://yosemite.org/wp-content/plugins/wildtrails/query.php?resource=report&region=jm"
+REPORT_ENDPOINT = "https://yosemite.org/wp-content/plugins/wildtrails/query.php?resource=report&region={region}"
 TRAILHEAD_ENDPOINT = "https://yosemite.org/wp-content/plugins/wildtrails/query.php?resource=trailheads"
 
 # phone number for permit office (previous number was 209-372-0740)
 PERMIT_OFFICE_PHONE = "209-372-0826"
 PERMIT_REQUEST_FORM_URL = "https://yosemite.org/yosemite-wilderness-permit-request-form/"
 
+# SMS notifications list as many permits as fit in a single SMS segment
+# (SMS_MAX_LENGTH characters), using these short trailhead names (other
+# trailheads use their full name)
+SMS_MAX_LENGTH = 160
+SMS_TRAILHEAD_NAMES = {
+    "j01a": "HI->Sunrise",
+    "j01b": "HI->LYV",
+    "j03a": "GP->LYV",
+    "j19": "Sunrise Lks",
+    "j24b": "Lyell Cyn",
+}
+
 # URLs for Telegram and IFTTT notifications
 TELEGRAM_URL = "https://apps.muetsch.io/webhook2telegram/api/messages"
 IFTTT_HOSTNAME = "https://maker.ifttt.com"
@@ -103,3 +218,32 @@ MAX_RESERVE_DAYS = 168
 MIN_RESERVE_DAYS = 2
 OPEN_DATE = "06-15"   # first calendar date JMT permits are available (MM-DD)
 CLOSE_DATE = "09-30"  # last calendar date JMT permits are available (MM-DD)
+
+# Daemon mode (python hackjohn.py --daemon) keeps polling the report from one
+# process. Polls are DAEMON_FAST_INTERVAL seconds apart within DAEMON_FAST_WINDOW
+# (minutes relative to REPORT_UPDATE_TIME, Pacific time) and ramp up to
+# DAEMON_SLOW_INTERVAL seconds apart over DAEMON_RAMP_MINUTES outside of it.
+REPORT_UPDATE_TIME = "11:00"
+DAEMON_FAST_WINDOW = (-10, 30)
+DAEMON_FAST_INTERVAL = 5
+DAEMON_SLOW_INTERVAL = 600
+DAEMON_RAMP_MINUTES = 60
+
+# Coordinated daemon (python hackjohn.py --daemon --workers N): N worker
+# processes take turns polling at the intervals above, so each worker polls N
+# times less often. Workers share the session state and SNAPSHOT_DATABASE (which
+# is required), where one of them holds a leader lease of COORDINATOR_LEASE
+# seconds and sends the notifications. Workers check for the lease and the
+# leader checks for reports published by other workers every
+# COORDINATOR_CHECK_INTERVAL seconds.
+COORDINATOR_LEASE = 15
+COORDINATOR_CHECK_INTERVAL = 0.5
+
+# Server mode (python hackjohn.py --serve) polls the report like the daemon and
+# serves the available permits in the latest report over a local HTTP API at
+# SERVE_HOST and SERVE_PORT, so other tools can follow the report without
+# pulling it themselves. Streams of changes (/events) send a keepalive comment
+# every SERVE_KEEPALIVE seconds.
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8040
+SERVE_KEEPALIVE = 15
@@ -14,55 +14,835 @@ Fill out the online permit request form if there are available permits:
 https://yosemite.org/yosemite-wilderness-permit-request-form/
 """
 
+import argparse
+import array
+import asyncio
+import collections.abc
+import contextlib
+import functools
+import html
+import itertools
+import math
+import os
 import pathlib
 import requests
 import json
-from datetime import datetime, timedelta
+import time
+from datetime import date as date_type, datetime, timedelta
+from operator import itemgetter
 import pytz
-from twocaptcha import TwoCaptcha
-from typing import Tuple, Union, List
+from typing import TYPE_CHECKING, Callable, ContextManager, Iterable, Iterator, Mapping, NamedTuple, Optional, Tuple, Union, List
 import warnings
-import pickle
+import random
+import socket
+import sys
+import threading
+import unicodedata
+import urllib.parse
+import zlib
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_fixed,
+    wait_random_exponential,
     retry_if_exception_type
 )
-from twilio.rest import Client
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where files are not locked (see file_lock)
+    fcntl = None
 
 # some parameters are set in config.py
 import config
 
+# aiohttp (only used by the server), numpy and sqlite3 (only used once a new
+# report is pulled), the Twilio SDK (only used when Twilio is enabled), the
+# 2Captcha SDK (only used when a captcha must be solved) and modules only used
+# by some modes are slow to import, so they are imported on first use to keep
+# one-off runs fast
+if TYPE_CHECKING:
+    import aiohttp
+    import numpy as np
+    from twilio.rest import Client
+
+
+# HTTP cache validators, timestamp and contents of the last report pulled for
+# each region, used to skip unchanged reports when polling repeatedly. The
+# validators and timestamp are saved in REPORT_STATE_FILE for later runs (see
+# load_report_state)
+_last_report_seen = {}
+
+# trailhead descriptions and when they were pulled (see get_trailhead_descriptions)
+_trailhead_cache = {}
+
+# history of pulled reports (see get_snapshot_store)
+_snapshot_store = None
+
+# available permits in the last report processed in this process, flattened by
+# flatten_permits (see get_previous_permits)
+_last_permits = {}
+
+# subscriptions from SUBSCRIPTIONS_FILE and the file's modification time (see
+# get_subscription_index)
+_subscription_index = {}
+
+# tasks that run in the background of the event loop, such as balance checks
+_background_tasks = set()
+
+# renderer for the current trailhead descriptions (see get_report_renderer)
+_report_renderer = {}
+
+
+def main(
+        daemon: bool = False,
+        replay: str = None,
+        poll_interval: List[str] = ("60",),
+        min_spaces: int = None,
+        workers: int = 1,
+        worker: int = None,
+        serve: bool = False,
+        host: str = None,
+        port: int = None,
+):
+    if replay is not None:
+        run_replay(replay, poll_interval, min_spaces=min_spaces)
+        return
+    if serve:
+        run_server(host, port)
+    elif worker is not None:
+        run_worker(worker, workers)
+    elif daemon and workers > 1:
+        run_workers(workers)
+    elif daemon:
+        run_daemon()
+    else:
+        check_for_permits()
 
-def main():
-    # pull permit and trailhead data
-    trailheads = get_trailhead_descriptions()
-    jmt_report, timestamp = get_jmt_report()
 
+async def main_async(
+        daemon: bool = False,
+        worker: int = None,
+        workers: int = 1,
+        serve: bool = False,
+        host: str = None,
+        port: int = None,
+) -> Optional[float]:
+    """
+    Run hackjohn on the running event loop (see main). A single poll returns
+    the detection latency (see check_for_permits_async).
+    """
+    try:
+        if serve:
+            await run_server_async(host, port)
+        elif worker is not None:
+            await run_worker_async(worker, workers)
+        elif daemon:
+            await run_daemon_async()
+        else:
+            return await check_for_permits_async()
+    finally:
+        await notification_queue.close()
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+class Notification(NamedTuple):
+    """
+    A notification to send (see evaluate_report).
+    """
+    rendering: "Rendering"  # report of the new permits (see render_report)
+    channels: dict          # keyword arguments for send_notifications_async
+    permits: dict           # new permits in the report, flattened by flatten_permits ({} if there are none)
+
+
+class Evaluation(NamedTuple):
+    """
+    Outcome of evaluating a report (see evaluate_report).
+    """
+    text: str  # full text report
+    notifications: List[Notification]
+    state: dict  # flattened permits to save in _last_permits once notifications are sent
+
+
+def evaluate_report(jmt_report: dict, timestamp: datetime, trailheads: dict) -> Evaluation:
+    """
+    Look for available permits in a report, compare them with the previous
+    report, write the output file, and decide which notifications to send
+    (for config.py and for each subscription in SUBSCRIPTIONS_FILE). This is
+    the part of the pipeline that does no network I/O (see
+    check_for_permits_async).
+    """
     # choose dates, look for available permits for those dates, and create text report
-    permits = find_available_permits(jmt_report, timestamp, trailheads)
-    text = create_text_report(timestamp, permits, trailheads)
-
-    # send notifications as appropriate
-    notify = decide_whether_to_notify(text, permits, timestamp)
-    if notify:
-        if config.ENABLE_TELEGRAM:
-            send_telegram_notification(text)
-        if config.ENABLE_IFTTT:
-            send_IFTTT_notification(text)
-        if config.ENABLE_TWILIO:
-            send_twilio_notification(text)
+    with metrics.timer("report_matrix"):
+        matrix = ReportMatrix(jmt_report, trailheads)
+    permits = find_available_permits(jmt_report, timestamp, trailheads, matrix=matrix)
+    rendering = render_report(timestamp, permits, trailheads)
+    text = rendering.text
+
+    # compare with the previous report and only notify about new availability
+    flat_permits = flatten_permits(permits)
+    previous_permits = get_previous_permits(timestamp, trailheads)
+    diff = diff_availability(previous_permits, flat_permits)
+    if previous_permits is not None:
+        print(f"{len(diff.opened)} opened, {len(diff.increased)} increased, "
+              f"{len(diff.decreased)} decreased, {len(diff.closed)} closed "
+              f"since the previous report")
+
+    notifications = []
+    notify = decide_whether_to_notify(
+        text, permits, timestamp, diff if previous_permits is not None else None)
+    if notify and diff.has_new_availability:
+        new_permits = diff.new_permits()
+        notifications.append(Notification(
+            render_report(timestamp, new_permits, trailheads), {}, flatten_permits(new_permits)))
+    elif notify:
+        notifications.append(Notification(rendering, {}, {}))
+    state = {"permits": flat_permits}
+
+    # notify each subscriber (if any) about new permits matching their search
+    if config.SUBSCRIPTIONS_FILE is not None:
+        subscriber_notifications, state["subscriptions"] = get_subscriber_notifications(
+            jmt_report, timestamp, trailheads, matrix=matrix)
+        notifications.extend(subscriber_notifications)
+
+    return Evaluation(text, notifications, state)
+
+
+def check_for_permits() -> Optional[float]:
+    """Synchronous wrapper of check_for_permits_async, for a single poll."""
+    return asyncio.run(main_async())
+
+
+async def check_for_permits_async() -> Optional[float]:
+    """
+    Pull the latest report, look for available permits, and send notifications
+    as appropriate. The trailhead descriptions are pulled while the report is
+    pulled (if they are not cached), and all notifications are sent
+    concurrently on the event loop, through notification_queue so that bursts
+    of openings are coalesced. Returns the detection latency in seconds (see
+    get_detection_latency) if a notification was sent right away, otherwise
+    None. Metrics are written (see Metrics) when the check is done.
+
+    Blocking I/O (HTTP requests with the shared requests sessions, file locks
+    and the Twilio SDK) runs in worker threads, so polls, the session
+    refresher and notifications of the daemon share one event loop.
+    """
+    try:
+        with metrics.timer("poll"):
+            return await _check_for_permits_async()
+    finally:
+        metrics.write_prometheus()
+
+
+async def _check_for_permits_async() -> Optional[float]:
+    load_report_state()
+    trailheads_task = asyncio.create_task(asyncio.to_thread(get_trailhead_descriptions))
+    try:
+        report = await get_jmt_report_async(only_if_changed=True)
+    except Exception:
+        trailheads_task.cancel()
+        raise
+    if report is None:
+        trailheads_task.cancel()
+        return None
+    jmt_report, timestamp = report
+
+    try:
+        store = get_snapshot_store()
+        if store is not None:
+            await asyncio.to_thread(store.add, jmt_report, timestamp)
+        latency = await notify_report_async(jmt_report, timestamp, trailheads_task)
+    except BaseException:
+        # forget this report so that the next poll processes it again
+        _last_report_seen.clear()
+        raise
+    save_report_state()
+    return latency
+
+
+async def notify_report_async(
+        jmt_report: dict,
+        timestamp: datetime,
+        trailheads_task: "asyncio.Task" = None,
+) -> Optional[float]:
+    """
+    Evaluate a pulled report (see evaluate_report) and send notifications as
+    appropriate. Returns the detection latency if a notification was sent
+    right away. trailheads_task is a task already pulling the trailhead
+    descriptions, if any.
+    """
+    trailheads = await (trailheads_task or asyncio.to_thread(get_trailhead_descriptions))
+    trailhead_ids = get_report_trailhead_ids(jmt_report)
+    if not trailhead_ids <= set(trailheads):
+        trailheads = await asyncio.to_thread(get_trailhead_descriptions, required_ids=trailhead_ids)
+    # evaluation reads the snapshot store and writes the output file, so it
+    # runs in a thread like the other blocking I/O
+    evaluation = await asyncio.to_thread(evaluate_report, jmt_report, timestamp, trailheads)
+
+    # send notifications as appropriate, holding back bursts of openings
+    # that follow a recent notification (see NotificationQueue)
+    latency = None
+    notification_queue.update_available({
+        **evaluation.state.get("subscriptions", {}), **evaluation.state["permits"]})
+    sent = await asyncio.gather(*(
+        notification_queue.submit(notification, timestamp, trailheads)
+        for notification in evaluation.notifications
+    ))
+    if any(sent):
+        latency = get_detection_latency(timestamp)
+        print(f"detection latency: {latency:.1f} seconds after report update")
+        metrics.observe("detection_latency_seconds", latency)
+
+    _last_permits.update(evaluation.state)
 
     print("")
-    print(text)
+    print(evaluation.text)
+    return latency
+
+
+async def run_daemon_async():
+    """
+    Poll the report forever from a single long-running process. The time
+    between polls is chosen by get_poll_interval, so polling is infrequent for
+    most of the day and tightens to a few seconds around the expected report
+    update. Errors during a poll are printed and do not stop the daemon.
+
+    Polling, the background session refresher (see
+    SessionManager.refresh_forever_async) and notifications share one event
+    loop. Polls slow down while API requests are failing (see
+    RequestGovernor.poll_interval).
+    """
+    import statistics
+
+    print("starting hackjohn daemon...")
+    refresher = asyncio.create_task(sessions.refresh_forever_async())
+    latencies = []
+    try:
+        while True:
+            try:
+                latency = await check_for_permits_async()
+            except Exception as e:
+                print(f"error while checking for permits: {e!r}")
+                latency = None
+            if latency is not None:
+                latencies.append(latency)
+                print(f"median detection latency over {len(latencies)} notifications: "
+                      f"{statistics.median(latencies):.1f} seconds")
+            interval = governor.poll_interval(get_poll_interval(datetime.now(pytz.utc)))
+            print(f"next poll in {interval:.0f} seconds...")
+            await asyncio.sleep(interval)
+    finally:
+        refresher.cancel()
+
+
+def run_daemon():
+    """Synchronous wrapper of run_daemon_async."""
+    asyncio.run(main_async(daemon=True))
+
+
+def run_workers(workers: int):
+    """
+    Run a coordinated daemon with a worker process for each of the workers
+    on this host (see run_worker_async). Workers can also be started one
+    at a time with run_worker, e.g. each as its own service, as long as they
+    share SNAPSHOT_DATABASE on this host.
+    """
+    import multiprocessing
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker, workers), name=f"hackjohn-worker-{worker}")
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def run_worker(worker: int, workers: int):
+    """
+    Run worker number worker (counting from 0) of a coordinated daemon with
+    workers workers. Each worker writes its own metrics file.
+    """
+    if config.METRICS_PROMETHEUS_FILE is not None:
+        path = pathlib.Path(config.METRICS_PROMETHEUS_FILE)
+        config.METRICS_PROMETHEUS_FILE = path.with_name(f"{path.stem}-worker{worker}{path.suffix}")
+    asyncio.run(main_async(worker=worker, workers=workers))
 
 
-def get_trailhead_descriptions() -> dict:
+async def run_worker_async(worker: int, workers: int, coordinator: "Coordinator" = None):
+    """
+    Poll the report as one of several coordinated workers, which take turns
+    (see get_worker_delay): the fleet polls at the pace of the daemon (see
+    get_poll_interval), while each worker polls, and is rate limited by its
+    RequestGovernor, workers times less often. This keeps the fleet polling
+    every few seconds even when a poll is slowed down by timeouts and retries.
+    Workers on one host share the authorized session (see SessionStateStore).
+
+    Each pulled report is published to the coordinator (by default, a
+    Coordinator on the snapshot store), and the worker that holds the leader
+    lease sends the notifications (see lead_forever_async).
+    """
+    if coordinator is None:
+        store = get_snapshot_store()
+        if store is None:
+            raise ValueError("coordinated workers share reports through SNAPSHOT_DATABASE, which must be set")
+        coordinator = Coordinator(store, name=f"{socket.gethostname()}:{os.getpid()}:{worker}")
+    print(f"starting hackjohn worker {worker} of {workers} ({coordinator.name})...")
+    published = asyncio.Event()
+    refresher = asyncio.create_task(sessions.refresh_forever_async())
+    leader = asyncio.create_task(lead_forever_async(coordinator, published))
+    try:
+        while True:
+            try:
+                with metrics.timer("poll"):
+                    report = await get_jmt_report_async(only_if_changed=True)
+                    if report is not None and await asyncio.to_thread(coordinator.publish, *report):
+                        print(f"worker {worker} detected a report update")
+                        published.set()
+            except Exception as e:
+                print(f"error while checking for permits: {e!r}")
+                # forget the last report so that the next poll publishes it again
+                _last_report_seen.clear()
+            finally:
+                metrics.write_prometheus()
+            interval = governor.poll_interval(get_poll_interval(datetime.now(pytz.utc)))
+            delay = get_worker_delay(time.time(), interval, worker, workers)
+            print(f"next poll in {delay:.0f} seconds...")
+            await asyncio.sleep(delay)
+    finally:
+        leader.cancel()
+        refresher.cancel()
+        await asyncio.to_thread(coordinator.resign)
+
+
+async def lead_forever_async(coordinator: "Coordinator", published: "asyncio.Event"):
+    """
+    While this worker holds the leader lease (see Coordinator), evaluate the
+    reports published by all workers and send notifications, checking every
+    COORDINATOR_CHECK_INTERVAL seconds, or right away when this worker
+    publishes a report. The coordinator is queried in a thread, so that its
+    database locks do not stall the polls of this worker.
+    """
+    leading = False
+    while True:
+        published.clear()
+        try:
+            if await asyncio.to_thread(coordinator.elect):
+                if not leading:
+                    print(f"{coordinator.name} is now the leader")
+                    # other workers may have handled the latest reports, so
+                    # compare with the reports in the snapshot store instead
+                    _last_permits.clear()
+                    leading = True
+                unhandled = await asyncio.to_thread(lambda: list(coordinator.unhandled_reports()))
+                for report_id, jmt_report, timestamp in unhandled:
+                    if not await asyncio.to_thread(coordinator.elect):
+                        break
+                    await notify_report_async(jmt_report, timestamp)
+                    await asyncio.to_thread(coordinator.mark_handled, report_id)
+            elif leading:
+                print(f"{coordinator.name} is no longer the leader")
+                leading = False
+        except Exception as e:
+            print(f"error while handling published reports: {e!r}")
+        try:
+            await asyncio.wait_for(published.wait(), config.COORDINATOR_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def get_poll_interval(now: datetime) -> float:
+    """
+    Choose the number of seconds to wait before the next poll. Inside the
+    DAEMON_FAST_WINDOW around REPORT_UPDATE_TIME (Pacific time), poll every
+    DAEMON_FAST_INTERVAL seconds. Outside of it, the interval ramps linearly
+    up to DAEMON_SLOW_INTERVAL over DAEMON_RAMP_MINUTES.
+
+    :param now: current time (must be timezone aware)
+    """
+    pacific = pytz.timezone("US/Pacific")
+    now = now.astimezone(pacific)
+    hour, minute = map(int, config.REPORT_UPDATE_TIME.split(":"))
+    update_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+    # minutes until (negative) or since (positive) the nearest update time
+    offset = min(
+        ((now - (update_time + timedelta(days=d))).total_seconds() / 60 for d in (-1, 0, 1)),
+        key=abs,
+    )
+    window_start, window_end = config.DAEMON_FAST_WINDOW
+    if window_start <= offset <= window_end:
+        minutes_outside = 0
+    else:
+        minutes_outside = min(abs(offset - window_start), abs(offset - window_end))
+
+    ramp = min(minutes_outside / config.DAEMON_RAMP_MINUTES, 1)
+    fast, slow = config.DAEMON_FAST_INTERVAL, config.DAEMON_SLOW_INTERVAL
+    return fast + ramp * (slow - fast)
+
+
+class AvailabilityServer:
+    """
+    Local HTTP API with the availability in the latest report, so that many
+    tools can follow the report while a single poller pulls it upstream (see
+    run_server_async). Endpoints:
+
+    - GET /availability: available permits (in the format of
+      find_available_permits) with the report timestamp and trailhead names.
+      Query parameters: start and end (YYYY-MM-DD), trailhead (id or name,
+      repeatable) and min_spaces. Without them, this is the result of
+      find_available_permits for config.py.
+    - GET /report: reserved permits per date and trailhead (the report of
+      get_jmt_report_async) between the start and end dates.
+    - GET /events: a Server-Sent Events stream with the /availability
+      response (for the same query parameters) whenever the report is
+      updated, and a comment every SERVE_KEEPALIVE seconds.
+    - GET /metrics: the metrics in the Prometheus text format (see Metrics).
+
+    Responses have an ETag of the report version, and requests with a
+    matching If-None-Match get 304 Not Modified. Availability is computed once
+    per report update (see ReportMatrix), and responses are cached until the
+    next update.
+    """
+
+    def __init__(self):
+        self.report = None   # (jmt_report, timestamp, trailheads, matrix) of the latest report
+        self.version = None  # report timestamp and version, used as the ETag and SSE event id
+        self._responses = {}  # (path, query) -> response body for this version
+        self._changed = asyncio.Event()  # set (and replaced) when the report is updated
+
+    def update(self, jmt_report: dict, timestamp: datetime, trailheads: dict):
+        """Serve a newly pulled report, and notify the clients of /events."""
+        self.report = jmt_report, timestamp, trailheads, ReportMatrix(jmt_report, trailheads)
+        self.version = ";".join(filter(None, (timestamp.isoformat(), getattr(jmt_report, "version", ""))))
+        self._responses.clear()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def availability(self, query: Mapping[str, str]) -> dict:
+        """Return the /availability response for the query parameters."""
+        jmt_report, timestamp, trailheads, matrix = self.report
+        start_date, end_date = self._get_dates(query)
+        selected = set(query.getall("trailhead", []))
+        permits = matrix.available_permits(
+            start_date, end_date,
+            min_spaces=int(query.get("min_spaces", config.MIN_SPACES)),
+            exclude_trailheads=() if selected else config.EXCLUDE_TRAILHEADS,
+        )
+        if selected:
+            permits = {
+                date: date_permits for date, date_permits in (
+                    (date, {
+                        id_: n for id_, n in date_permits.items()
+                        if id_ in selected or trailheads[id_]["wpsName"] in selected
+                    })
+                    for date, date_permits in permits.items()
+                )
+                if date_permits
+            }
+        return {
+            "timestamp": timestamp.isoformat(),
+            "start_date": start_date,
+            "end_date": end_date,
+            "permits": permits,
+            "trailheads": {
+                id_: trailheads[id_]["wpsName"] for date_permits in permits.values() for id_ in date_permits
+            },
+        }
+
+    def reserved(self, query: Mapping[str, str]) -> dict:
+        """Return the /report response for the query parameters."""
+        jmt_report, timestamp = self.report[:2]
+        start_date, end_date = self._get_dates(query)
+        return {
+            "timestamp": timestamp.isoformat(),
+            "reserved": {
+                date: jmt_report[date] for date in sorted(jmt_report) if start_date <= date <= end_date
+            },
+        }
+
+    def _get_dates(self, query: Mapping[str, str]) -> Tuple[str, str]:
+        """Return the dates of the query (see get_start_end_dates), checking their format."""
+        jmt_report, timestamp = self.report[:2]
+        for key in "start", "end":
+            if key in query:
+                date_type.fromisoformat(query[key])
+        return get_start_end_dates(jmt_report, timestamp, start_date=query.get("start"), end_date=query.get("end"))
+
+    def _get_body(self, path: str, query: Mapping[str, str]) -> bytes:
+        """Return the JSON response body for the path and query, from the cache if possible."""
+        key = path, tuple(sorted(query.items()))
+        if key not in self._responses:
+            if len(self._responses) >= 1000:
+                self._responses.clear()
+            response = self.availability(query) if path == "/availability" else self.reserved(query)
+            self._responses[key] = json.dumps(response).encode()
+        return self._responses[key]
+
+    def app(self) -> "aiohttp.web.Application":
+        """Return the aiohttp application serving the endpoints."""
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/availability", self._handle_json)
+        app.router.add_get("/report", self._handle_json)
+        app.router.add_get("/events", self._handle_events)
+        app.router.add_get("/metrics", self._handle_metrics)
+        return app
+
+    async def _handle_json(self, request: "aiohttp.web.Request") -> "aiohttp.web.Response":
+        from aiohttp import web
+
+        if self.report is None:
+            raise web.HTTPServiceUnavailable(text="no report pulled yet", headers={"Retry-After": "5"})
+        etag = f'"{self.version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        try:
+            body = self._get_body(request.path, request.query)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=f"invalid query: {e}")
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def _handle_events(self, request: "aiohttp.web.Request") -> "aiohttp.web.StreamResponse":
+        from aiohttp import web
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        last_version = request.headers.get("Last-Event-ID")
+        metrics.increment("server_event_streams_total")
+        try:
+            while True:
+                changed = self._changed
+                if self.version is not None and self.version != last_version:
+                    try:
+                        body = self._get_body("/availability", request.query)
+                    except ValueError as e:
+                        await response.write(f"event: error\ndata: invalid query: {e}\n\n".encode())
+                        return response
+                    await response.write(
+                        f"id: {self.version}\nevent: availability\ndata: ".encode() + body + b"\n\n")
+                    last_version = self.version
+                try:
+                    await asyncio.wait_for(changed.wait(), config.SERVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            return response
+
+    async def _handle_metrics(self, request: "aiohttp.web.Request") -> "aiohttp.web.Response":
+        from aiohttp import web
+
+        return web.Response(text=metrics.prometheus_text(), content_type="text/plain")
+
+
+def run_server(host: str = None, port: int = None):
+    """Synchronous wrapper of run_server_async."""
+    asyncio.run(main_async(serve=True, host=host, port=port))
+
+
+async def run_server_async(host: str = None, port: int = None, server: AvailabilityServer = None):
+    """
+    Poll the report like the daemon (see run_daemon_async), sending the same
+    notifications, and serve the availability in the latest report over a
+    local HTTP API (see AvailabilityServer), by default at SERVE_HOST and
+    SERVE_PORT. However many clients use the API, the report is pulled once
+    per poll.
+    """
+    from aiohttp import web
+
+    print("starting hackjohn server...")
+    host = host or config.SERVE_HOST
+    port = port or config.SERVE_PORT
+    server = server or AvailabilityServer()
+    runner = web.AppRunner(server.app(), access_log=None, shutdown_timeout=1)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"serving permit availability at http://{host}:{port}/availability")
+    refresher = asyncio.create_task(sessions.refresh_forever_async())
+    try:
+        while True:
+            try:
+                with metrics.timer("poll"):
+                    report = await get_jmt_report_async(only_if_changed=True)
+                    if report is not None:
+                        await _serve_report_async(server, *report)
+            except Exception as e:
+                print(f"error while checking for permits: {e!r}")
+            finally:
+                metrics.write_prometheus()
+            interval = governor.poll_interval(get_poll_interval(datetime.now(pytz.utc)))
+            print(f"next poll in {interval:.0f} seconds...")
+            await asyncio.sleep(interval)
+    finally:
+        refresher.cancel()
+        await runner.cleanup()
+
+
+async def _serve_report_async(server: AvailabilityServer, jmt_report: dict, timestamp: datetime):
+    """Store, serve and notify a newly pulled report."""
+    try:
+        store = get_snapshot_store()
+        if store is not None:
+            await asyncio.to_thread(store.add, jmt_report, timestamp)
+        trailheads = await asyncio.to_thread(
+            get_trailhead_descriptions, required_ids=get_report_trailhead_ids(jmt_report))
+        server.update(jmt_report, timestamp, trailheads)
+        await notify_report_async(jmt_report, timestamp)
+    except BaseException:
+        # forget this report so that the next poll processes it again
+        _last_report_seen.clear()
+        raise
+
+
+def get_worker_delay(now: float, interval: float, worker: int, workers: int) -> float:
+    """
+    Choose the number of seconds until the next poll of a coordinated worker
+    (see run_worker_async). Each worker polls every workers * interval
+    seconds, offset by worker * interval seconds (in unix time, so workers
+    started at different times line up), so that together the workers poll
+    every interval seconds.
+
+    :param now: unix time
+    :param interval: seconds between polls of the fleet (see get_poll_interval)
+    """
+    return (worker * interval - now) % (interval * workers)
+
+
+def get_detection_latency(timestamp: datetime) -> float:
+    """
+    Seconds between the report update (the report timestamp) and now. This is
+    how long it took hackjohn to notice and report the update.
+    """
+    return (datetime.now(pytz.utc) - timestamp).total_seconds()
+
+
+class Metrics:
+    """
+    Timings, counts and spend for each stage of the pipeline, so we can see
+    where the seconds between a report update and a notification go.
+
+    Every observation is appended as a JSON line to METRICS_LOG_FILE, and
+    aggregates (count, sum and last value of each timing, and totals of each
+    counter) are written in the Prometheus text format to
+    METRICS_PROMETHEUS_FILE (e.g. for the node_exporter textfile collector)
+    after every poll. Either output is disabled by setting it to None.
+    """
+
+    def __init__(self):
+        self._timings = {}   # (name, labels) -> [count, sum, last]
+        self._counters = {}  # (name, labels) -> total
+        self._lock = threading.Lock()
+        self._log_file = None
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a timing in seconds, e.g. observe("stage_seconds", 0.1, stage="render")."""
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            timing = self._timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = seconds
+        self.log(name, seconds, **labels)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Add value to a counter, e.g. increment("retries_total", function="...")."""
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self.log(name, value, **labels)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Context manager that records the duration of a pipeline stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def log(self, name: str, value: float, **labels):
+        """Append an observation to METRICS_LOG_FILE as a JSON line."""
+        if config.METRICS_LOG_FILE is None:
+            return
+        line = json.dumps({"time": time.time(), "metric": name, "value": value, **labels})
+        with self._lock:
+            if self._log_file is None:
+                self._log_file = open(config.METRICS_LOG_FILE, "a", buffering=1)
+            self._log_file.write(line + "\n")
+
+    def prometheus_text(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        def series(name, labels, suffix=""):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            return f"hackjohn_{name}{suffix}{{{label_text}}}" if labels else f"hackjohn_{name}{suffix}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._timings}):
+                timings = [(labels, timing) for (name_, labels), timing in sorted(self._timings.items()) if name_ == name]
+                lines.append(f"# TYPE hackjohn_{name} summary")
+                for labels, (count, total, last) in timings:
+                    lines.append(f"{series(name, labels, '_count')} {count}")
+                    lines.append(f"{series(name, labels, '_sum')} {total:.6f}")
+                lines.append(f"# TYPE hackjohn_{name}_last gauge")
+                for labels, (count, total, last) in timings:
+                    lines.append(f"{series(name, labels, '_last')} {last:.6f}")
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE hackjohn_{name} counter")
+                for (name_, labels), total in sorted(self._counters.items()):
+                    if name_ == name:
+                        lines.append(f"{series(name, labels)} {total:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """Atomically write prometheus_text to METRICS_PROMETHEUS_FILE."""
+        if config.METRICS_PROMETHEUS_FILE is None:
+            return
+        path = pathlib.Path(config.METRICS_PROMETHEUS_FILE)
+        temp_path = path.with_name(f"{path.name}.tmp")
+        temp_path.write_text(self.prometheus_text())
+        temp_path.replace(path)
+
+
+metrics = Metrics()
+
+
+def timed(stage: str) -> Callable:
+    """Decorator that records the duration of each call as a pipeline stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_retry(retry_state):
+    """
+    Tenacity before_sleep callback that counts retries of the decorated
+    function (it is not called after the last attempt).
+    """
+    metrics.increment("retries_total", function=retry_state.fn.__name__)
+
+
+def get_trailhead_descriptions(required_ids: Iterable[str] = (), force_refresh: bool = False) -> dict:
     """
     Get trailhead information (names, quotas, etc.). Returns a dictionary with
     an entry for each trailhead.
 
+    Trailhead information rarely changes, so it is cached in memory and in
+    TRAILHEAD_CACHE_FILE for TRAILHEAD_CACHE_TTL seconds. The cache is refreshed
+    early if force_refresh is True or if it is missing any of required_ids
+    (e.g. a trailhead that appeared in the JMT report).
+
     For example, this is the entry for "j01a":
     {
         'id': 'j01a',
@@ -78,19 +858,225 @@ def get_trailhead_descriptions() -> dict:
         'notes': '...'
     }
     """
+    trailheads = _get_cached_trailheads(required_ids, force_refresh)
+    if trailheads is not None:
+        return trailheads
+
     print("pulling trailhead information...")
     raw_data = get_json_from_api(config.TRAILHEAD_ENDPOINT)
     trailheads = raw_data["response"]["values"]
+    _write_trailhead_cache(trailheads)
     return trailheads
 
 
-def get_jmt_report() -> Tuple[dict, datetime]:
+def _get_cached_trailheads(required_ids: Iterable[str], force_refresh: bool) -> Optional[dict]:
+    """
+    Return cached trailhead information, or None if it needs to be pulled
+    (see get_trailhead_descriptions).
     """
-    Get the number of reserved permits from each trailhead for each date.
-    Returns a dictionary with keys for dates. Each value is a dictionary with
-    a key for each JMT trailhead. Also returns the timestamp of when the report
-    was last updated (in PST). The raw report is a list of dicts. The list is
-    reformatted into a dictionary to make it easier to work with.
+    if force_refresh:
+        return None
+    trailheads = _read_trailhead_cache()
+    missing = set(required_ids) - set(trailheads or {})
+    if trailheads is not None and missing:
+        print(f"trailhead cache is missing {', '.join(sorted(missing))} -- refreshing...")
+        return None
+    return trailheads
+
+
+def get_report_trailhead_ids(jmt_report: dict) -> set:
+    """Return the ids of all trailheads (and exit quotas) in a report."""
+    if isinstance(jmt_report, ReservationReport):
+        return set(jmt_report.trailhead_ids)
+    return {id_ for counts in jmt_report.values() for id_ in counts}
+
+
+def _read_trailhead_cache(max_age: float = None) -> Optional[dict]:
+    """
+    Return cached trailhead information if it is younger than max_age seconds
+    (default TRAILHEAD_CACHE_TTL), checking memory first and then
+    TRAILHEAD_CACHE_FILE.
+    """
+    if not _trailhead_cache and config.TRAILHEAD_CACHE_FILE is not None:
+        cache_file = pathlib.Path(config.TRAILHEAD_CACHE_FILE)
+        if cache_file.is_file():
+            try:
+                _trailhead_cache.update(json.loads(cache_file.read_text()))
+            except ValueError:
+                print(f"ignoring invalid trailhead cache at {cache_file.absolute()}")
+    if not _trailhead_cache:
+        return None
+    age = time.time() - _trailhead_cache["fetched_at"]
+    if age > (config.TRAILHEAD_CACHE_TTL if max_age is None else max_age):
+        return None
+    return _trailhead_cache["trailheads"]
+
+
+def _write_trailhead_cache(trailheads: dict):
+    """Cache trailhead information in memory and in TRAILHEAD_CACHE_FILE."""
+    _trailhead_cache.clear()
+    _trailhead_cache.update(fetched_at=time.time(), trailheads=trailheads)
+    if config.TRAILHEAD_CACHE_FILE is not None:
+        cache_file = pathlib.Path(config.TRAILHEAD_CACHE_FILE)
+        temp_file = cache_file.with_name(f"{cache_file.name}.tmp")
+        temp_file.write_text(json.dumps(_trailhead_cache))
+        temp_file.replace(cache_file)
+
+
+class ReservationReport(collections.abc.Mapping):
+    """
+    Compact report of reserved permits (see get_jmt_report_async). The
+    reserved count of every date and trailhead (or exit quota) is a 16-bit
+    integer in a single array, with one row per date (in the order of dates)
+    and one column per trailhead (in the order of trailhead_ids), and -1 for
+    missing values.
+    Dates are kept as the YYYY-MM-DD strings of the report and only parsed
+    when needed (see days).
+
+    A ReservationReport behaves like the dictionary of get_jmt_report_async
+    ({date: {trailhead_id: reserved}}), building the dictionary of a date when
+    it is looked up, so callers can treat it as a dict. ReportMatrix and
+    SnapshotStore read the array directly.
+
+    The report timestamp does not identify a report merged from several
+    regions, since a region can update to a time before another region's
+    timestamp. version identifies it among reports with the same timestamp:
+    the timestamp of each region (see _merge_region_reports), or "" for the
+    report of a single region.
+    """
+
+    __slots__ = ("dates", "trailhead_ids", "counts", "version", "_rows", "_days")
+
+    def __init__(
+            self,
+            dates: List[str],
+            trailhead_ids: Tuple[str, ...],
+            counts: array.array,
+            version: str = "",
+    ):
+        self.dates = dates
+        self.trailhead_ids = trailhead_ids
+        self.counts = counts
+        self.version = version
+        self._rows = None  # date -> row, built on first lookup
+        self._days = None  # dates as datetime64[D], parsed on first use
+
+    @classmethod
+    def from_values(cls, values: List[dict]) -> "ReservationReport":
+        """
+        Build a report from the "values" of a raw report from the API: a list
+        with a dict per date, with the "date" and the reserved count of each
+        trailhead. Rows are read with C-level item lookups when every row has
+        the same trailheads (as the API returns them), and one value at a time
+        otherwise.
+        """
+        columns = [id_ for id_ in values[0] if id_ != "date"] if values else []
+        dates = list(map(itemgetter("date"), values))
+        counts = array.array("h")
+        try:
+            if len(set(dates)) < len(dates) or set(map(len, values)) != {len(columns) + 1}:
+                raise ValueError("rows differ")
+            get_row = itemgetter(*columns) if len(columns) > 1 else lambda row: (row[columns[0]],)
+            counts.extend(itertools.chain.from_iterable(map(get_row, values)))
+        except (KeyError, TypeError, ValueError, IndexError):
+            # rows with different trailheads, missing values or repeated dates
+            rows = {}
+            for row in values:
+                rows.setdefault(row["date"], {}).update(row)
+            dates = list(rows)
+            columns = list(dict.fromkeys(id_ for row in rows.values() for id_ in row if id_ != "date"))
+            counts = array.array("h", [
+                -1 if row.get(id_) is None else row[id_]
+                for row in rows.values()
+                for id_ in columns
+            ])
+        return cls(dates, tuple(map(sys.intern, columns)), counts)
+
+    @classmethod
+    def from_mapping(cls, jmt_report: Mapping[str, dict]) -> "ReservationReport":
+        """
+        Return a report in the dictionary format of get_jmt_report_async (e.g.
+        one written by hand) as a ReservationReport.
+        """
+        if isinstance(jmt_report, ReservationReport):
+            return jmt_report
+        return cls.from_values([{"date": date, **counts} for date, counts in jmt_report.items()])
+
+    @classmethod
+    def merge(cls, reports: List["ReservationReport"]) -> "ReservationReport":
+        """
+        Merge reports (e.g. of several regions) into one. Values of later
+        reports take precedence, and missing values do not overwrite.
+        """
+        import numpy as np
+
+        dates = list(dict.fromkeys(date for report in reports for date in report.dates))
+        trailhead_ids = tuple(dict.fromkeys(id_ for report in reports for id_ in report.trailhead_ids))
+        row_index = {date: i for i, date in enumerate(dates)}
+        column_index = {id_: i for i, id_ in enumerate(trailhead_ids)}
+        merged = np.full((len(dates), len(trailhead_ids)), -1, dtype=np.int16)
+        for report in reports:
+            cells = np.ix_(
+                [row_index[date] for date in report.dates],
+                [column_index[id_] for id_ in report.trailhead_ids],
+            )
+            counts = report.matrix()
+            merged[cells] = np.where(counts >= 0, counts, merged[cells])
+        counts = array.array("h")
+        counts.frombytes(merged.tobytes())
+        return cls(dates, trailhead_ids, counts)
+
+    def matrix(self) -> "np.ndarray":
+        """Return the reserved counts as a (dates x trailheads) view of the array."""
+        import numpy as np
+
+        return np.frombuffer(self.counts, dtype=np.int16).reshape(len(self.dates), len(self.trailhead_ids))
+
+    def days(self) -> "np.ndarray":
+        """Return the dates as an array of datetime64[D]."""
+        import numpy as np
+
+        if self._days is None:
+            self._days = np.array(self.dates, dtype="datetime64[D]")
+        return self._days
+
+    def __getitem__(self, date: str) -> dict:
+        if self._rows is None:
+            self._rows = {date: i for i, date in enumerate(self.dates)}
+        width = len(self.trailhead_ids)
+        start = self._rows[date] * width
+        return {id_: n for id_, n in zip(self.trailhead_ids, self.counts[start:start + width]) if n >= 0}
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.dates)
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __repr__(self) -> str:
+        return f"ReservationReport({len(self.dates)} dates, {len(self.trailhead_ids)} trailheads)"
+
+
+async def get_jmt_report_async(only_if_changed: bool = False) -> Optional[Tuple[ReservationReport, datetime]]:
+    """
+    Get the number of reserved permits from each trailhead for each date, for
+    every region in REGIONS. Returns a ReservationReport, which behaves like a
+    dictionary with keys for dates. Each value is a dictionary with a key for
+    each trailhead (and exit quota). Also returns the timestamp of when the
+    report was last updated (in PST). The raw report is a list of dicts, which
+    is decoded into the compact array of a ReservationReport.
+
+    The reports of all regions are pulled concurrently (see get_region_report,
+    which runs in a worker thread for each region) and merged. The timestamp
+    is that of the most recently updated region.
+
+    If only_if_changed is True, returns None when no region's report has
+    changed since the last call (or since the state loaded from
+    REPORT_STATE_FILE, see load_report_state). The request is made conditional
+    on the ETag/Last-Modified of the previous response (in case the server
+    supports it), and otherwise a report is skipped if its timestamp has not
+    moved. Unchanged regions are merged from their previous report, which is
+    pulled again if it is not in memory (e.g. in a new process).
 
     Here is a sample of the output. There is one entry per date.
     {
@@ -105,35 +1091,1012 @@ def get_jmt_report() -> Tuple[dict, datetime]:
         },
     }
     """
-    print("pulling JMT permit availability report...")
-    raw_data = get_json_from_api(config.JMT_REPORT_ENDPOINT)
+    regions = list(config.REGIONS)
+    reports = await asyncio.gather(*(
+        asyncio.to_thread(get_region_report, region, only_if_changed) for region in regions))
+    if only_if_changed and any(report is not None for report in reports):
+        # the contents of unchanged regions are only kept in memory
+        missing = [
+            i for i, region in enumerate(regions)
+            if reports[i] is None and "report" not in _last_report_seen[region]
+        ]
+        for i in missing:
+            _last_report_seen[regions[i]].clear()
+        pulled = await asyncio.gather(*(
+            asyncio.to_thread(get_region_report, regions[i], True) for i in missing))
+        for i, report in zip(missing, pulled):
+            reports[i] = report
+    return _merge_region_reports(regions, reports, only_if_changed)
+
+
+def get_region_report(region: str, only_if_changed: bool = False) -> Optional[Tuple[ReservationReport, datetime]]:
+    """
+    Get the report for a single region, in the format of
+    get_jmt_report_async. If only_if_changed is True, returns None when the
+    region's report has not changed since the last call (see
+    _last_report_seen). Blocks until the report is pulled.
+    """
+    print(f"pulling {region} permit availability report...")
+    last_seen = _last_report_seen.setdefault(region, {}) if only_if_changed else None
+    validators = last_seen.setdefault("validators", {}) if only_if_changed else None
+    raw_data = get_json_from_api(get_report_endpoint(region), validators=validators)
+    return _parse_jmt_report(raw_data, last_seen)
+
+
+def load_report_state():
+    """
+    Load the timestamps and HTTP cache validators of the last reports
+    processed by an earlier run from REPORT_STATE_FILE, unless reports were
+    already pulled in this process.
+    """
+    if _last_report_seen or config.REPORT_STATE_FILE is None:
+        return
+    state_file = pathlib.Path(config.REPORT_STATE_FILE)
+    if not state_file.is_file():
+        return
+    try:
+        state = json.loads(state_file.read_text())
+    except ValueError:
+        print(f"ignoring invalid report state at {state_file.absolute()}")
+        return
+    for region, last_seen in state.items():
+        if region in config.REGIONS:
+            _last_report_seen[region] = {"timestamp": last_seen["timestamp"], "validators": last_seen["validators"]}
+
+
+def save_report_state():
+    """
+    Save the timestamps and HTTP cache validators of the reports processed
+    in REPORT_STATE_FILE (see load_report_state).
+    """
+    if config.REPORT_STATE_FILE is None:
+        return
+    state = {
+        region: {"timestamp": last_seen["timestamp"], "validators": last_seen.get("validators", {})}
+        for region, last_seen in _last_report_seen.items() if "timestamp" in last_seen
+    }
+    state_file = pathlib.Path(config.REPORT_STATE_FILE)
+    temp_file = state_file.with_name(f"{state_file.name}.tmp")
+    temp_file.write_text(json.dumps(state, indent=2))
+    temp_file.replace(state_file)
+
+
+def get_report_endpoint(region: str = None) -> str:
+    """Return the report API URL for a region (default the first of REGIONS)."""
+    return config.REPORT_ENDPOINT.format(region=region or next(iter(config.REGIONS)))
+
+
+def _parse_jmt_report(
+        raw_data: Optional[dict],
+        last_seen: dict = None,
+) -> Optional[Tuple[ReservationReport, datetime]]:
+    """
+    Reformat a raw report from the API (see get_jmt_report_async). If
+    last_seen is given, returns None if the report's timestamp matches the one
+    in last_seen, and otherwise saves the timestamp and the reformatted report
+    there.
+    """
+    if raw_data is None:
+        print("report not modified since last poll")
+        return None
 
     # get the timestamp
-    report_timestamp = raw_data["response"]["timestamp"]
-    report_timestamp = datetime.strptime(report_timestamp, "%Y-%m-%dT%H:%M:%S")
-    pacific = pytz.timezone("US/Pacific")
-    report_timestamp = pacific.localize(report_timestamp)
+    raw_timestamp = raw_data["response"]["timestamp"]
+    if last_seen is not None and raw_timestamp == last_seen.get("timestamp"):
+        print("report timestamp unchanged since last poll")
+        return None
+    report_timestamp = pytz.timezone("US/Pacific").localize(datetime.fromisoformat(raw_timestamp))
+
+    # get the reserved permit counts
+    with metrics.timer("decode"):
+        report = ReservationReport.from_values(raw_data["response"]["values"])
+
+    if last_seen is not None:
+        last_seen.update(timestamp=raw_timestamp, report=(report, report_timestamp))
+    return report, report_timestamp
+
+
+def _merge_region_reports(
+        regions: List[str],
+        reports: List[Optional[Tuple[ReservationReport, datetime]]],
+        only_if_changed: bool,
+) -> Optional[Tuple[ReservationReport, datetime]]:
+    """
+    Merge the reports of several regions into one report with the latest
+    timestamp (see get_jmt_report_async), and the timestamp of every region
+    as its version. Regions whose report has not changed are taken from their
+    previous report.
+    """
+    if all(report is None for report in reports):
+        return None
+    if len(reports) == 1:
+        return reports[0]
+    region_reports, timestamps = [], {}
+    for region, report in zip(regions, reports):
+        if report is None and only_if_changed:
+            report = _last_report_seen[region].get("report")
+        if report is None:
+            continue
+        region_reports.append(report[0])
+        timestamps[region] = report[1]
+    merged = ReservationReport.merge(region_reports)
+    merged.version = ",".join(
+        f"{region}={timestamp.strftime('%Y-%m-%dT%H:%M:%S')}" for region, timestamp in timestamps.items())
+    return merged, max(timestamps.values())
+
+
+class SnapshotStore:
+    """
+    Append-only history of JMT reports in a SQLite database, so that questions
+    like "at what minute do cancellations usually appear?" can be answered
+    later. Reports are deduplicated by their timestamp and version (see
+    ReservationReport), so polling every few seconds adds a row only when the
+    report is actually updated.
+
+    Each report is a single row. The reserved counts are stored as a
+    zlib-compressed array of 16-bit integers with one row per date (starting at
+    first_date) and one column per trailhead (in the order of trailhead_ids).
+    Missing values are stored as -1. A season of reports fits in well under a
+    megabyte, and range queries use the indexes on the report timestamp and the
+    report date (in Pacific time).
+    """
 
-    # get the reserved permit counts and reformat
-    report_vals = {}
-    for val_dict in raw_data["response"]["values"]:
-        date = val_dict["date"]
-        report_vals[date] = val_dict.copy()
-        report_vals[date].pop("date")
+    def __init__(self, path: Union[str, pathlib.Path]):
+        import sqlite3
+
+        self.path = pathlib.Path(path)
+        self._connection = sqlite3.connect(
+            self.path, timeout=config.SNAPSHOT_DATABASE_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS reports (
+                    id INTEGER PRIMARY KEY,
+                    timestamp TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    report_date TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    first_date TEXT NOT NULL,
+                    n_dates INTEGER NOT NULL,
+                    trailhead_ids TEXT NOT NULL,
+                    counts BLOB NOT NULL,
+                    UNIQUE (timestamp, version)
+                );
+                CREATE INDEX IF NOT EXISTS reports_report_date ON reports (report_date);
+            """)
+
+    def add(self, jmt_report: dict, timestamp: datetime, fetched_at: float = None) -> bool:
+        """
+        Store a report (output of get_jmt_report_async). Returns False if a
+        report with the same timestamp and version was already stored.
+
+        :param fetched_at: unix time when the report was pulled (default now)
+        """
+        import numpy as np
+
+        report = ReservationReport.from_mapping(jmt_report)
+        order = sorted(range(len(report.trailhead_ids)), key=report.trailhead_ids.__getitem__)
+        trailhead_ids = [report.trailhead_ids[i] for i in order]
+        days = report.days()
+        first_date = days.min()
+        n_dates = int((days.max() - first_date) // np.timedelta64(1, "D")) + 1
+        counts = np.full((n_dates, len(trailhead_ids)), -1, dtype=np.int16)
+        counts[(days - first_date) // np.timedelta64(1, "D")] = report.matrix()[:, order]
+
+        timestamp = timestamp.astimezone(pytz.timezone("US/Pacific"))
+        row = (
+            timestamp.strftime("%Y-%m-%dT%H:%M:%S"),
+            report.version,
+            timestamp.strftime("%Y-%m-%d"),
+            time.time() if fetched_at is None else fetched_at,
+            str(first_date),
+            n_dates,
+            ",".join(trailhead_ids),
+            zlib.compress(counts.tobytes()),
+        )
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO reports (timestamp, version, report_date, fetched_at, first_date, "
+                "n_dates, trailhead_ids, counts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+        return cursor.rowcount == 1
+
+    def query(
+        self,
+        start: Union[str, datetime] = None,
+        end: Union[str, datetime] = None,
+    ) -> Iterator[Tuple[dict, datetime]]:
+        """
+        Yield stored reports (in the format of get_jmt_report_async) in order of
+        their timestamps (and of when they were stored, for reports with the
+        same timestamp). Optionally restrict to reports updated between start
+        and end (inclusive), given as datetimes or as dates (YYYY-MM-DD).
+        """
+        for row in self._select(self._REPORT_COLUMNS, start, end):
+            yield self._decode(*row)
+
+    def timestamps(
+        self,
+        start: Union[str, datetime] = None,
+        end: Union[str, datetime] = None,
+    ) -> List[Tuple[datetime, float]]:
+        """Return (report timestamp, unix time when fetched) of stored reports."""
+        pacific = pytz.timezone("US/Pacific")
+        return [
+            (pacific.localize(datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")), fetched_at)
+            for timestamp, fetched_at in self._select("timestamp, fetched_at", start, end)
+        ]
+
+    def latest(self, before: datetime = None) -> Optional[Tuple[dict, datetime]]:
+        """
+        Return the most recently updated stored report, or None. If before is
+        given, only consider reports updated before that time.
+        """
+        where, params = "", []
+        if before is not None:
+            where = "WHERE timestamp < ?"
+            params.append(before.astimezone(pytz.timezone("US/Pacific")).strftime("%Y-%m-%dT%H:%M:%S"))
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {self._REPORT_COLUMNS} FROM reports {where} ORDER BY timestamp DESC, id DESC LIMIT 1",
+                params).fetchone()
+        return None if row is None else self._decode(*row)
+
+    def stored_after(self, report_id: Optional[int]) -> Iterator[Tuple[int, ReservationReport, datetime]]:
+        """
+        Yield (id, report, timestamp) of the reports stored after the report
+        with report_id, in the order they were stored. If report_id is None,
+        only the latest report.
+        """
+        if report_id is None:
+            query = f"SELECT id, {self._REPORT_COLUMNS} FROM reports ORDER BY timestamp DESC, id DESC LIMIT 1"
+        else:
+            query = f"SELECT id, {self._REPORT_COLUMNS} FROM reports WHERE id > ? ORDER BY id"
+        with self._lock:
+            rows = self._connection.execute(query, () if report_id is None else (report_id,)).fetchall()
+        for report_id, *row in rows:
+            yield (report_id, *self._decode(*row))
+
+    def _select(self, columns: str, start, end, page_size: int = 100) -> Iterator[tuple]:
+        """
+        Yield rows in order of their timestamps, reading page_size rows at a
+        time so that long histories are streamed from disk rather than loaded
+        at once.
+        """
+        clauses, params = [], []
+        for bound, operator in (start, ">="), (end, "<="):
+            if bound is None:
+                continue
+            if isinstance(bound, datetime):
+                column = "timestamp"
+                bound = bound.astimezone(pytz.timezone("US/Pacific")).strftime("%Y-%m-%dT%H:%M:%S")
+            else:
+                column = "report_date"
+            clauses.append(f"{column} {operator} ?")
+            params.append(bound)
+        last = "", 0
+        while True:
+            where = " AND ".join(clauses + ["(timestamp, id) > (?, ?)"])
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT timestamp, id, {columns} FROM reports WHERE {where} ORDER BY timestamp, id LIMIT ?",
+                    params + [*last, page_size]).fetchall()
+            for row in rows:
+                yield row[2:]
+            if len(rows) < page_size:
+                return
+            last = rows[-1][:2]
+
+    _REPORT_COLUMNS = "timestamp, version, first_date, n_dates, trailhead_ids, counts"
+
+    @staticmethod
+    def _decode(
+            timestamp: str,
+            version: str,
+            first_date: str,
+            n_dates: int,
+            trailhead_ids: str,
+            blob: bytes,
+    ) -> Tuple[ReservationReport, datetime]:
+        import numpy as np
+
+        trailhead_ids = tuple(map(sys.intern, trailhead_ids.split(",")))
+        counts = np.frombuffer(zlib.decompress(blob), dtype=np.int16).reshape(n_dates, len(trailhead_ids))
+        # dates without any values were not in the report
+        rows = np.flatnonzero((counts >= 0).any(axis=1))
+        dates = np.datetime_as_string(np.datetime64(first_date) + rows).tolist()
+        report_counts = array.array("h")
+        report_counts.frombytes(counts[rows].tobytes())
+        timestamp = pytz.timezone("US/Pacific").localize(datetime.fromisoformat(timestamp))
+        return ReservationReport(dates, trailhead_ids, report_counts, version), timestamp
+
+
+def get_snapshot_store() -> Optional[SnapshotStore]:
+    """Return the SnapshotStore at SNAPSHOT_DATABASE, or None if it is disabled."""
+    global _snapshot_store
+    if config.SNAPSHOT_DATABASE is None:
+        return None
+    if _snapshot_store is None:
+        _snapshot_store = SnapshotStore(config.SNAPSHOT_DATABASE)
+    return _snapshot_store
+
+
+class Coordinator:
+    """
+    Shared state of the workers of a coordinated daemon (see
+    run_worker_async). Workers publish every report they pull to the snapshot
+    store, which keeps one copy of each report update (the first worker to
+    publish it detected it). The workers compete for a leader lease of
+    COORDINATOR_LEASE seconds, renewed while the leader is alive. Only the
+    leader evaluates the published reports and sends notifications, in the
+    order they were published, and it records the last report it handled so
+    that a new leader (if the leader stops) carries on where it left off.
+    Each report update is thus notified once, unless the leader stops while
+    sending its notifications.
+
+    The lease is kept in the SQLite database of the snapshot store, so the
+    workers must share SNAPSHOT_DATABASE on one host: SQLite locks are not
+    reliable on network file systems, so workers on several hosts are not
+    supported. Its methods block on the database, so call them in a thread
+    from async code.
+    """
+
+    def __init__(self, store: SnapshotStore, name: str):
+        """
+        :param store: snapshot store shared by the workers
+        :param name: name of this worker, unique among the workers
+        """
+        import sqlite3
+
+        self.store = store
+        self.name = name
+        self._connection = sqlite3.connect(
+            store.path, timeout=config.SNAPSHOT_DATABASE_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS leader (
+                    singleton INTEGER PRIMARY KEY CHECK (singleton = 0),
+                    worker TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    handled_id INTEGER
+                )
+            """)
+
+    def publish(self, jmt_report: dict, timestamp: datetime) -> bool:
+        """Publish a pulled report. Returns False if it was already published."""
+        return self.store.add(jmt_report, timestamp)
+
+    def elect(self) -> bool:
+        """
+        Take the leader lease if it is free or expired, or renew it if this
+        worker holds it. Returns whether this worker is the leader.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                INSERT INTO leader (singleton, worker, expires) VALUES (0, ?, ?)
+                ON CONFLICT (singleton) DO UPDATE SET worker = excluded.worker, expires = excluded.expires
+                WHERE leader.worker = excluded.worker OR leader.expires < ?
+            """, (self.name, now + config.COORDINATOR_LEASE, now))
+            leader, = self._connection.execute("SELECT worker FROM leader").fetchone()
+        return leader == self.name
+
+    def resign(self):
+        """Release the leader lease (if held), so another worker takes over right away."""
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE leader SET expires = 0 WHERE worker = ?", (self.name,))
+
+    def unhandled_reports(self) -> Iterator[Tuple[int, ReservationReport, datetime]]:
+        """
+        Yield (id, report, timestamp) of the published reports that no leader
+        has handled yet, in the order they were published. If no report was
+        ever handled, only the latest.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT handled_id FROM leader").fetchone()
+        yield from self.store.stored_after(None if row is None else row[0])
+
+    def mark_handled(self, report_id: int):
+        """Record that the leader handled the report with report_id."""
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE leader SET handled_id = ? WHERE worker = ?", (report_id, self.name))
+
+
+def read_report_history(path: Union[str, pathlib.Path]) -> Iterator[Tuple[dict, datetime]]:
+    """
+    Yield recorded reports (in the format of get_jmt_report_async) one at a
+    time, in the order they were recorded. path is either a snapshot database
+    (see SnapshotStore) or a JSON lines file with one raw API response (see
+    get_json_from_api) per line, optionally gzip compressed.
+    """
+    import gzip
+
+    path = pathlib.Path(path)
+    with open(path, "rb") as f:
+        header = f.read(16)
+    if header == b"SQLite format 3\x00":
+        yield from SnapshotStore(path).query()
+        return
+    opener = gzip.open if header[:2] == b"\x1f\x8b" else open
+    with opener(path, "rt") as lines:
+        for line in lines:
+            if line.strip():
+                yield _parse_jmt_report(json.loads(line))
+
+
+@contextlib.contextmanager
+def file_lock(path: Union[str, pathlib.Path]):
+    """
+    Context manager that holds an exclusive lock on the file at path (created
+    if needed), which works across processes (and threads). Without fcntl
+    (e.g. on Windows), nothing is locked.
+    """
+    with open(path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_running(solver: str) -> bool:
+    """
+    Return whether the poller named solver ("host:pid:thread", see
+    SessionManager._authorize) may still be running, i.e. whether its process
+    exists. The session state is only shared by the pollers of one host, so a
+    solver with another host name (e.g. in a copied state file) cannot be
+    checked and is assumed to be running until SESSION_SOLVE_TIMEOUT.
+    """
+    host, pid, _ = solver.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SessionStateStore:
+    """
+    Authorization state of the yosemite.org API session, saved as JSON so that
+    it is reused by later runs and shared by pollers running at the same time:
+
+    {
+        "cookies": [{"name": ..., "value": ..., "domain": ..., "path": ..., ...}],
+        "solved_at": 1625155200.0,  # unix time when the captcha was solved
+        "lifetime": 86400.0,        # expected lifetime of a session (see SessionManager)
+        "solving": {"by": ..., "until": 1625155800.0}  # poller solving a captcha, if any
+    }
 
-    return report_vals, report_timestamp
+    Writes replace the file atomically, so readers never see a partial file.
+    lock() holds an exclusive lock on a companion .lock file that works across
+    processes (and threads) while the state is read and updated. It is never
+    held while solving a captcha: a poller claims the solve (see claim), so
+    only one poller at a time solves a captcha while the others wait and then
+    reuse its cookies.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+        self.lock_path = self.path.with_name(f"{self.path.name}.lock")
+
+    def lock(self) -> ContextManager:
+        """Context manager that holds the cross-process lock on the state."""
+        return file_lock(self.lock_path)
+
+    def load(self) -> Optional[dict]:
+        """Return the saved state, or None if there is none (or it is invalid)."""
+        try:
+            state = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            print(f"ignoring invalid session state at {self.path.absolute()}")
+            return None
+        return state
+
+    def save(
+            self,
+            cookies: requests.cookies.RequestsCookieJar,
+            solved_at: Optional[float],
+            lifetime: Optional[float],
+            solving: dict = None,
+    ):
+        """Save the cookies of a session authorized at solved_at (hold lock())."""
+        state = {
+            "cookies": [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "expires": cookie.expires,
+                    "secure": cookie.secure,
+                }
+                for cookie in cookies
+            ],
+            "solved_at": solved_at,
+            "lifetime": lifetime,
+        }
+        if solving is not None:
+            state["solving"] = solving
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        temp_path.write_text(json.dumps(state, indent=2))
+        temp_path.chmod(0o600)
+        temp_path.replace(self.path)
+
+    def invalidate(self, solved_at: Optional[float], lifetime: float):
+        """
+        Forget the saved cookies if they are those of the session authorized
+        at solved_at (cookies saved since by another poller are kept), and
+        save the observed lifetime.
+        """
+        with self.lock():
+            state = self.load() or {"cookies": [], "solved_at": None, "lifetime": config.SESSION_LIFETIME}
+            if state["solved_at"] == solved_at:
+                state["cookies"] = []
+            self.save(self.cookie_jar(state), state["solved_at"], lifetime, state.get("solving"))
+
+    def claim(self, solver: str) -> bool:
+        """
+        Claim solving a captcha for solver (a name unique to the poller) for up
+        to SESSION_SOLVE_TIMEOUT seconds (hold lock()). Returns False if
+        another poller's claim has not expired yet. The claim ends when the new
+        cookies are saved, or with release.
+        """
+        state = self.load() or {"cookies": [], "solved_at": None, "lifetime": config.SESSION_LIFETIME}
+        solving = state.get("solving")
+        if solving and solving["by"] != solver and solving["until"] > time.time() and _is_running(solving["by"]):
+            return False
+        solving = {"by": solver, "until": time.time() + config.SESSION_SOLVE_TIMEOUT}
+        self.save(self.cookie_jar(state), state["solved_at"], state["lifetime"], solving)
+        return True
+
+    def release(self, solver: str):
+        """End the claim of solver (see claim), e.g. after the solve failed."""
+        with self.lock():
+            state = self.load()
+            if state is not None and (state.get("solving") or {}).get("by") == solver:
+                self.save(self.cookie_jar(state), state["solved_at"], state["lifetime"])
+
+    @staticmethod
+    def cookie_jar(state: dict) -> requests.cookies.RequestsCookieJar:
+        """Return the saved cookies as a cookie jar."""
+        jar = requests.cookies.RequestsCookieJar()
+        for cookie in state["cookies"]:
+            jar.set(**cookie)
+        return jar
+
+
+class RequestGovernor:
+    """
+    Paces requests to the yosemite.org APIs according to how the site is
+    doing, so that hackjohn backs off when the site is struggling and polls at
+    full speed when it is healthy. Every API request in this process (from all
+    threads, tasks and regions) goes through the one governor:
+
+    - latency: exponentially weighted moving averages of the response time and
+      its deviation set the timeout (like TCP's retransmission timeout), within
+      API_TIMEOUT_MIN and API_TIMEOUT_MAX
+    - errors: after consecutive errors (exceptions, 429 and 5xx responses),
+      requests wait a random time up to API_BACKOFF_BASE * 2 ** (errors - 1)
+      seconds, capped at API_BACKOFF_MAX or extended by a Retry-After header.
+      The first successful response ends the backoff.
+    - budget: a token bucket allows at most API_REQUEST_BUDGET requests per
+      minute, in bursts of up to the same number. The bucket is kept in
+      API_BUDGET_FILE, so the budget is shared by all pollers on the host
+      (e.g. the workers of a coordinated daemon and one-shot runs from cron).
+
+    The error rate (also a moving average) slows down the daemon's polling
+    (see poll_interval).
+    """
+
+    def __init__(self):
+        self.latency = None     # smoothed response time in seconds
+        self.deviation = None   # smoothed absolute deviation of the response time
+        self.error_rate = 0.0   # smoothed fraction of failed requests
+        self.consecutive_errors = 0
+        self._backoff_until = 0.0
+        self._tokens = float(config.API_REQUEST_BUDGET)  # used if API_BUDGET_FILE is None
+        self._tokens_at = time.time()
+        self._lock = threading.Lock()
+
+    def timeout(self) -> float:
+        """Seconds to wait for a response before giving up."""
+        if self.latency is None:
+            return config.API_TIMEOUT
+        timeout = self.latency + 4 * self.deviation
+        return min(max(timeout, config.API_TIMEOUT_MIN), config.API_TIMEOUT_MAX)
+
+    def _reserve(self) -> float:
+        """Take a request from the budget and return the seconds to wait before sending it."""
+        budget_wait = self._take_token()
+        with self._lock:
+            wait = max(budget_wait, self._backoff_until - time.monotonic())
+        if wait > 0:
+            metrics.observe("governor_wait_seconds", wait)
+        return wait
+
+    def _take_token(self) -> float:
+        """
+        Take a token from the bucket (in API_BUDGET_FILE, or in this process if
+        it is None) and return the seconds until the token is available.
+        """
+        if config.API_BUDGET_FILE is None:
+            with self._lock:
+                self._tokens, self._tokens_at = self._spend(self._tokens, self._tokens_at, time.time())
+                tokens = self._tokens
+        else:
+            path = pathlib.Path(config.API_BUDGET_FILE)
+            with file_lock(path.with_name(f"{path.name}.lock")):
+                try:
+                    bucket = json.loads(path.read_text())
+                    tokens, tokens_at = self._spend(bucket["tokens"], bucket["at"], time.time())
+                except (FileNotFoundError, ValueError, KeyError, TypeError):
+                    tokens, tokens_at = self._spend(config.API_REQUEST_BUDGET, time.time(), time.time())
+                path.write_text(json.dumps({"tokens": tokens, "at": tokens_at}))
+        return -tokens / (config.API_REQUEST_BUDGET / 60) if tokens < 0 else 0
+
+    @staticmethod
+    def _spend(tokens: float, tokens_at: float, now: float) -> Tuple[float, float]:
+        """Refill a bucket that had tokens at unix time tokens_at, and take a token at now."""
+        rate = config.API_REQUEST_BUDGET / 60
+        tokens = min(tokens + max(now - tokens_at, 0) * rate, config.API_REQUEST_BUDGET)
+        return tokens - 1, now
+
+    def wait(self):
+        """Block until the next request may be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, seconds: float, status: int = None, retry_after: str = None):
+        """
+        Record the outcome of a request that took seconds: its HTTP status, or
+        None if it failed without a response (e.g. a timeout).
+        """
+        failed = status is None or status == 429 or status >= 500
+        alpha = config.API_HEALTH_SMOOTHING
+        with self._lock:
+            if self.latency is None:
+                self.latency, self.deviation = seconds, seconds / 2
+            else:
+                self.deviation += alpha * (abs(seconds - self.latency) - self.deviation)
+                self.latency += alpha * (seconds - self.latency)
+            self.error_rate += alpha * (failed - self.error_rate)
+            if not failed:
+                self.consecutive_errors = 0
+                self._backoff_until = 0.0
+                return
+            self.consecutive_errors += 1
+            cap = min(config.API_BACKOFF_BASE * 2 ** (self.consecutive_errors - 1), config.API_BACKOFF_MAX)
+            backoff = random.uniform(0, cap)
+            if retry_after is not None and retry_after.isdigit():
+                backoff = max(backoff, int(retry_after))
+            self._backoff_until = time.monotonic() + backoff
+        metrics.increment("api_errors_total", status=str(status or "none"))
+        print(f"API request failed ({self.consecutive_errors} in a row) -- "
+              f"backing off for {backoff:.1f} seconds")
+
+    def poll_interval(self, interval: float) -> float:
+        """Stretch a poll interval by up to API_ERROR_SLOWDOWN as the error rate rises."""
+        return interval * (1 + (config.API_ERROR_SLOWDOWN - 1) * self.error_rate)
+
+
+governor = RequestGovernor()
+
+
+class SessionManager:
+    """
+    Owns the HTTP sessions used by hackjohn, so that every request goes through
+    a small number of long-lived sessions with keep-alive connection pools (one
+    pool per host) instead of opening a new connection per request.
+
+    - the API session carries the authorization cookies for the yosemite.org
+      APIs. Cookies are loaded from SESSION_STATE_FILE (see
+      SessionStateStore) once, and the session is reauthorized in place when
+      they expire. Pollers in other processes share the same saved session,
+      and only one of them solves a captcha at a time.
+    - the notification session is shared by the Telegram and IFTTT notifiers.
+    - the Twilio client is created once and reuses its own connection pool.
+
+    The sessions block, so the asynchronous pipeline sends requests from
+    worker threads (requests sessions are shared by threads, with a
+    connection pool of HTTP_POOL_MAXSIZE per host).
+
+    Retries are left to the tenacity decorators, so the transport adapters
+    never retry on their own.
+
+    Solving a captcha takes a minute or two, so in daemon mode a background
+    refresher (see refresh_forever_async) authorizes a standby session before the
+    current authorization is expected to expire, and swaps it in atomically.
+    The expected lifetime starts at SESSION_LIFETIME and is a moving average
+    (see observe_lifetime): it moves down when authorization expires sooner,
+    and back up when sessions are replaced without expiring, so a single early
+    expiry (e.g. the server flushing its sessions) does not keep the refresher
+    solving captchas too often.
+    """
+
+    def __init__(self):
+        self._api_session = None
+        self._authorized = False
+        self._standby = None
+        self._standby_authorized_at = None
+        self._notify_session = None
+        self._twilio_client = None
+        self.authorized_at = None  # unix time when the current cookies were obtained
+        self.lifetime = config.SESSION_LIFETIME  # expected seconds until cookies expire
+        self._lock = threading.Lock()
+        self._solve_lock = threading.Lock()  # held while solving a captcha
+
+    @staticmethod
+    def _new_session() -> requests.Session:
+        s = requests.session()
+        adapter = HTTPAdapter(
+            pool_connections=config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE,
+            max_retries=0,
+        )
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        return s
+
+    def api_session(self) -> requests.Session:
+        """
+        Return the authorized session for the yosemite.org APIs. Uses a standby
+        session from the background refresher if one is ready, then the saved
+        session (from the last run or another poller) if there is one,
+        otherwise authenticates a new session and saves it.
+        """
+        with self._lock:
+            if self._api_session is None:
+                self._api_session = self._new_session()
+            if self._authorized:
+                return self._api_session
+
+        # wait for a captcha that the refresher may be solving right now (only
+        # threads that need an authorized session wait for the solve)
+        with self._solve_lock:
+            with self._lock:
+                if self._authorized:
+                    return self._api_session
+                if self._standby is not None:
+                    print("switching to standby session...")
+                    self._swap_in_standby()
+                    return self._api_session
+                s = self._api_session
+            authorized_at = self._authorize(s)
+            with self._lock:
+                self.authorized_at = authorized_at
+                self._authorized = True
+            return s
+
+    def _authorize(self, s: requests.Session, newer_than: float = None, verify: bool = False) -> float:
+        """
+        Authorize session s with the saved session (from the last run or
+        another poller), if there is one authorized after newer_than, and
+        otherwise by solving a captcha and saving the cookies. Returns the unix
+        time when the cookies were obtained. If verify is True, a new session
+        is checked with a request for a report before it is saved.
+
+        Only one poller at a time solves a captcha (see SessionStateStore.claim),
+        while the others wait for its cookies. The session state is only locked
+        while it is read and written, never during the solve.
+        """
+        store = self.state_store()
+        solver = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        waiting = False
+        while True:
+            with store.lock():
+                with metrics.timer("session_load"):
+                    state = store.load()
+                if state is not None:
+                    self.lifetime = state["lifetime"]
+                if state is not None and state["cookies"] and state["solved_at"] > (newer_than or 0):
+                    print("using saved session...")
+                    s.cookies.update(store.cookie_jar(state))
+                    return state["solved_at"]
+                if store.claim(solver):
+                    break
+            if not waiting:
+                print("waiting for another poller to solve a captcha...")
+                waiting = True
+            time.sleep(config.SESSION_SOLVE_CHECK_INTERVAL)
+
+        print("did not find a saved session -- getting new session...")
+        try:
+            get_authorized_session(api_key=config.CAPTCHA_API_KEY, session=s)
+            authorized_at = time.time()
+            if verify:
+                governor.wait()
+                query = s.get(get_report_endpoint(), timeout=governor.timeout())
+                if query.json()["response"] is None:
+                    raise ValueError("new session is not authorized")
+        except BaseException:
+            store.release(solver)
+            raise
+        with store.lock():
+            store.save(s.cookies, authorized_at, self.lifetime)
+        return authorized_at
+
+    @staticmethod
+    def state_store() -> SessionStateStore:
+        return SessionStateStore(config.SESSION_STATE_FILE)
+
+    def invalidate_api_session(self):
+        """
+        Forget the authorization cookies (in memory and in the saved session
+        state, unless another poller has saved a newer session), so that the
+        next call to api_session authenticates again. The session itself is
+        kept so its connections stay warm.
+        """
+        with self._lock:
+            if not self._authorized:
+                # already invalidated (e.g. by a concurrent request), and maybe
+                # being authorized again right now
+                return
+            if self.authorized_at is not None:
+                observed = time.time() - self.authorized_at
+                print(f"authorization expired after {observed / 3600:.1f} hours")
+                self.observe_lifetime(observed, expired=True)
+            if self._api_session is not None:
+                self._api_session.cookies.clear()
+            self._authorized = False
+            authorized_at = self.authorized_at
+        self.state_store().invalidate(authorized_at, self.lifetime)
+
+    def observe_lifetime(self, seconds: float, expired: bool):
+        """
+        Update the expected lifetime of the cookies with a session that
+        expired after seconds, or that was replaced by the refresher after
+        seconds without expiring (which moves the expected lifetime back up
+        towards SESSION_LIFETIME). The expected lifetime moves by
+        SESSION_LIFETIME_SMOOTHING of the difference, between
+        SESSION_LIFETIME_MIN and SESSION_LIFETIME.
+        """
+        target = seconds if expired else config.SESSION_LIFETIME
+        lifetime = self.lifetime + config.SESSION_LIFETIME_SMOOTHING * (target - self.lifetime)
+        self.lifetime = min(max(lifetime, config.SESSION_LIFETIME_MIN), config.SESSION_LIFETIME)
+
+    def _swap_in_standby(self):
+        """Replace the API session with the standby session (hold self._lock)."""
+        old_session, self._api_session = self._api_session, self._standby
+        self._standby = None
+        self._authorized = True
+        self.authorized_at = self._standby_authorized_at
+        if old_session is not None:
+            old_session.close()
+
+    def seconds_until_refresh(self) -> float:
+        """
+        Seconds until the background refresher should solve a new captcha: at
+        SESSION_REFRESH_FRACTION of the expected lifetime of the cookies, or
+        right away if the API session is not authorized.
+        """
+        if not self._authorized or self.authorized_at is None:
+            return 0
+        refresh_at = self.authorized_at + config.SESSION_REFRESH_FRACTION * self.lifetime
+        return refresh_at - time.time()
+
+    def refresh(self):
+        """
+        Authorize a standby session, check that it works with a request for a
+        report, save it, and swap it in for the current API session. If another
+        poller has saved a newer session in the meantime, that session is used
+        instead of solving another captcha.
+        """
+        with self._solve_lock:
+            if self._standby is None:
+                s = self._new_session()
+                authorized_at = self._authorize(s, newer_than=self.authorized_at, verify=True)
+                self._standby, self._standby_authorized_at = s, authorized_at
+        with self._lock:
+            if self._standby is not None:
+                print("switching to refreshed session...")
+                if self._authorized and self.authorized_at is not None:
+                    # the current session is replaced before it expired
+                    self.observe_lifetime(time.time() - self.authorized_at, expired=False)
+                self._swap_in_standby()
+
+    async def refresh_forever_async(self):
+        """
+        Refresh the API session ahead of expiry, forever. This runs as a task
+        on the daemon's event loop, and captcha solves run in a worker thread,
+        so polling never waits on them.
+        """
+        while True:
+            try:
+                if self.authorized_at is None:
+                    # load saved cookies or solve a first captcha
+                    await asyncio.to_thread(self.api_session)
+                wait = self.seconds_until_refresh()
+                if wait > 0:
+                    # check again soon, in case the session is invalidated early
+                    await asyncio.sleep(min(wait, 1))
+                    continue
+                print("refreshing authorized session in the background...")
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"error refreshing session: {e!r}")
+                await asyncio.sleep(config.RECAPTCHA_RETRY_INTERVAL)
+
+    def api_get(self, url: str, **kwargs) -> requests.Response:
+        """
+        GET from a yosemite.org API with the authorized session, paced by the
+        request governor.
+        """
+        s = self.api_session()
+        governor.wait()
+        kwargs.setdefault("timeout", governor.timeout())
+        start = time.perf_counter()
+        try:
+            response = s.get(url, **kwargs)
+        except requests.RequestException:
+            governor.record(time.perf_counter() - start)
+            raise
+        seconds = time.perf_counter() - start
+        governor.record(seconds, response.status_code, response.headers.get("Retry-After"))
+        _observe_response_times(response, seconds)
+        return response
+
+    def notify_post(self, url: str, timeout: float, **kwargs) -> requests.Response:
+        """POST to a notification service with the shared notification session."""
+        with self._lock:
+            if self._notify_session is None:
+                self._notify_session = self._new_session()
+        start = time.perf_counter()
+        response = self._notify_session.post(url, timeout=timeout, **kwargs)
+        _observe_response_times(response, time.perf_counter() - start)
+        return response
+
+    def twilio_client(self) -> "Client":
+        """Return the Twilio client, creating it on first use."""
+        with self._lock:
+            if self._twilio_client is None:
+                from twilio.http.http_client import TwilioHttpClient
+                from twilio.rest import Client
+
+                http_client = TwilioHttpClient(
+                    pool_connections=True, timeout=config.NOTIFY_TIMEOUTS["twilio"])
+                self._twilio_client = Client(
+                    config.TWILIO_ACCOUNT_SID,
+                    config.TWILIO_AUTH_TOKEN,
+                    http_client=http_client,
+                )
+            return self._twilio_client
+
+
+sessions = SessionManager()
+
+
+class SessionExpired(ValueError):
+    """The yosemite.org API responded that the session is not authorized."""
+
+
+def _observe_response_times(response: requests.Response, seconds: float):
+    """Record time to first byte (until headers were parsed) and total time."""
+    host = urllib.parse.urlsplit(response.url).hostname
+    metrics.observe("http_seconds", response.elapsed.total_seconds(), phase="ttfb", host=host)
+    metrics.observe("http_seconds", seconds, phase="total", host=host)
 
 
 @retry(
     stop=stop_after_attempt(config.MAX_RETRY_ATTEMPTS),
     retry=retry_if_exception_type(),
+    before_sleep=count_retry,
     reraise=True,
 )
-def get_json_from_api(api_url: str) -> dict:
+def get_json_from_api(api_url: str, validators: dict = None) -> Optional[dict]:
     """
     Get the raw data from the specified API. Sends a GET request to the URL
-    provided. Uses saved cookies from the last run if they exist, otherwise
-    authenticates a new session.
+    provided with the authorized session (see SessionManager.api_session).
+    Blocks until the response is received (the asynchronous pipeline calls it
+    in a worker thread).
 
     The response for the yosemite.org APIs is a JSON file with keys for
     "status" and "response". The "status" entry contains a message about
@@ -144,56 +2107,88 @@ def get_json_from_api(api_url: str) -> dict:
     config.MAX_RETRY_ATTEMPTS times.
 
     :param api_url: URL for the GET request
-    :return: JSON response from the request
+    :param validators: HTTP cache validators ("ETag" and "Last-Modified") from
+    a previous response. If provided, the request is conditional and the dict
+    is updated in place with the validators of the new response.
+    :return: JSON response from the request, or None if validators were
+    provided and the server responded 304 Not Modified
     """
-    cookie_file = pathlib.Path(config.COOKIE_FILE)
-    if cookie_file.is_file():
-        print("using saved cookies...")
-        with open(cookie_file, "rb") as f:
-            cookies = pickle.load(f)
-        s = requests.session()
-        s.cookies.update(cookies)
-
-    else:
-        print("did not find saved cookies -- getting new session...")
-        s = get_authorized_session(api_key=config.CAPTCHA_API_KEY)
-
     # pull the data (should be near instantaneous, but sometimes there are
     # timeout errors which go away upon retrying)
-    query = s.get(api_url, timeout=2)
-    data = json.loads(query.text)
+    query = sessions.api_get(api_url, headers=_get_conditional_headers(validators))
+    try:
+        return _read_api_response(query.status_code, query.headers, query.content, validators)
+    except SessionExpired:
+        sessions.invalidate_api_session()
+        raise
+
+
+def _get_conditional_headers(validators: Optional[dict]) -> dict:
+    """Return headers for a conditional request (see get_json_from_api)."""
+    headers = {}
+    if validators:
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+
+def _read_api_response(
+        status: int,
+        headers: Mapping[str, str],
+        body: bytes,
+        validators: Optional[dict],
+) -> Optional[dict]:
+    """
+    Decode the JSON response from a yosemite.org API (see get_json_from_api).
+    Raises SessionExpired if the session is not authorized.
+    """
+    if validators is not None and status == 304:
+        return None
+    with metrics.timer("json_parse"):
+        data = json.loads(body)
 
     # data["response"] will be a dict if successful, or None if not authorized
     if data["response"] is None:
         print("cookies were not valid -- deleting cookies and retrying with "
               "new session...")
-        cookie_file.unlink(missing_ok=True)
-        raise ValueError(f"session is not authorized")
+        raise SessionExpired("session is not authorized")
+
+    if validators is not None:
+        validators.clear()
+        for header in ("ETag", "Last-Modified"):
+            if header in headers:
+                validators[header] = headers[header]
 
     return data
 
 
 @retry(
     stop=stop_after_attempt(config.MAX_RETRY_ATTEMPTS),
-    wait=wait_fixed(config.RECAPTCHA_RETRY_INTERVAL),
+    wait=wait_random_exponential(multiplier=config.RECAPTCHA_RETRY_INTERVAL, max=config.API_BACKOFF_MAX),
     retry=retry_if_exception_type(),
+    before_sleep=count_retry,
     reraise=True,
 )
-def get_authorized_session(api_key: str) -> requests.Session:
+def get_authorized_session(api_key: str, session: requests.Session = None) -> requests.Session:
     """
     Solve the recaptcha, then authenticate browser by sending the recaptcha
     response in a POST request. Return the authorized session.
 
     If an exception is raised, this function will be retried up to
-    config.MAX_RETRY_ATTEMPTS times, waiting config.RECAPTCHA_RETRY_INTERVAL
-    seconds between attempts.
+    config.MAX_RETRY_ATTEMPTS times, waiting a random time between attempts
+    (up to config.RECAPTCHA_RETRY_INTERVAL seconds, doubled for each attempt).
 
     :param api_key: API key for the captcha solving service
+    :param session: session to authorize (a new session if None)
     """
     print("solving captcha...")
     try:
-        recaptcha_response = get_recaptcha_response(api_key)
-        s = requests.session()
+        with metrics.timer("captcha_solve"):
+            recaptcha_response = get_recaptcha_response(api_key)
+        metrics.increment("spend_usd_total", config.CAPTCHA_COST, service="2captcha")
+        s = session or requests.session()
         r = s.post(
             url=config.RECAPTCHA_REQUEST_URL,
             data={
@@ -202,16 +2197,10 @@ def get_authorized_session(api_key: str) -> requests.Session:
             },
         )
         r.raise_for_status()  # raise exception if the request didn't work
-
-        # save cookies to a file so we can try reusing later
-        with open(config.COOKIE_FILE, "wb") as f:
-            pickle.dump(s.cookies, f)
-
         return s
 
     except Exception as e:
-        print(f"\nerror solving recaptcha -- waiting {config.RECAPTCHA_RETRY_INTERVAL} "
-              f"seconds and trying again...")
+        print("\nerror solving recaptcha -- waiting and trying again...")
         raise e
 
 
@@ -222,6 +2211,8 @@ def get_recaptcha_response(api_key: str) -> str:
     NOTE: This is configured to use 2Captcha as the captcha solving service. If
     you want to use a different service you'll have to modify this function.
     """
+    from twocaptcha import TwoCaptcha
+
     solver = TwoCaptcha(apiKey=api_key)
     balance = solver.balance()
     print(f"2Captcha current balance: ${balance}...")
@@ -231,20 +2222,156 @@ def get_recaptcha_response(api_key: str) -> str:
     return r["code"]
 
 
-def find_available_permits(jmt_report: dict, timestamp: datetime, trailheads: dict) -> dict:
+class Region(NamedTuple):
     """
-    Search for available permits at JMT trailheads for the appropriate dates.
-    Only include if there are at least MIN_SPACES available. Do not include any
-    trailheads listed in EXCLUDE_TRAILHEADS.
+    Quota model of a wilderness region, from REGIONS in config.py. Permits at
+    a trailhead are limited by its entry quota and by the exit quota that
+    applies to it, if any.
+    """
+    id: str
+    default_exit: Optional[str]        # exit quota for trailheads without their own
+    exits: Mapping[str, str]           # trailhead id -> exit quota id
+    trailheads: Optional[frozenset]    # trailhead ids to watch (None for all)
+
+    @property
+    def exit_quota_ids(self) -> set:
+        """Ids in the region's report that are exit quotas, not trailheads."""
+        return {self.default_exit, *self.exits.values()} - {None}
+
+    def exit_quota(self, trailhead_id: str) -> Optional[str]:
+        return self.exits.get(trailhead_id, self.default_exit)
+
+
+def get_regions() -> dict:
+    """Return a Region for each region in REGIONS, keyed by region id."""
+    return {
+        id_: Region(
+            id=id_,
+            default_exit=region.get("default_exit"),
+            exits=region.get("exits", {}),
+            trailheads=frozenset(region["trailheads"]) if region.get("trailheads") else None,
+        )
+        for id_, region in config.REGIONS.items()
+    }
+
+
+class ReportMatrix:
+    """
+    Dense date x trailhead representation of a report, so that available
+    permits can be computed for all dates and trailheads with a few vectorized
+    operations instead of a loop over every date and trailhead.
+
+    - dates: sorted report dates (datetime64[D])
+    - trailhead_ids: entry trailheads, in the order they appear in the report
+    - entry_available: entry quota minus reserved permits (dates x trailheads)
+    - exit_available: exit quota minus reserved exits, for the exit quota that
+      applies to each trailhead (dates x trailheads). Trailheads without an
+      exit quota are only limited by their entry quota.
+    - names: wpsName of each trailhead
+
+    Which ids are exit quotas, and which exit quota applies to each trailhead,
+    comes from the Region of the trailhead (its "region" in the trailhead
+    information). Dates, trailheads or exit quotas missing from the report
+    count as unavailable.
+    """
+
+    def __init__(self, jmt_report: dict, trailheads: dict, regions: dict = None):
+        import numpy as np
+
+        regions = get_regions() if regions is None else regions
+        report = ReservationReport.from_mapping(jmt_report)
+        order = np.argsort(report.days(), kind="stable")
+        columns = list(report.trailhead_ids)
+        column_index = {id_: i for i, id_ in enumerate(columns)}
+
+        # reserved permits, with quotas for missing values so nothing is available
+        quotas = np.array([trailheads[id_]["quota"] for id_ in columns])
+        counts = report.matrix()[order]
+        reserved = np.where(counts >= 0, counts, quotas)
+        available = quotas - reserved
+
+        # exit quotas are not real trailheads
+        exit_ids = set().union(*(region.exit_quota_ids for region in regions.values()))
+        trailhead_regions = {}
+        for id_ in columns:
+            region = regions.get(trailheads[id_].get("region"))
+            if id_ in exit_ids or (region is not None and region.trailheads is not None
+                                   and id_ not in region.trailheads):
+                continue
+            trailhead_regions[id_] = region
+        self.trailhead_ids = list(trailhead_regions)
+        entry_columns = [column_index[id_] for id_ in self.trailhead_ids]
+        self.entry_available = available[:, entry_columns]
+
+        # limit each trailhead by its exit quota
+        self.exit_available = self.entry_available.copy()
+        for col, (id_, region) in enumerate(trailhead_regions.items()):
+            exit_id = region.exit_quota(id_) if region is not None else None
+            if exit_id is None:
+                continue
+            if exit_id in column_index:
+                self.exit_available[:, col] = available[:, column_index[exit_id]]
+            else:
+                self.exit_available[:, col] = 0
+
+        self.dates = report.days()[order]
+        self.names = np.array([trailheads[id_]["wpsName"] for id_ in self.trailhead_ids])
+
+    def available(self) -> "np.ndarray":
+        """Return the number of available permits (dates x trailheads)."""
+        import numpy as np
+
+        return np.clip(np.minimum(self.entry_available, self.exit_available), 0, None)
+
+    def available_permits(
+            self,
+            start_date: str,
+            end_date: str,
+            min_spaces: int = 1,
+            exclude_trailheads: Iterable[str] = (),
+    ) -> dict:
+        """
+        Return available permits between start_date and end_date (inclusive)
+        with at least min_spaces available, excluding trailheads by wpsName, in
+        the format of find_available_permits.
+        """
+        import numpy as np
+
+        available = self.available()
+        date_mask = (self.dates >= np.datetime64(start_date)) & (self.dates <= np.datetime64(end_date))
+        trailhead_mask = ~np.isin(self.names, list(exclude_trailheads))
+        mask = (available >= max(min_spaces, 1)) & date_mask[:, None] & trailhead_mask[None, :]
+
+        available_permits = {}
+        rows, cols = np.nonzero(mask)
+        for row, col, n in zip(rows.tolist(), cols.tolist(), available[rows, cols].tolist()):
+            date = str(self.dates[row])
+            if date not in available_permits:
+                available_permits[date] = {}
+            available_permits[date][self.trailhead_ids[col]] = n
+        return available_permits
+
+
+@timed("availability")
+def find_available_permits(
+        jmt_report: dict,
+        timestamp: datetime,
+        trailheads: dict,
+        matrix: ReportMatrix = None,
+) -> dict:
+    """
+    Search for available permits at the trailheads of every region in REGIONS
+    for the appropriate dates. Only include if there are at least MIN_SPACES
+    available. Do not include any trailheads listed in EXCLUDE_TRAILHEADS.
 
     Logic:
     - raw report contains number of reserved permits from each trailhead per day
     - trailhead file contains the entry quota for the trailhead, as well as the
-      exit quota for Donohue Pass (note that Lyell Canyon has different Donohue
-      exit quota)
+      exit quotas (for JMT, the exit quota for Donohue Pass; note that Lyell
+      Canyon has a different Donohue exit quota, see REGIONS)
     - entry permits available = trailhead quota - trailhead reserved
-    - Donohue exits available = Donohue quota - Donohue reserved
-    --> overall available = min(entry permits available, Donohue exits available)
+    - exits available = exit quota - exits reserved
+    --> overall available = min(entry permits available, exits available)
 
     Returns a dictionary of available permits. For example:
     {
@@ -257,46 +2384,27 @@ def find_available_permits(jmt_report: dict, timestamp: datetime, trailheads: di
         }
     }
 
-    :param jmt_report: dictionary of reserved permits (output of get_jmt_report)
+    :param jmt_report: dictionary of reserved permits (output of get_jmt_report_async)
     :param timestamp: timestamp of the last report update
     :param trailheads: dictionary of trailhead information (output of
     get_trailhead_descriptions)
+    :param matrix: ReportMatrix of the report, if it has already been built
     """
     # get appropriate date range based on user input and today's date
     start_date, end_date = get_start_end_dates(jmt_report, timestamp)
     print(f"searching for open permits from {start_date} through {end_date}...")
 
-    available_permits = {}
-    for date in date_range(start_date, end_date):
-        permit_data = jmt_report[date]
-        for trailhead_id in permit_data:
-            if trailhead_id in ["d01", "d02"]:
-                continue  # these are exit quotas, not real trailheads
-            if trailheads[trailhead_id]["wpsName"] in config.EXCLUDE_TRAILHEADS:
-                continue
-
-            quota = trailheads[trailhead_id]["quota"]
-            taken = permit_data[trailhead_id]
-            trailhead_available = quota - taken
-
-            # Lyell Canyon trailhead has a different Donohue Pass exit quota
-            dh = "d02" if trailhead_id == "j24b" else "d01"
-            dh_quota = trailheads[dh]["quota"]
-            dh_taken = permit_data[dh]
-            dh_available = dh_quota - dh_taken
-
-            available = min(trailhead_available, dh_available)
-            available = max(available, 0)
+    matrix = matrix or ReportMatrix(jmt_report, trailheads)
+    return matrix.available_permits(
+        start_date, end_date, config.MIN_SPACES, config.EXCLUDE_TRAILHEADS)
 
-            if available >= max(config.MIN_SPACES, 1):
-                if date not in available_permits:
-                    available_permits[date] = {}
-                available_permits[date][trailhead_id] = available
 
-    return available_permits
-
-
-def get_start_end_dates(jmt_report: dict, timestamp: datetime) -> Tuple[str, str]:
+def get_start_end_dates(
+        jmt_report: dict,
+        timestamp: datetime,
+        start_date: str = None,
+        end_date: str = None,
+) -> Tuple[str, str]:
     """
     Choose the date range to look for permits.
 
@@ -312,8 +2420,10 @@ def get_start_end_dates(jmt_report: dict, timestamp: datetime) -> Tuple[str, str
     - last report date + MAX_RESERVE_DAYS (currently 168)
     - JMT trailhead close date (currently September 30)
 
-    :param jmt_report: dictionary of reserved permits (output of get_jmt_report)
+    :param jmt_report: dictionary of reserved permits (output of get_jmt_report_async)
     :param timestamp: timestamp of the last report update
+    :param start_date: use instead of START_DATE
+    :param end_date: use instead of END_DATE
 
     :return: start date and end date in YYYY-MM-DD format
     """
@@ -324,47 +2434,632 @@ def get_start_end_dates(jmt_report: dict, timestamp: datetime) -> Tuple[str, str
     max_reserve_date = (report_date + timedelta(days=config.MAX_RESERVE_DAYS)).strftime("%Y-%m-%d")
     open_date = f"{report_date.year}-{config.OPEN_DATE}"
     close_date = f"{report_date.year}-{config.CLOSE_DATE}"
-    start_date = max(config.START_DATE, min_found_date, min_reserve_date, open_date)
-    end_date = min(config.END_DATE, max_found_date, max_reserve_date, close_date)
+    start_date = max(start_date or config.START_DATE, min_found_date, min_reserve_date, open_date)
+    end_date = min(end_date or config.END_DATE, max_found_date, max_reserve_date, close_date)
     return start_date, end_date
 
 
+class Rendering(NamedTuple):
+    """
+    A report rendered for each notification channel (see ReportRenderer).
+    Notification functions accept either a Rendering or plain text.
+    """
+    text: str      # plain text, written to the output file
+    sms: str       # compact text within a single SMS segment (SMS_MAX_LENGTH characters)
+    telegram: str  # Markdown for Telegram
+    html: str      # HTML for IFTTT
+
+
+class ReportRenderer:
+    """
+    Render available permits for every notification channel in one pass.
+    The trailhead display names (escaped for each format) and the output time
+    zone are looked up once per set of trailhead descriptions (see
+    get_report_renderer), rather than for every report.
+    """
+
+    def __init__(self, trailheads: dict):
+        self.time_zone = pytz.timezone(config.OUTPUT_TIME_ZONE)
+        self.names = {id_: trailhead["wpsName"] for id_, trailhead in trailheads.items()}
+        self.telegram_names = {id_: _escape_markdown(name) for id_, name in self.names.items()}
+        self.html_names = {id_: html.escape(name) for id_, name in self.names.items()}
+        self.sms_names = {id_: _get_sms_name(id_, name) for id_, name in self.names.items()}
+        self._timestamps = {}  # timestamp -> (long, short) strings in time_zone
+
+    def render(self, timestamp: datetime, permits: dict) -> Rendering:
+        """
+        Render available permits (in the nested format of
+        find_available_permits, in the order they should be listed).
+        """
+        updated, updated_short = self._format_timestamp(timestamp)
+        update_str = f"Report last updated {updated}.\n"
+        if not permits:
+            return Rendering(
+                text=f"NO AVAILABLE PERMITS\n\n{update_str}",
+                sms=f"No available permits (report updated {updated_short}).",
+                telegram=f"*NO AVAILABLE PERMITS*\n\n{update_str}",
+                html=f"<b>NO AVAILABLE PERMITS</b><br /><br />Report last updated {updated}.",
+            )
+
+        text_dates, telegram_dates, html_dates, sms_items = [], [], [], []
+        for date, trailhead_permits in permits.items():
+            text_lines = [f"{date}:"]
+            telegram_lines = [f"*{date}*"]
+            html_lines = [f"<b>{date}</b>"]
+            sms_date = f"{int(date[5:7])}/{int(date[8:10])}"
+            for trailhead_id, n in trailhead_permits.items():
+                count = f"{n} permit{'s' if n != 1 else ''} for "
+                text_lines.append(count + self.names[trailhead_id])
+                telegram_lines.append(count + self.telegram_names[trailhead_id])
+                html_lines.append(count + self.html_names[trailhead_id])
+                sms_items.append((sms_date, f"{self.sms_names[trailhead_id]} {n}"))
+            text_dates.append("\n".join(text_lines))
+            telegram_dates.append("\n".join(telegram_lines))
+            html_dates.append("<br />".join(html_lines))
+
+        form, phone = config.PERMIT_REQUEST_FORM_URL, config.PERMIT_OFFICE_PHONE
+        return Rendering(
+            text=(
+                "\n\n".join(text_dates) + f"\n\n{update_str}"
+                f"\nPermit request form: {form}\nPermit office phone: {phone}"
+            ),
+            sms=self._render_sms(sms_items),
+            telegram=(
+                "\n\n".join(telegram_dates) + f"\n\n{update_str}"
+                f"\n[Permit request form]({form})\nPermit office phone: {phone}"
+            ),
+            html=(
+                "<br /><br />".join(html_dates) + f"<br /><br />Report last updated {updated}.<br />"
+                f'<br /><a href="{form}">Permit request form</a><br />Permit office phone: {phone}'
+            ),
+        )
+
+    def _format_timestamp(self, timestamp: datetime) -> Tuple[str, str]:
+        if timestamp not in self._timestamps:
+            local = timestamp.astimezone(self.time_zone)
+            self._timestamps = {timestamp: (
+                local.strftime("%Y-%m-%d %-I:%M:%S %p %Z"),
+                local.strftime("%-m/%-d %-I:%M %p"),
+            )}
+        return self._timestamps[timestamp]
+
+    @staticmethod
+    def _render_sms(items: List[Tuple[str, str]]) -> str:
+        """
+        List as many (date, trailhead and spaces) items as fit in one SMS
+        segment, and count the rest.
+        """
+        suffix = f". Call {config.PERMIT_OFFICE_PHONE}"
+        body = "Permits:"
+        previous_date = None
+        for i, (date, item) in enumerate(items):
+            piece = f", {item}" if date == previous_date else f"{';' if previous_date else ''} {date} {item}"
+            remaining = len(items) - i - 1
+            more = f" +{remaining} more" if remaining else ""
+            if len(body) + len(piece) + len(more) + len(suffix) > config.SMS_MAX_LENGTH:
+                body += f" +{len(items) - i} more"
+                break
+            body += piece
+            previous_date = date
+        return body + suffix
+
+
+def _escape_markdown(text: str) -> str:
+    """Escape the characters with a meaning in Telegram's Markdown."""
+    for character in "\\_*`[":
+        text = text.replace(character, f"\\{character}")
+    return text
+
+
+def _get_sms_name(trailhead_id: str, name: str) -> str:
+    """
+    Return the short name of a trailhead for SMS (SMS_TRAILHEAD_NAMES, or else
+    its name), restricted to ASCII so the message is sent as 7-bit text.
+    """
+    name = config.SMS_TRAILHEAD_NAMES.get(trailhead_id, name)
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return name if len(name) <= 24 else f"{name[:23]}."
+
+
+def get_report_renderer(trailheads: dict) -> ReportRenderer:
+    """
+    Return a ReportRenderer for the trailhead descriptions, reusing the last
+    one while the descriptions are the same object (they are cached by
+    get_trailhead_descriptions).
+    """
+    if _report_renderer.get("trailheads") is not trailheads:
+        _report_renderer.update(trailheads=trailheads, renderer=ReportRenderer(trailheads))
+    return _report_renderer["renderer"]
+
+
+@timed("render")
+def render_report(timestamp: datetime, available_permit_dict: dict, trailheads: dict) -> Rendering:
+    """
+    Render the dictionary of available permits for every notification
+    channel (see ReportRenderer).
+    """
+    return get_report_renderer(trailheads).render(timestamp, available_permit_dict)
+
+
 def create_text_report(timestamp: datetime, available_permit_dict: dict, trailheads: dict) -> str:
     """
     Convert the dictionary of available permits to a text report with human
     readable trailhead names. This is the text that will be written to the
-    output file and sent in notifications.
+    output file (notifications use render_report).
     """
-    out_tz = pytz.timezone(config.OUTPUT_TIME_ZONE)
-    timestamp_str = timestamp.astimezone(out_tz).strftime("%Y-%m-%d %-I:%M:%S %p %Z")
-    update_str = f"Report last updated {timestamp_str}.\n"
-    if len(available_permit_dict) == 0:
-        text = f"NO AVAILABLE PERMITS\n\n{update_str}"
-    else:
-        text_list = []
-        for date in available_permit_dict:
-            date_text = f"{date}:"
-            for trailhead_id in available_permit_dict[date]:
-                n = available_permit_dict[date][trailhead_id]
-                trailhead_name = trailheads[trailhead_id]["wpsName"]
-                date_text += f"\n{n} permit{'s' if n != 1 else ''} for {trailhead_name}"
-            text_list.append(date_text)
-
-        text = "\n\n".join(text_list)
-        text += f"\n\n{update_str}"
-        text += f"\nPermit request form: {config.PERMIT_REQUEST_FORM_URL}"
-        text += f"\nPermit office phone: {config.PERMIT_OFFICE_PHONE}"
+    return render_report(timestamp, available_permit_dict, trailheads).text
 
-    return text
+
+class AvailabilityDiff(NamedTuple):
+    """
+    Changes in available permits between two reports, keyed by
+    (date, trailhead_id). See diff_availability.
+    """
+    opened: dict     # spaces available now that were not available before
+    increased: dict  # (spaces before, spaces now) where availability grew
+    decreased: dict  # (spaces before, spaces now) where availability shrank
+    closed: dict     # spaces available before that are no longer available
+
+    @property
+    def has_new_availability(self) -> bool:
+        return bool(self.opened or self.increased)
+
+    def new_permits(self) -> dict:
+        """
+        Return the opened and increased permits (with the spaces available
+        now) in the nested format of find_available_permits.
+        """
+        new = dict(self.opened)
+        new.update((key, after) for key, (before, after) in self.increased.items())
+        return unflatten_permits(new)
+
+
+def diff_availability(previous: Optional[dict], current: dict) -> AvailabilityDiff:
+    """
+    Compare available permits (flattened by flatten_permits) from the previous
+    and current reports. If previous is None, every available permit counts as
+    opened.
+    """
+    previous = previous or {}
+    opened, increased, decreased, closed = {}, {}, {}, {}
+    for key, n in current.items():
+        before = previous.get(key)
+        if before is None:
+            opened[key] = n
+        elif n > before:
+            increased[key] = before, n
+        elif n < before:
+            decreased[key] = before, n
+    for key, before in previous.items():
+        if key not in current:
+            closed[key] = before
+    return AvailabilityDiff(opened, increased, decreased, closed)
+
+
+def flatten_permits(permits: dict) -> dict:
+    """
+    Convert available permits from find_available_permits to a flat dictionary
+    keyed by (date, trailhead_id).
+    """
+    return {
+        (date, trailhead_id): n
+        for date, trailhead_permits in permits.items()
+        for trailhead_id, n in trailhead_permits.items()
+    }
+
+
+def unflatten_permits(flat_permits: dict) -> dict:
+    """Inverse of flatten_permits, with dates in chronological order."""
+    permits = {}
+    for (date, trailhead_id), n in sorted(flat_permits.items()):
+        permits.setdefault(date, {})[trailhead_id] = n
+    return permits
+
+
+def prioritize_permits(flat_permits: dict) -> dict:
+    """
+    Like unflatten_permits, but with the trailheads of each date ordered by
+    the number of spaces (largest first), so the most urgent permits (nearest
+    dates, largest openings) come first in a text report.
+    """
+    permits = {}
+    for (date, trailhead_id), n in sorted(flat_permits.items(), key=lambda item: (item[0][0], -item[1], item[0][1])):
+        permits.setdefault(date, {})[trailhead_id] = n
+    return permits
+
+
+def get_previous_permits(
+        timestamp: datetime,
+        trailheads: dict,
+        key: str = "permits",
+        find: Callable = find_available_permits,
+) -> Optional[dict]:
+    """
+    Return the flattened available permits of the last report processed before
+    the report at timestamp. Uses the permits saved under key from earlier in
+    this process, or else applies find to the latest earlier report in the
+    snapshot store. Returns None if there is no previous report.
+    """
+    if key in _last_permits:
+        return _last_permits[key]
+    store = get_snapshot_store()
+    previous = store.latest(before=timestamp) if store is not None else None
+    if previous is None:
+        return None
+    return flatten_permits(find(*previous, trailheads))
+
+
+class ReplayAlert(NamedTuple):
+    """A notification that a poller would have sent (see Backtest)."""
+    timestamp: datetime    # when the report that was seen had been updated
+    detected_at: datetime  # time of the poll that saw it
+    permits: dict          # newly opened or increased permits (format of find_available_permits)
+
+    @property
+    def latency(self) -> float:
+        return (self.detected_at - self.timestamp).total_seconds()
+
+
+class Backtest:
+    """
+    Simulate a poller that checks the report on a schedule, given every
+    recorded version of the report in order (see replay_reports).
+
+    A report version is seen by the first poll at or after its update time,
+    unless a newer version replaced it before that poll. An opening (a permit
+    that opened or gained spaces between consecutive versions) is detected if
+    it is still new at the next poll, and missed if it was taken again before
+    the poller looked. Detection latency is measured from the update that
+    first showed the opening.
+
+    :param poll_interval: seconds between polls, or a function of the poll time
+    that returns the seconds until the next poll (such as get_poll_interval)
+    :param phase: seconds between the first report update and the first poll
+    """
+
+    def __init__(self, poll_interval: Union[float, Callable[[datetime], float]], phase: float = 0):
+        self.poll_interval = poll_interval
+        self.phase = phase
+        self.alerts = []     # ReplayAlert for each notification
+        self.latencies = []  # seconds until each detected opening was seen
+        self.n_reports = 0
+        self.n_seen = 0      # report versions seen by a poll
+        self.n_polls = 0
+        self.n_missed = 0    # openings that were taken before a poll saw them
+        self._next_poll = None
+        self._seen = None     # flattened permits at the last poll that saw a new version
+        self._latest = None   # flattened permits of the latest version
+        self._pending = None  # (timestamp, flattened permits) of a version no poll has seen yet
+        self._openings = {}   # (date, trailhead_id) -> first update showing it, since the last poll
+
+    def feed(self, timestamp: datetime, flat_permits: dict):
+        """Process the next report version (with permits flattened by flatten_permits)."""
+        self.n_reports += 1
+        if self._latest is None:
+            # the first version is what the poller already knew
+            self._seen = self._latest = flat_permits
+            self._next_poll = timestamp + timedelta(seconds=self.phase)
+            return
+        if self._pending is not None and self._next_poll < timestamp:
+            self._poll()
+        self._advance(timestamp)
+
+        diff = diff_availability(self._latest, flat_permits)
+        for key in (*diff.opened, *diff.increased):
+            self._openings.setdefault(key, timestamp)
+        self._latest = flat_permits
+        self._pending = timestamp, flat_permits
+
+    def finish(self):
+        """Let the next poll see the last version."""
+        if self._pending is not None:
+            self._poll()
+
+    def _advance(self, timestamp: datetime):
+        """Move the next poll to the first poll at or after timestamp."""
+        if callable(self.poll_interval):
+            while self._next_poll < timestamp:
+                self._next_poll += timedelta(seconds=self.poll_interval(self._next_poll))
+                self.n_polls += 1
+        elif self._next_poll < timestamp:
+            n = math.ceil((timestamp - self._next_poll).total_seconds() / self.poll_interval)
+            self._next_poll += timedelta(seconds=n * self.poll_interval)
+            self.n_polls += n
+
+    def _poll(self):
+        timestamp, flat_permits = self._pending
+        diff = diff_availability(self._seen, flat_permits)
+        new = {*diff.opened, *diff.increased}
+        for key, first_shown in self._openings.items():
+            if key in new:
+                self.latencies.append((self._next_poll - first_shown).total_seconds())
+            else:
+                self.n_missed += 1
+        if diff.has_new_availability:
+            self.alerts.append(ReplayAlert(timestamp, self._next_poll, diff.new_permits()))
+        self.n_seen += 1
+        self._seen = flat_permits
+        self._pending = None
+        self._openings = {}
+
+    def summary(self) -> dict:
+        import statistics
+
+        latencies = sorted(self.latencies)
+        return {
+            "poll_interval": getattr(self.poll_interval, "__name__", self.poll_interval),
+            "reports": self.n_reports,
+            "reports_seen": self.n_seen,
+            "polls": self.n_polls,
+            "notifications": len(self.alerts),
+            "openings_detected": len(latencies),
+            "openings_missed": self.n_missed,
+            "median_latency": statistics.median(latencies) if latencies else None,
+            "max_latency": latencies[-1] if latencies else None,
+        }
+
+
+def replay_reports(
+        reports: Iterable[Tuple[dict, datetime]],
+        backtests: Iterable[Backtest],
+        trailheads: dict = None,
+        min_spaces: int = None,
+) -> List[Backtest]:
+    """
+    Run recorded reports (such as from read_report_history) through the
+    permit search of find_available_permits and feed the available permits to
+    each backtest, so that poll schedules can be compared offline. Reports are
+    processed one at a time, so a season of history is never held in memory.
+
+    Replays never send requests to yosemite.org (which would spend captcha
+    credits), so trailheads default to the trailhead cache, however old it is.
+    Raises ValueError if the trailheads are not cached, or if a report has
+    trailheads that are missing from them.
+
+    :param trailheads: trailhead information (default from TRAILHEAD_CACHE_FILE)
+    :param min_spaces: use instead of MIN_SPACES
+    """
+    backtests = list(backtests)
+    min_spaces = config.MIN_SPACES if min_spaces is None else min_spaces
+    if trailheads is None:
+        trailheads = _read_trailhead_cache(max_age=math.inf)
+        if trailheads is None:
+            raise ValueError(
+                "replay needs the trailhead descriptions in TRAILHEAD_CACHE_FILE -- "
+                "run hackjohn once to cache them")
+    for jmt_report, timestamp in reports:
+        missing = get_report_trailhead_ids(jmt_report) - set(trailheads)
+        if missing:
+            raise ValueError(
+                f"report from {timestamp} has trailheads missing from the trailhead "
+                f"descriptions: {', '.join(sorted(missing))} -- run hackjohn once to refresh them")
+        start_date, end_date = get_start_end_dates(jmt_report, timestamp)
+        permits = ReportMatrix(jmt_report, trailheads).available_permits(
+            start_date, end_date, min_spaces, config.EXCLUDE_TRAILHEADS)
+        flat_permits = flatten_permits(permits)
+        for backtest in backtests:
+            backtest.feed(timestamp, flat_permits)
+    for backtest in backtests:
+        backtest.finish()
+    return backtests
+
+
+def run_replay(path: Union[str, pathlib.Path], poll_intervals: Iterable[str], min_spaces: int = None):
+    """
+    Replay the report history at path (see read_report_history) for each poll
+    interval (seconds, or "daemon" for the schedule of get_poll_interval) and
+    print how many openings each would have caught, and how quickly.
+    """
+    poll_intervals = list(poll_intervals)
+    backtests = [
+        Backtest(get_poll_interval if interval == "daemon" else float(interval))
+        for interval in poll_intervals
+    ]
+    print(f"replaying reports from {path}...")
+    replay_reports(read_report_history(path), backtests, min_spaces=min_spaces)
+    for interval, backtest in zip(poll_intervals, backtests):
+        summary = backtest.summary()
+        latency = (
+            f"median latency {summary['median_latency']:.0f} s, max {summary['max_latency']:.0f} s"
+            if summary["openings_detected"] else "no latency"
+        )
+        print(
+            f"poll interval {interval}: {summary['polls']} polls saw "
+            f"{summary['reports_seen']} of {summary['reports']} reports, sent "
+            f"{summary['notifications']} notifications, detected {summary['openings_detected']} "
+            f"and missed {summary['openings_missed']} openings ({latency})"
+        )
 
 
-def decide_whether_to_notify(text: str, permits: dict, timestamp: datetime) -> bool:
+class Subscription(NamedTuple):
+    """
+    A subscriber's permit search, loaded from SUBSCRIPTIONS_FILE. See
+    load_subscriptions.
+    """
+    name: str
+    start_date: str
+    end_date: str
+    min_spaces: int
+    trailheads: Optional[frozenset]  # wpsNames to include (None for all)
+    exclude_trailheads: frozenset    # wpsNames to exclude
+    channels: dict  # keyword arguments for send_notifications_async (with subscriber set)
+
+    def wants(self, trailhead_name: str, n: int) -> bool:
+        return (
+            n >= max(self.min_spaces, 1)
+            and (self.trailheads is None or trailhead_name in self.trailheads)
+            and trailhead_name not in self.exclude_trailheads
+        )
+
+
+# keys of a subscription in SUBSCRIPTIONS_FILE, other than its channels
+_SUBSCRIPTION_KEYS = {"name", "start_date", "end_date", "min_spaces", "trailheads", "exclude_trailheads"}
+
+# keyword arguments of send_notifications_async for each notification channel
+_CHANNEL_KEYS = ("telegram_token", "ifttt_key", "twilio_to_phone")
+
+
+def load_subscriptions(path: Union[str, pathlib.Path]) -> List[Subscription]:
+    """
+    Read subscriptions from a JSON file containing a list of objects like:
+    {
+        "name": "alice",
+        "start_date": "2021-07-01",
+        "end_date": "2021-08-15",
+        "min_spaces": 2,
+        "trailheads": ["Lyell Canyon"],
+        "exclude_trailheads": [],
+        "telegram_token": "...",
+        "ifttt_key": "...",
+        "twilio_to_phone": ["+15555555555"]
+    }
+    Only name, start_date and end_date are required. min_spaces defaults to 1,
+    trailheads to all trailheads, and each notification channel is enabled
+    only if its key is present. Subscribers are never notified on the channels
+    of config.py, so subscriptions without any channel are skipped (with a
+    warning), and unknown keys (e.g. misspelled channels) are reported.
+    """
+    subscriptions = []
+    for entry in json.loads(pathlib.Path(path).read_text()):
+        unknown_keys = set(entry) - _SUBSCRIPTION_KEYS - set(_CHANNEL_KEYS)
+        if unknown_keys:
+            print(f"ignoring unknown keys in subscription {entry.get('name')!r}: {', '.join(sorted(unknown_keys))}")
+        channels = {key: entry[key] for key in _CHANNEL_KEYS if entry.get(key)}
+        if not channels:
+            print(f"skipping subscription {entry.get('name')!r}: no notification channels "
+                  f"(set any of {', '.join(_CHANNEL_KEYS)})")
+            continue
+        channels["subscriber"] = entry["name"]
+        subscriptions.append(Subscription(
+            name=entry["name"],
+            start_date=entry["start_date"],
+            end_date=entry["end_date"],
+            min_spaces=entry.get("min_spaces", 1),
+            trailheads=frozenset(entry["trailheads"]) if "trailheads" in entry else None,
+            exclude_trailheads=frozenset(entry.get("exclude_trailheads", [])),
+            channels=channels,
+        ))
+    return subscriptions
+
+
+class SubscriptionIndex:
+    """
+    Index of subscriptions by the dates in their search windows, so that
+    matching available permits to subscribers costs one dictionary lookup per
+    available permit and then only touches subscriptions whose window contains
+    that date. Windows are a season long at most, so indexing every date is
+    cheap.
+    """
+
+    def __init__(self, subscriptions: List[Subscription]):
+        self.subscriptions = subscriptions
+        self._by_date = {}
+        for subscription in subscriptions:
+            start = date_type.fromisoformat(subscription.start_date).toordinal()
+            end = date_type.fromisoformat(subscription.end_date).toordinal()
+            for ordinal in range(start, end + 1):
+                self._by_date.setdefault(date_type.fromordinal(ordinal).isoformat(), []).append(subscription)
+        self.start_date = min((s.start_date for s in subscriptions), default=None)
+        self.end_date = max((s.end_date for s in subscriptions), default=None)
+
+    def covering(self, date: str) -> List[Subscription]:
+        """Return subscriptions whose window contains date (YYYY-MM-DD)."""
+        return self._by_date.get(date, [])
+
+    def match(self, flat_permits: dict, trailheads: dict) -> List[Tuple[Subscription, dict]]:
+        """
+        Match flattened available permits (see flatten_permits) to
+        subscriptions. Returns a list of each matched subscription with its
+        permits, in the format of find_available_permits.
+        """
+        matches = {}
+        for (date, trailhead_id), n in sorted(flat_permits.items()):
+            name = trailheads[trailhead_id]["wpsName"]
+            for subscription in self.covering(date):
+                if subscription.wants(name, n):
+                    _, permits = matches.setdefault(id(subscription), (subscription, {}))
+                    permits.setdefault(date, {})[trailhead_id] = n
+        return list(matches.values())
+
+
+def get_subscription_index() -> Optional[SubscriptionIndex]:
+    """
+    Return the SubscriptionIndex for SUBSCRIPTIONS_FILE, or None if it is not
+    set. The file is reread when it changes.
+    """
+    if config.SUBSCRIPTIONS_FILE is None:
+        return None
+    path = pathlib.Path(config.SUBSCRIPTIONS_FILE)
+    mtime = path.stat().st_mtime
+    if _subscription_index.get("mtime") != mtime:
+        subscriptions = load_subscriptions(path)
+        print(f"loaded {len(subscriptions)} subscriptions from {path}")
+        _subscription_index.update(mtime=mtime, index=SubscriptionIndex(subscriptions))
+    return _subscription_index["index"]
+
+
+def find_subscription_permits(
+        jmt_report: dict,
+        timestamp: datetime,
+        trailheads: dict,
+        matrix: ReportMatrix = None,
+) -> dict:
+    """
+    Find available permits for all subscriptions at once: every trailhead with
+    at least one space, for dates in the union of the subscription windows
+    (restricted to reservable dates like find_available_permits).
+    """
+    index = get_subscription_index()
+    start_date, end_date = get_start_end_dates(
+        jmt_report, timestamp, start_date=index.start_date, end_date=index.end_date)
+    matrix = matrix or ReportMatrix(jmt_report, trailheads)
+    return matrix.available_permits(start_date, end_date)
+
+
+def get_subscriber_notifications(
+        jmt_report: dict,
+        timestamp: datetime,
+        trailheads: dict,
+        matrix: ReportMatrix = None,
+) -> Tuple[List[Notification], dict]:
+    """
+    Find permits that opened up (or gained spaces) since the previous report
+    and match the search of a subscription in SUBSCRIPTIONS_FILE. Each matched
+    subscriber gets its own text report on its own channels.
+
+    Returns a list of Notification, and the flattened permits for all
+    subscriptions to save in _last_permits once the notifications are sent.
+    """
+    index = get_subscription_index()
+    flat_permits = flatten_permits(find_subscription_permits(jmt_report, timestamp, trailheads, matrix))
+    previous = get_previous_permits(
+        timestamp, trailheads, key="subscriptions", find=find_subscription_permits)
+    diff = diff_availability(previous, flat_permits)
+    matches = index.match(flatten_permits(diff.new_permits()), trailheads)
+    print(f"new permits match {len(matches)} of {len(index.subscriptions)} subscriptions")
+    notifications = [
+        Notification(
+            render_report(timestamp, permits, trailheads), subscription.channels, flatten_permits(permits))
+        for subscription, permits in matches
+    ]
+    return notifications, flat_permits
+
+
+def decide_whether_to_notify(
+        text: str,
+        permits: dict,
+        timestamp: datetime,
+        diff: AvailabilityDiff = None,
+) -> bool:
     """
     Write output file and decide whether to notify. Send notification if all of
     the following are true:
-    - there are available permits (or NOTIFY_IF_NO_PERMITS is True)
+    - there are newly opened or increased permits according to diff (or there
+      are no available permits and NOTIFY_IF_NO_PERMITS is True)
     - the contents of the output file have changed
     - the updated happened after MIN_REPORT_DATE
+
+    If diff is None, any available permits count as new.
     """
     # Detect if output_path has changed. If so, rewrite output.
     output_has_changed = True
@@ -380,86 +3075,364 @@ def decide_whether_to_notify(text: str, permits: dict, timestamp: datetime) -> b
             print("no change since last run")
 
     # determine whether to notify
+    has_new_permits = diff.has_new_availability if diff is not None else len(permits) > 0
     notify = (
-        ((len(permits) > 0) or config.NOTIFY_IF_NO_PERMITS)
+        (has_new_permits or (len(permits) == 0 and config.NOTIFY_IF_NO_PERMITS))
         and output_has_changed
         and (config.MIN_REPORT_DATE <= timestamp.strftime("Y-%m-%d"))
     )
     return notify
 
 
-def date_range(
-    start: str,
-    end: str,
-    date_format: str = "%Y-%m-%d",
-    inclusive_end: bool = True,
-) -> str:
-    """Return a generator for looping through a range of dates."""
-    start = datetime.strptime(start, date_format)
-    end = datetime.strptime(end, date_format)
-    i = 1 if inclusive_end else 0
-    for n in range(int((end - start).days) + i):
-        yield (start + timedelta(n)).strftime(date_format)
+async def send_notifications_async(
+        text: Union[str, Rendering],
+        telegram_token: str = None,
+        ifttt_key: str = None,
+        twilio_to_phone: Union[str, List[str]] = None,
+        subscriber: str = None,
+) -> dict:
+    """
+    Send the text to all enabled notification channels at once, with one
+    concurrent task per channel and per Twilio recipient (each notifier runs
+    in a worker thread). Each channel has its own timeout (NOTIFY_TIMEOUTS)
+    and retries (NOTIFY_RETRY_ATTEMPTS). The Twilio balance check runs after
+    the messages are sent and does not delay delivery. If text is a Rendering
+    (see render_report), each channel gets its own format.
+
+    By default, notifies the channels enabled in config.py. If any of
+    telegram_token, ifttt_key or twilio_to_phone is given, or subscriber (the
+    name of the subscription being notified) is set, only the given channels
+    are notified.
+
+    Returns a dictionary of the seconds it took to deliver to each channel
+    (None if delivery failed), which is also printed.
+    """
+    telegram_token, ifttt_key, twilio_to_phone = _get_channels(
+        telegram_token, ifttt_key, twilio_to_phone, subscriber)
+    tasks = {}
+    if telegram_token:
+        tasks["telegram"] = asyncio.to_thread(send_telegram_notification, text, token=telegram_token)
+    if ifttt_key:
+        tasks["ifttt"] = asyncio.to_thread(send_IFTTT_notification, text, key=ifttt_key)
+    if twilio_to_phone:
+        for phone in _force_to_list(twilio_to_phone):
+            tasks[f"twilio {phone}"] = asyncio.to_thread(
+                send_twilio_notification, text, to_phone=phone, check_balance=False)
+
+    async def deliver(channel, coroutine):
+        try:
+            await coroutine
+            delivery_times[channel] = time.perf_counter() - start
+            print(f"delivered {channel} notification in {delivery_times[channel]:.2f} seconds")
+            metrics.observe("notification_seconds", delivery_times[channel], channel=channel.split()[0])
+        except Exception as e:
+            delivery_times[channel] = None
+            print(f"error sending {channel} notification: {e!r}")
+            metrics.increment("notification_errors_total", channel=channel.split()[0])
+
+    start = time.perf_counter()
+    delivery_times = {}
+    await asyncio.gather(*(deliver(channel, coroutine) for channel, coroutine in tasks.items()))
+
+    # check the balance in the background (main_async waits for it before exiting)
+    if twilio_to_phone:
+        task = asyncio.create_task(asyncio.to_thread(report_twilio_balance))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return delivery_times
+
+
+def _get_channels(telegram_token: str, ifttt_key: str, twilio_to_phone, subscriber: str = None) -> tuple:
+    """
+    Return the channels to notify (see send_notifications_async): the ones
+    given, or else (unless notifying a subscriber) the ones enabled in
+    config.py.
+    """
+    if subscriber is None and not (telegram_token or ifttt_key or twilio_to_phone):
+        telegram_token = config.TELEGRAM_TOKEN if config.ENABLE_TELEGRAM else None
+        ifttt_key = config.IFTTT_KEY if config.ENABLE_IFTTT else None
+        twilio_to_phone = config.TWILIO_TO_PHONE if config.ENABLE_TWILIO else None
+    return telegram_token, ifttt_key, twilio_to_phone
+
+
+def _as_rendering(text: Union[str, Rendering]) -> Rendering:
+    """
+    Return text as a Rendering. Plain text is sent as is on every channel
+    (with HTML line breaks for IFTTT).
+    """
+    if isinstance(text, Rendering):
+        return text
+    return Rendering(text=text, sms=text, telegram=text, html=text.replace("\n", "<br />"))
 
 
-def send_telegram_notification(text: str):
+class NotificationQueue:
     """
-    Send a notification to the Telegram app. Uses the TELEGRAM_TOKEN and
-    TELEGRAM_FROM_NAME parameters at the top of this script.
+    Coalesce, prioritize and deduplicate the notifications of the daemon, so a
+    burst of openings over successive polls does not send a flood of slightly
+    different messages (each of which costs money with Twilio).
+
+    Each destination (a Telegram token, IFTTT key or Twilio phone number) is
+    queued separately. The first notification to a destination is sent right
+    away, so the first alert is as fast as ever. New permits for a destination
+    that was notified less than NOTIFY_COALESCE_WINDOW seconds ago are held
+    and sent together in one message once the window is over, most urgent
+    first (see prioritize_permits). Permits are not sent again to a
+    destination that was already sent at least as many spaces (until they are
+    taken, see update_available). Permits whose delivery failed are held
+    again, and retried once the window is over (or, without a window, with
+    the next notification or on close).
     """
-    payload = {
-        "recipient_token": config.TELEGRAM_TOKEN,
-        "text": text,
+
+    def __init__(self):
+        self._pending = {}    # destination -> {(date, trailhead_id): spaces} waiting to be sent
+        self._delivered = {}  # destination -> {(date, trailhead_id): spaces} already sent
+        self._last_sent = {}  # destination -> time.monotonic() of the last message
+        self._report = None   # (timestamp, trailheads) of the latest report, to render held messages
+        self._flusher = None
+        self._wakeup = None
+
+    @staticmethod
+    def destinations(channels: dict) -> List[Tuple[str, str]]:
+        """
+        Split keyword arguments for send_notifications_async (channels of a
+        Notification) into (keyword, value) pairs, one per destination.
+        """
+        telegram_token, ifttt_key, twilio_to_phone = _get_channels(
+            channels.get("telegram_token"), channels.get("ifttt_key"), channels.get("twilio_to_phone"),
+            channels.get("subscriber"))
+        destinations = []
+        if telegram_token:
+            destinations.append(("telegram_token", telegram_token))
+        if ifttt_key:
+            destinations.append(("ifttt_key", ifttt_key))
+        if twilio_to_phone:
+            destinations.extend(("twilio_to_phone", phone) for phone in _force_to_list(twilio_to_phone))
+        return destinations
+
+    async def submit(self, notification: Notification, timestamp: datetime, trailheads: dict) -> bool:
+        """
+        Queue a notification. Returns whether it was sent right away to any
+        destination (rather than held or deduplicated).
+        """
+        if not notification.permits:
+            # nothing to coalesce (e.g. NO AVAILABLE PERMITS)
+            await send_notifications_async(notification.rendering, **notification.channels)
+            return True
+        self._report = timestamp, trailheads
+        now = time.monotonic()
+        ready = []
+        for destination in self.destinations(notification.channels):
+            delivered = self._delivered.get(destination, {})
+            permits = {key: n for key, n in notification.permits.items() if n > delivered.get(key, 0)}
+            if len(permits) < len(notification.permits):
+                metrics.increment("notifications_deduplicated_total", len(notification.permits) - len(permits))
+            if permits:
+                pending = self._pending.setdefault(destination, {})
+                for key, n in permits.items():
+                    pending[key] = max(n, pending.get(key, 0))
+            if destination not in self._pending:
+                continue
+            # held permits (e.g. from a failed delivery) go with new ones
+            if now - self._last_sent.get(destination, -math.inf) >= config.NOTIFY_COALESCE_WINDOW:
+                ready.append(destination)
+            elif permits:
+                metrics.increment("notifications_coalesced_total", len(permits))
+        await self._send(ready)
+        if self._pending and config.NOTIFY_COALESCE_WINDOW > 0:
+            self._schedule_flush()
+        return bool(ready)
+
+    def update_available(self, flat_permits: dict):
+        """
+        Update the queue with the permits available in the latest report
+        (flattened by flatten_permits). Held permits that were taken are
+        dropped, and permits are forgotten as delivered once spaces are
+        taken, so later openings are sent again.
+        """
+        for destination_permits in self._pending, self._delivered:
+            for destination, permits in list(destination_permits.items()):
+                for key, n in list(permits.items()):
+                    if key in flat_permits:
+                        permits[key] = min(n, flat_permits[key])
+                    else:
+                        del permits[key]
+                if not permits:
+                    del destination_permits[destination]
+
+    async def close(self):
+        """Send all held messages now, e.g. before the daemon exits."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self._send(list(self._pending))
+
+    async def _send(self, destinations: List[Tuple[str, str]]):
+        destinations = [destination for destination in destinations if self._pending.get(destination)]
+        await asyncio.gather(*(self._send_one(destination) for destination in destinations))
+
+    async def _send_one(self, destination: Tuple[str, str]):
+        delivered = self._delivered.setdefault(destination, {})
+        # a concurrent submission may already have taken the held permits
+        permits = {
+            key: n for key, n in self._pending.pop(destination, {}).items()
+            if n > delivered.get(key, 0)
+        }
+        if not permits:
+            return
+        # count the permits as delivered while sending, so that concurrent
+        # submissions to this destination are deduplicated against them
+        previous = {key: delivered.get(key) for key in permits}
+        delivered.update(permits)
+        self._last_sent[destination] = time.monotonic()
+        timestamp, trailheads = self._report
+        rendering = render_report(timestamp, prioritize_permits(permits), trailheads)
+        keyword, value = destination
+        delivery_times = await send_notifications_async(rendering, **{keyword: value})
+        if None not in delivery_times.values():
+            return
+        # delivery failed: hold the permits again to retry them (see submit)
+        for key, n in previous.items():
+            if n is None:
+                delivered.pop(key, None)
+            else:
+                delivered[key] = n
+        pending = self._pending.setdefault(destination, {})
+        for key, n in permits.items():
+            pending[key] = max(n, pending.get(key, 0))
+        if config.NOTIFY_COALESCE_WINDOW > 0:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_when_due())
+        else:
+            self._wakeup.set()
+
+    async def _flush_when_due(self):
+        """Send held messages as their windows end, until none are left."""
+        while self._pending:
+            now = time.monotonic()
+            due = {
+                destination: self._last_sent.get(destination, -math.inf) + config.NOTIFY_COALESCE_WINDOW
+                for destination in self._pending
+            }
+            ready = [destination for destination, time_due in due.items() if time_due <= now]
+            if ready:
+                await self._send(ready)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), min(due.values()) - now)
+            except asyncio.TimeoutError:
+                pass
+
+
+notification_queue = NotificationQueue()
+
+
+@retry(
+    stop=stop_after_attempt(config.NOTIFY_RETRY_ATTEMPTS),
+    retry=retry_if_exception_type(),
+    before_sleep=count_retry,
+    reraise=True,
+)
+def send_telegram_notification(text: Union[str, Rendering], token: str = None):
+    """
+    Send a notification to the Telegram app. Uses the TELEGRAM_TOKEN (unless
+    token is given) and TELEGRAM_FROM_NAME parameters at the top of this script.
+    """
+    r = sessions.notify_post(config.TELEGRAM_URL, json=_get_telegram_payload(text, token),
+                             timeout=config.NOTIFY_TIMEOUTS["telegram"])
+    r.raise_for_status()
+
+
+def _get_telegram_payload(text: Union[str, Rendering], token: str = None) -> dict:
+    return {
+        "recipient_token": token or config.TELEGRAM_TOKEN,
+        "text": _as_rendering(text).telegram,
         "origin": config.TELEGRAM_FROM_NAME,
         "options": {
             "disable_link_previews": True
         },
     }
-    r = requests.post(config.TELEGRAM_URL, json=payload)
-    r.raise_for_status()
 
 
-def send_IFTTT_notification(text: str):
+@retry(
+    stop=stop_after_attempt(config.NOTIFY_RETRY_ATTEMPTS),
+    retry=retry_if_exception_type(),
+    before_sleep=count_retry,
+    reraise=True,
+)
+def send_IFTTT_notification(text: Union[str, Rendering], key: str = None):
     """
     Send a notification using your IFTTT applet. Uses the IFTTT_EVENT_NAME and
-    IFTTT_KEY parameters at the top of this script.
+    IFTTT_KEY (unless key is given) parameters at the top of this script.
     """
+    url, report = _get_IFTTT_request(text, key)
+    r = sessions.notify_post(url, data=report, timeout=config.NOTIFY_TIMEOUTS["ifttt"])
+    r.raise_for_status()
+
+
+def _get_IFTTT_request(text: Union[str, Rendering], key: str = None) -> Tuple[str, dict]:
     report = {
-        "value1": text.replace("\n", "<br />"),
+        "value1": _as_rendering(text).html,
         "value2": config.PERMIT_OFFICE_PHONE,
     }
-    url = f"{config.IFTTT_HOSTNAME}/trigger/{config.IFTTT_EVENT_NAME}/with/key/{config.IFTTT_KEY}"
-    r = requests.post(url, data=report)
-    r.raise_for_status()
+    url = f"{config.IFTTT_HOSTNAME}/trigger/{config.IFTTT_EVENT_NAME}/with/key/{key or config.IFTTT_KEY}"
+    return url, report
 
 
 def send_twilio_notification(
-        text: str,
+        text: Union[str, Rendering],
         from_phone: str = config.TWILIO_PHONE_NUMBER,
         to_phone: Union[str, List[str]] = None,
+        check_balance: bool = True,
 ):
     """
     Send SMS text message using Twilio. Uses the TWILIO_ACCOUNT_SID,
     TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER, and TWILIO_TO_PHONE parameters at
     the top of this script.
 
-    :param text: contents of text message
+    :param text: contents of text message (the sms format of a Rendering)
     :param from_phone: phone number to send message (Twilio phone number)
     :param to_phone: phone number(s) to receive message
+    :param check_balance: whether to report the Twilio balance afterwards
     """
     # send SMS message(s)
     to_phone = to_phone or config.TWILIO_TO_PHONE
     to_phone = _force_to_list(to_phone)
     from_phone = _parse_phone_number(from_phone)
-    client = Client(config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN)
     for x in to_phone:
-        client.messages.create(
-            body=text,
-            from_=from_phone,
-            to=_parse_phone_number(x),
-        )
+        _send_twilio_message(text, from_phone, _parse_phone_number(x))
 
-    # report twilio balance
+    if check_balance:
+        report_twilio_balance()
+
+
+@retry(
+    stop=stop_after_attempt(config.NOTIFY_RETRY_ATTEMPTS),
+    retry=retry_if_exception_type(),
+    before_sleep=count_retry,
+    reraise=True,
+)
+def _send_twilio_message(text: Union[str, Rendering], from_phone: str, to_phone: str):
+    """Send a single SMS, retrying up to NOTIFY_RETRY_ATTEMPTS times."""
+    text = _as_rendering(text).sms
+    client = sessions.twilio_client()
+    client.messages.create(body=text, from_=from_phone, to=to_phone)
+    # each segment of a longer message loses 7 characters to the header that
+    # joins the segments
+    if len(text) <= config.SMS_MAX_LENGTH:
+        segments = 1
+    else:
+        segments = math.ceil(len(text) / (config.SMS_MAX_LENGTH - 7))
+    metrics.increment("spend_usd_total", segments * config.TWILIO_COST_PER_SEGMENT, service="twilio")
+
+
+def report_twilio_balance():
+    """Print the Twilio balance and warn if it is running low."""
+    client = sessions.twilio_client()
     balance_data = client.api.v2010.balance.fetch()
     balance = float(balance_data.balance)
     currency = balance_data.currency
@@ -482,5 +3455,65 @@ def _force_to_list(x) -> list:
     return x
 
 
+def parse_args(args: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and poll the report on a schedule that tightens "
+             "around the expected report update time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="with --daemon, poll with this many coordinated worker processes "
+             "that take turns, with one of them sending notifications "
+             "(default: 1)",
+    )
+    parser.add_argument(
+        "--worker",
+        type=int,
+        metavar="N",
+        help="run only worker N (from 0) of --workers coordinated workers, "
+             "e.g. to run each worker as its own service on this host",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="poll the report like --daemon and serve the available permits "
+             "over a local HTTP API",
+    )
+    parser.add_argument(
+        "--host",
+        help="with --serve, listen on this address (default: SERVE_HOST)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="with --serve, listen on this port (default: SERVE_PORT)",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="instead of polling, replay recorded reports from a snapshot "
+             "database or a JSON lines file of API responses and show which "
+             "openings each poll interval would have caught",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        nargs="+",
+        default=["60"],
+        help="seconds between polls to simulate with --replay, or daemon for "
+             "the schedule of --daemon (default: 60)",
+    )
+    parser.add_argument(
+        "--min-spaces",
+        type=int,
+        help="use instead of MIN_SPACES with --replay",
+    )
+    return parser.parse_args(args)
+
+
 if __name__ == "__main__":
-    main()
+    main(**vars(parse_args()))
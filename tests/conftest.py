@@ -0,0 +1,62 @@
+"""
+Shared fixtures for the hackjohn tests. Run the tests from the repository
+root with:
+
+    python -m pytest tests
+
+Tests never touch yosemite.org or the notification services: network paths
+run against the mock server of benchmark.py.
+"""
+
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import benchmark  # noqa: E402
+import config  # noqa: E402
+import hackjohn  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_config(tmp_path, monkeypatch):
+    """
+    Keep every file that hackjohn writes in a temporary directory, and
+    forget what hackjohn remembers between polls before and after each test.
+    """
+    monkeypatch.setattr(config, "OUTPUT_PATH", tmp_path / "output.txt")
+    monkeypatch.setattr(config, "SESSION_STATE_FILE", tmp_path / "session.json")
+    monkeypatch.setattr(config, "REPORT_STATE_FILE", tmp_path / "report-state.json")
+    monkeypatch.setattr(config, "TRAILHEAD_CACHE_FILE", tmp_path / "trailheads.json")
+    monkeypatch.setattr(config, "SNAPSHOT_DATABASE", None)
+    monkeypatch.setattr(config, "SUBSCRIPTIONS_FILE", None)
+    monkeypatch.setattr(config, "API_BUDGET_FILE", tmp_path / "request-budget.json")
+    benchmark.reset_hackjohn_state()
+    yield
+    benchmark.reset_hackjohn_state()
+
+
+@pytest.fixture
+def mock_state() -> benchmark.MockState:
+    return benchmark.MockState()
+
+
+@pytest.fixture
+def mock_server(mock_state):
+    """
+    Point hackjohn at the mock server of benchmark.py. Captcha solves are
+    counted in mock_server.solves.
+    """
+    with benchmark.mock_environment(mock_state) as server:
+        hackjohn.sessions = hackjohn.SessionManager()
+        server.solves = 0
+        solve = hackjohn.get_recaptcha_response
+
+        def counting_solve(api_key):
+            server.solves += 1
+            return solve(api_key)
+
+        hackjohn.get_recaptcha_response = counting_solve
+        yield server
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+import config
+import hackjohn
+
+TIMESTAMP = pytz.timezone("US/Pacific").localize(datetime(2021, 7, 1, 11, 0))
+
+
+def test_diff_availability_classifies_changes():
+    previous = {("2021-07-05", "j19"): 2, ("2021-07-05", "j24b"): 3, ("2021-07-06", "j19"): 1, ("2021-07-07", "d01"): 4}
+    current = {("2021-07-05", "j19"): 2, ("2021-07-05", "j24b"): 5, ("2021-07-06", "j19"): 0, ("2021-07-08", "j01a"): 1}
+    diff = hackjohn.diff_availability(previous, current)
+    assert diff.opened == {("2021-07-08", "j01a"): 1}
+    assert diff.increased == {("2021-07-05", "j24b"): (3, 5)}
+    assert diff.decreased == {("2021-07-06", "j19"): (1, 0)}
+    assert diff.closed == {("2021-07-07", "d01"): 4}
+    assert diff.has_new_availability
+    assert diff.new_permits() == {"2021-07-05": {"j24b": 5}, "2021-07-08": {"j01a": 1}}
+
+
+def test_diff_availability_without_previous_report():
+    current = {("2021-07-05", "j19"): 2}
+    diff = hackjohn.diff_availability(None, current)
+    assert diff.opened == current
+    assert not (diff.increased or diff.decreased or diff.closed)
+
+
+def test_diff_availability_only_closed_is_not_new():
+    diff = hackjohn.diff_availability({("2021-07-05", "j19"): 2}, {})
+    assert not diff.has_new_availability
+    assert diff.new_permits() == {}
+
+
+def test_flatten_permits_round_trip():
+    permits = {"2021-07-05": {"j19": 2, "j24b": 3}, "2021-07-06": {"j01a": 1}}
+    assert hackjohn.unflatten_permits(hackjohn.flatten_permits(permits)) == permits
+
+
+@pytest.mark.parametrize("previous, current, notify", [
+    ({}, {("2021-07-05", "j19"): 2}, True),
+    ({("2021-07-05", "j19"): 2}, {("2021-07-05", "j19"): 3}, True),
+    ({("2021-07-05", "j19"): 2}, {("2021-07-05", "j19"): 1}, False),
+    ({("2021-07-05", "j19"): 2, ("2021-07-06", "j19"): 1}, {("2021-07-05", "j19"): 2}, False),
+])
+def test_decide_whether_to_notify_on_new_availability(previous, current, notify):
+    diff = hackjohn.diff_availability(previous, current)
+    permits = hackjohn.unflatten_permits(current)
+    assert hackjohn.decide_whether_to_notify(f"report of {current}", permits, TIMESTAMP, diff) is notify
+
+
+def test_decide_whether_to_notify_writes_output_once():
+    permits = {"2021-07-05": {"j19": 2}}
+    assert hackjohn.decide_whether_to_notify("report", permits, TIMESTAMP)
+    assert config.OUTPUT_PATH.read_text() == "report"
+    # the same text again is not a change
+    assert not hackjohn.decide_whether_to_notify("report", permits, TIMESTAMP)
+
+
+def test_decide_whether_to_notify_without_permits(monkeypatch):
+    monkeypatch.setattr(config, "NOTIFY_IF_NO_PERMITS", False)
+    assert not hackjohn.decide_whether_to_notify("no permits", {}, TIMESTAMP)
+    monkeypatch.setattr(config, "NOTIFY_IF_NO_PERMITS", True)
+    assert hackjohn.decide_whether_to_notify("still no permits", {}, TIMESTAMP)
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import hackjohn
+
+T0 = datetime(2021, 7, 1, 11, 0)
+A = ("2021-07-05", "j19")
+B = ("2021-07-05", "j24b")
+
+
+def run(backtest: hackjohn.Backtest, versions: list) -> dict:
+    for seconds, flat_permits in versions:
+        backtest.feed(T0 + timedelta(seconds=seconds), flat_permits)
+    backtest.finish()
+    return backtest.summary()
+
+
+def test_opening_taken_before_a_poll_is_missed():
+    backtest = hackjohn.Backtest(60)
+    summary = run(backtest, [(0, {}), (10, {A: 2}), (20, {A: 2, B: 1}), (30, {B: 1})])
+    assert summary["reports"] == 4
+    assert summary["reports_seen"] == 1
+    assert summary["openings_detected"] == 1
+    assert summary["openings_missed"] == 1
+    # B first showed 20 seconds in and was seen by the poll at 60 seconds
+    assert summary["median_latency"] == 40
+    alert, = backtest.alerts
+    assert alert.timestamp == T0 + timedelta(seconds=30)
+    assert alert.detected_at == T0 + timedelta(seconds=60)
+    assert alert.permits == {"2021-07-05": {"j24b": 1}}
+
+
+def test_each_poll_sees_the_latest_version():
+    backtest = hackjohn.Backtest(60)
+    summary = run(backtest, [(0, {}), (10, {A: 2}), (130, {A: 2, B: 1})])
+    assert summary["reports_seen"] == 2
+    assert summary["polls"] == 3
+    assert summary["notifications"] == 2
+    assert backtest.latencies == [50, 50]
+    assert [alert.permits for alert in backtest.alerts] == [
+        {"2021-07-05": {"j19": 2}},
+        {"2021-07-05": {"j24b": 1}},
+    ]
+
+
+def test_decreases_do_not_notify():
+    backtest = hackjohn.Backtest(60)
+    summary = run(backtest, [(0, {A: 3}), (10, {A: 1})])
+    assert summary["reports_seen"] == 1
+    assert summary["notifications"] == 0
+    assert summary["median_latency"] is None
+
+
+def test_poll_interval_function_and_phase():
+    # polls at 30 seconds, then every 10 seconds
+    backtest = hackjohn.Backtest(lambda poll_time: 10, phase=30)
+    run(backtest, [(0, {}), (45, {A: 1})])
+    assert backtest.latencies == [5]
+    assert backtest.n_polls == 2
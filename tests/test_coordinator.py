@@ -0,0 +1,73 @@
+import threading
+from datetime import datetime
+
+import pytz
+
+import hackjohn
+
+PACIFIC = pytz.timezone("US/Pacific")
+
+
+def report(n: int, version: str = "") -> hackjohn.ReservationReport:
+    jmt_report = hackjohn.ReservationReport.from_mapping({"2021-07-05": {"j19": n}, "2021-07-06": {"j24b": 1}})
+    jmt_report.version = version
+    return jmt_report
+
+
+def timestamp(minute: int) -> datetime:
+    return PACIFIC.localize(datetime(2021, 7, 1, 11, minute))
+
+
+def test_snapshot_store_deduplicates_by_timestamp_and_version(tmp_path):
+    store = hackjohn.SnapshotStore(tmp_path / "snapshots.sqlite")
+    assert store.add(report(1), timestamp(0))
+    assert not store.add(report(1), timestamp(0))
+    # a merged report can be updated without its timestamp moving
+    assert store.add(report(2, "jm=2021-07-01T11:00:00,ym=2021-07-01T10:59:00"), timestamp(0))
+    assert store.add(report(3), timestamp(1))
+    assert [dict(stored) for stored, _ in store.query()] == [
+        dict(report(1)), dict(report(2)), dict(report(3))]
+    latest, latest_timestamp = store.latest()
+    assert dict(latest) == dict(report(3))
+    assert latest_timestamp == timestamp(1)
+    before, _ = store.latest(before=timestamp(1))
+    assert before.version == "jm=2021-07-01T11:00:00,ym=2021-07-01T10:59:00"
+
+
+def test_coordinator_hands_each_report_to_one_leader(tmp_path):
+    store = hackjohn.SnapshotStore(tmp_path / "snapshots.sqlite")
+    first = hackjohn.Coordinator(store, "first")
+    second = hackjohn.Coordinator(store, "second")
+    assert first.publish(report(1), timestamp(0))
+    assert not second.publish(report(1), timestamp(0))
+    assert first.elect()
+    assert not second.elect()
+
+    # a new leader starts from the latest report
+    (report_id, handled, handled_timestamp), = first.unhandled_reports()
+    assert dict(handled) == dict(report(1))
+    assert handled_timestamp == timestamp(0)
+    first.mark_handled(report_id)
+    assert list(first.unhandled_reports()) == []
+
+    second.publish(report(2), timestamp(1))
+    first.publish(report(3), timestamp(2))
+    first.resign()
+    assert second.elect()
+    # the new leader carries on where the previous one left off
+    assert [dict(r) for _, r, _ in second.unhandled_reports()] == [dict(report(2)), dict(report(3))]
+
+
+def test_coordinator_elects_a_single_leader_concurrently(tmp_path):
+    store = hackjohn.SnapshotStore(tmp_path / "snapshots.sqlite")
+    coordinators = [hackjohn.Coordinator(store, f"worker{i}") for i in range(8)]
+    results = {}
+    threads = [
+        threading.Thread(target=lambda c=coordinator: results.update({c.name: c.elect()}))
+        for coordinator in coordinators
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(results.values()) == 1
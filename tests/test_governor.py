@@ -0,0 +1,59 @@
+import pytest
+
+import config
+import hackjohn
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """Allow 4 requests per minute (a token every 15 seconds)."""
+    monkeypatch.setattr(config, "API_REQUEST_BUDGET", 4)
+    return 4
+
+
+def test_budget_is_shared_by_pollers_on_the_host(budget):
+    # two governors stand for two processes sharing API_BUDGET_FILE
+    first, second = hackjohn.RequestGovernor(), hackjohn.RequestGovernor()
+    assert [first._reserve(), second._reserve(), first._reserve(), second._reserve()] == [0, 0, 0, 0]
+    assert 14 < first._reserve() <= 15
+    # the next token after that one
+    assert 29 < second._reserve() <= 30
+
+
+def test_budget_without_file_is_per_process(budget, monkeypatch):
+    monkeypatch.setattr(config, "API_BUDGET_FILE", None)
+    first, second = hackjohn.RequestGovernor(), hackjohn.RequestGovernor()
+    assert [first._reserve() for _ in range(budget)] == [0] * budget
+    assert second._reserve() == 0
+    assert first._reserve() > 0
+
+
+def test_backoff_doubles_with_consecutive_errors(monkeypatch):
+    monkeypatch.setattr(config, "API_BACKOFF_BASE", 1)
+    monkeypatch.setattr(config, "API_BACKOFF_MAX", 6)
+    # always wait the longest time the jitter allows
+    monkeypatch.setattr(hackjohn.random, "uniform", lambda low, high: high)
+    governor = hackjohn.RequestGovernor()
+    waits = []
+    for status in 500, None, 429, 503:
+        governor.record(0.1, status)
+        waits.append(governor._reserve())
+    assert waits == pytest.approx([1, 2, 4, 6], abs=0.1)
+    # a Retry-After header extends the backoff
+    governor.record(0.1, 503, retry_after="30")
+    assert governor._reserve() == pytest.approx(30, abs=0.1)
+    # the first success ends it
+    governor.record(0.1, 200)
+    assert governor._reserve() == 0
+    assert governor.consecutive_errors == 0
+
+
+def test_error_rate_slows_polling(monkeypatch):
+    monkeypatch.setattr(config, "API_HEALTH_SMOOTHING", 0.5)
+    monkeypatch.setattr(config, "API_ERROR_SLOWDOWN", 3)
+    governor = hackjohn.RequestGovernor()
+    assert governor.poll_interval(10) == 10
+    governor.record(0.1, None)
+    assert governor.poll_interval(10) == pytest.approx(20)
+    governor.record(0.1, 200)
+    assert governor.poll_interval(10) == pytest.approx(15)
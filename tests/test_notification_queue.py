@@ -0,0 +1,173 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+import pytz
+
+import benchmark
+import config
+import hackjohn
+
+TIMESTAMP = pytz.timezone("US/Pacific").localize(datetime(2021, 7, 1, 11, 0))
+TRAILHEADS = benchmark.make_trailheads()
+WINDOW = 0.2
+CHANNELS = {"ifttt_key": "key", "subscriber": "alice"}
+A = ("2021-07-05", "j19")  # Sunrise Lakes
+B = ("2021-07-05", "j24b")  # Lyell Canyon
+C = ("2021-07-04", "j01b")  # Happy Isles->Little Yosemite Valley
+
+
+class Messages(list):
+    """Messages sent, as (destination, text), and destinations where delivery fails."""
+
+    def __init__(self):
+        super().__init__()
+        self.failing = set()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Record the messages sent by NotificationQueue instead of sending them."""
+    monkeypatch.setattr(config, "NOTIFY_COALESCE_WINDOW", WINDOW)
+    messages = Messages()
+
+    async def send_notifications_async(text, **channels):
+        channel, = (key for key in channels if key != "subscriber")
+        messages.append((channels[channel], text.text))
+        return {channel: None if channels[channel] in messages.failing else 0.0}
+
+    monkeypatch.setattr(hackjohn, "send_notifications_async", send_notifications_async)
+    return messages
+
+
+def notification(permits: dict, channels: dict = CHANNELS) -> hackjohn.Notification:
+    rendering = hackjohn.render_report(TIMESTAMP, hackjohn.unflatten_permits(permits), TRAILHEADS)
+    return hackjohn.Notification(rendering, channels, permits)
+
+
+def run(coroutine_function):
+    asyncio.run(coroutine_function())
+
+
+def test_first_notification_is_sent_right_away(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        assert await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        await queue.close()
+
+    run(scenario)
+    (destination, text), = sent
+    assert destination == "key"
+    assert "2 permits for Sunrise Lakes" in text
+
+
+def test_notifications_within_the_window_are_coalesced(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        assert not await queue.submit(notification({A: 2, B: 1}), TIMESTAMP, TRAILHEADS)
+        assert not await queue.submit(notification({A: 2, B: 3, C: 1}), TIMESTAMP, TRAILHEADS)
+        assert len(sent) == 1
+        await asyncio.sleep(WINDOW * 2)
+        await queue.close()
+
+    run(scenario)
+    assert len(sent) == 2
+    _, text = sent[1]
+    # A was already sent, and the held message has the latest spaces, nearest date first
+    assert "Sunrise Lakes" not in text
+    assert text.index("1 permit for Happy Isles") < text.index("3 permits for Lyell Canyon")
+
+
+def test_delivered_permits_are_not_sent_again_until_taken(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        await asyncio.sleep(WINDOW * 1.5)
+        assert not await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        assert not await queue.submit(notification({A: 1}), TIMESTAMP, TRAILHEADS)
+        assert len(sent) == 1
+        # one space is taken, so gaining it back is new again
+        queue.update_available({A: 1})
+        assert await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        await queue.close()
+
+    run(scenario)
+    assert len(sent) == 2
+
+
+def test_held_permits_that_were_taken_are_dropped(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        await queue.submit(notification({A: 2, B: 1}), TIMESTAMP, TRAILHEADS)
+        queue.update_available({A: 2})
+        await queue.close()
+
+    run(scenario)
+    assert len(sent) == 1
+
+
+def test_destinations_are_queued_separately(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        other = {"twilio_to_phone": ["+15555555555", "+15555555556"], "subscriber": "bob"}
+        assert await queue.submit(notification({A: 2}, other), TIMESTAMP, TRAILHEADS)
+        await queue.close()
+
+    run(scenario)
+    assert sorted(destination for destination, _ in sent) == ["+15555555555", "+15555555556", "key"]
+
+
+def test_failed_delivery_is_retried_after_the_window(sent):
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        sent.failing.add("key")
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        sent.failing.clear()
+        await asyncio.sleep(WINDOW * 2)
+        await queue.close()
+
+    run(scenario)
+    assert [destination for destination, _ in sent] == ["key", "key"]
+
+
+def test_failed_delivery_without_window_is_retried_with_the_next_notification(sent, monkeypatch):
+    monkeypatch.setattr(config, "NOTIFY_COALESCE_WINDOW", 0)
+
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        sent.failing.add("key")
+        assert await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        sent.failing.clear()
+        assert await queue.submit(notification({A: 2, B: 1}), TIMESTAMP, TRAILHEADS)
+        await queue.close()
+
+    run(scenario)
+    assert len(sent) == 2
+    _, text = sent[1]
+    assert "Sunrise Lakes" in text and "Lyell Canyon" in text
+
+
+def test_failed_delivery_without_window_is_retried_on_close(sent, monkeypatch):
+    monkeypatch.setattr(config, "NOTIFY_COALESCE_WINDOW", 0)
+
+    async def scenario():
+        queue = hackjohn.NotificationQueue()
+        sent.failing.add("key")
+        await queue.submit(notification({A: 2}), TIMESTAMP, TRAILHEADS)
+        sent.failing.clear()
+        await queue.close()
+
+    run(scenario)
+    assert [destination for destination, _ in sent] == ["key", "key"]
+
+
+def test_subscriber_destinations_do_not_fall_back_to_config(monkeypatch):
+    monkeypatch.setattr(config, "ENABLE_TELEGRAM", False)
+    monkeypatch.setattr(config, "ENABLE_TWILIO", False)
+    monkeypatch.setattr(config, "ENABLE_IFTTT", True)
+    monkeypatch.setattr(config, "IFTTT_KEY", "config-key")
+    assert hackjohn.NotificationQueue.destinations({"subscriber": "alice"}) == []
+    assert hackjohn.NotificationQueue.destinations({}) == [("ifttt_key", "config-key")]
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import pathlib
+
+import pytest
+
+import benchmark
+import config
+import hackjohn
+
+
+@pytest.fixture
+def ifttt_sent(mock_server, monkeypatch):
+    """Record the IFTTT notifications sent, as (key, text)."""
+    sent = []
+    monkeypatch.setattr(config, "ENABLE_TELEGRAM", False)
+    monkeypatch.setattr(config, "ENABLE_IFTTT", True)
+    monkeypatch.setattr(config, "IFTTT_KEY", "owner")
+    monkeypatch.setattr(
+        hackjohn, "send_IFTTT_notification", lambda text, key=None: sent.append((key, text.text)))
+    return sent
+
+
+def write_subscriptions(tmp_path, monkeypatch, entries: list):
+    path = tmp_path / "subscriptions.json"
+    path.write_text(json.dumps(entries))
+    monkeypatch.setattr(config, "SUBSCRIPTIONS_FILE", path)
+
+
+def test_single_poll_notifies_once_per_destination(ifttt_sent, tmp_path, monkeypatch):
+    window = {"start_date": config.START_DATE, "end_date": config.END_DATE}
+    write_subscriptions(tmp_path, monkeypatch, [
+        {"name": "owner-too", **window, "ifttt_key": "owner"},
+        {"name": "friend", **window, "ifttt_key": "friend"},
+    ])
+    assert hackjohn.check_for_permits() is not None
+    # the owner's subscription matches the same permits as config.py, so the
+    # notification queue sends them to the shared key once
+    assert sorted(key for key, _ in ifttt_sent) == ["friend", "owner"]
+
+
+def test_single_poll_skips_unchanged_report(ifttt_sent, mock_state):
+    hackjohn.check_for_permits()
+    assert len(ifttt_sent) == 1
+    assert hackjohn.check_for_permits() is None
+    assert len(ifttt_sent) == 1
+
+
+def test_new_process_skips_unchanged_report(ifttt_sent, mock_state, monkeypatch):
+    hackjohn.check_for_permits()
+    # a later cron run starts with nothing in memory
+    benchmark.reset_hackjohn_state()
+    monkeypatch.setattr(hackjohn, "evaluate_report", None)
+    assert hackjohn.check_for_permits() is None
+
+
+def test_new_process_merges_unchanged_regions():
+    state = benchmark.MockState(n_regions=3)
+    with benchmark.mock_environment(state):
+        hackjohn.check_for_permits()
+        # only the first region was updated since the last run
+        state_file = pathlib.Path(config.REPORT_STATE_FILE)
+        saved = json.loads(state_file.read_text())
+        saved["jm"]["timestamp"] = "2021-07-01T10:00:00"
+        state_file.write_text(json.dumps(saved))
+        benchmark.reset_hackjohn_state()
+        jmt_report, _ = asyncio.run(hackjohn.get_jmt_report_async(only_if_changed=True))
+    assert set(jmt_report.trailhead_ids) == set(state.trailheads)
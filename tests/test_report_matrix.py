@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import pytz
+
+import config
+import hackjohn
+
+
+def trailhead(region: str, quota: int, name: str) -> dict:
+    return {"region": region, "quota": quota, "wpsName": name}
+
+
+TRAILHEADS = {
+    "j19": trailhead("jm", 10, "Sunrise Lakes"),
+    "j24b": trailhead("jm", 5, "Lyell Canyon"),
+    "d01": trailhead("jm", 20, "Donohue Exit Quota"),
+    "d02": trailhead("jm", 10, "Donohue Exit Quota (Lyell Canyon)"),
+    "ym1": trailhead("ym", 4, "Mono Pass"),
+    "ym2": trailhead("ym", 4, "Parker Pass"),
+    "ymx": trailhead("ym", 6, "Mono Exit Quota"),
+    "oz1": trailhead("oz", 3, "Outside Any Region"),
+}
+
+
+def test_each_region_applies_its_own_exit_quotas():
+    regions = {
+        "jm": hackjohn.Region("jm", "d01", {"j24b": "d02"}, None),
+        "ym": hackjohn.Region("ym", "ymx", {}, frozenset({"ym1"})),
+    }
+    jmt_report = {
+        "2021-07-05": {"j19": 0, "j24b": 3, "d01": 17, "d02": 0, "ym1": 0, "ym2": 0, "ymx": 5, "oz1": 1},
+        # the Mono exit quota is missing, so nothing is available in that region
+        "2021-07-06": {"j19": 10, "j24b": 5, "d01": 0, "d02": 0, "ym1": 0, "ym2": 0, "oz1": 3},
+    }
+    matrix = hackjohn.ReportMatrix(jmt_report, TRAILHEADS, regions)
+    # exit quotas are not trailheads, and ym2 is not watched in its region
+    assert matrix.trailhead_ids == ["j19", "j24b", "ym1", "oz1"]
+    assert matrix.available_permits("2021-07-05", "2021-07-06") == {
+        # Sunrise Lakes is limited by the Donohue exit quota, Lyell Canyon by
+        # its own entry quota (its exit quota is d02), Mono Pass by the Mono
+        # exit quota, and a trailhead outside REGIONS by its entry quota only
+        "2021-07-05": {"j19": 3, "j24b": 2, "ym1": 1, "oz1": 2},
+    }
+
+
+def test_lyell_canyon_uses_its_own_donohue_exit_quota(monkeypatch):
+    monkeypatch.setattr(config, "REGIONS", {"jm": {"default_exit": "d01", "exits": {"j24b": "d02"}}})
+    jmt_report = {
+        "2021-07-05": {"j19": 0, "j24b": 0, "d01": 20, "d02": 8},
+        "2021-07-06": {"j19": 0, "j24b": 0, "d01": 15, "d02": 10},
+    }
+    matrix = hackjohn.ReportMatrix(jmt_report, TRAILHEADS)
+    assert matrix.available_permits("2021-07-05", "2021-07-06") == {
+        "2021-07-05": {"j24b": 2},
+        "2021-07-06": {"j19": 5},
+    }
+
+
+def test_find_available_permits_applies_the_search(monkeypatch):
+    monkeypatch.setattr(config, "REGIONS", {"jm": {"default_exit": "d01", "exits": {"j24b": "d02"}}})
+    monkeypatch.setattr(config, "START_DATE", "2021-07-02")
+    monkeypatch.setattr(config, "END_DATE", "2021-07-05")
+    monkeypatch.setattr(config, "MIN_SPACES", 2)
+    monkeypatch.setattr(config, "EXCLUDE_TRAILHEADS", ["Sunrise Lakes"])
+    reserved = {"2021-07-02": 0, "2021-07-03": 4, "2021-07-04": 2, "2021-07-05": 0, "2021-07-06": 0}
+    jmt_report = {date: {"j19": 0, "j24b": n, "d01": 0, "d02": 7} for date, n in reserved.items()}
+    timestamp = pytz.timezone("US/Pacific").localize(datetime(2021, 7, 1, 11, 0))
+    # permits can be reserved from MIN_RESERVE_DAYS after the report
+    # (2021-07-03) through END_DATE, with at least MIN_SPACES available
+    assert hackjohn.find_available_permits(jmt_report, timestamp, TRAILHEADS) == {
+        "2021-07-04": {"j24b": 3},
+        "2021-07-05": {"j24b": 3},
+    }
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import hackjohn
+
+
+def test_from_values_regular_rows():
+    values = [
+        {"date": "2021-07-05", "j19": 3, "j24b": 0},
+        {"date": "2021-07-06", "j19": 9, "j24b": 21},
+    ]
+    report = hackjohn.ReservationReport.from_values(values)
+    assert report.dates == ["2021-07-05", "2021-07-06"]
+    assert report.trailhead_ids == ("j19", "j24b")
+    assert list(report.counts) == [3, 0, 9, 21]
+    assert report["2021-07-06"] == {"j19": 9, "j24b": 21}
+    assert dict(report) == {"2021-07-05": {"j19": 3, "j24b": 0}, "2021-07-06": {"j19": 9, "j24b": 21}}
+
+
+def test_from_values_irregular_rows():
+    values = [
+        {"date": "2021-07-05", "j19": 3},
+        {"date": "2021-07-06", "j24b": 21, "j19": None},
+        {"date": "2021-07-05", "d01": 4},
+    ]
+    report = hackjohn.ReservationReport.from_values(values)
+    # rows of a repeated date are merged, and trailheads are in order of first appearance
+    assert report.dates == ["2021-07-05", "2021-07-06"]
+    assert report.trailhead_ids == ("j19", "d01", "j24b")
+    # missing values are left out of the dictionary of a date
+    assert report["2021-07-05"] == {"j19": 3, "d01": 4}
+    assert report["2021-07-06"] == {"j24b": 21}
+
+
+def test_from_values_single_trailhead():
+    report = hackjohn.ReservationReport.from_values([{"date": "2021-07-05", "j19": 3}])
+    assert report["2021-07-05"] == {"j19": 3}
+
+
+def test_from_values_empty():
+    report = hackjohn.ReservationReport.from_values([])
+    assert len(report) == 0
+    assert report.trailhead_ids == ()
+
+
+def test_merge_later_reports_take_precedence():
+    first = hackjohn.ReservationReport.from_mapping({
+        "2021-07-05": {"j19": 3, "j24b": 1},
+        "2021-07-06": {"j19": 4},
+    })
+    second = hackjohn.ReservationReport.from_values([
+        {"date": "2021-07-06", "j19": 5, "d01": None},
+        {"date": "2021-07-07", "j19": None, "d01": 2},
+    ])
+    merged = hackjohn.ReservationReport.merge([first, second])
+    assert merged.dates == ["2021-07-05", "2021-07-06", "2021-07-07"]
+    assert merged.trailhead_ids == ("j19", "j24b", "d01")
+    assert dict(merged) == {
+        "2021-07-05": {"j19": 3, "j24b": 1},
+        "2021-07-06": {"j19": 5},
+        "2021-07-07": {"d01": 2},
+    }
+
+
+def test_merge_missing_values_do_not_overwrite():
+    first = hackjohn.ReservationReport.from_mapping({"2021-07-05": {"j19": 3}})
+    second = hackjohn.ReservationReport.from_values([{"date": "2021-07-05", "j19": None, "d01": 1}])
+    merged = hackjohn.ReservationReport.merge([first, second])
+    assert merged["2021-07-05"] == {"j19": 3, "d01": 1}
+
+
+def test_merged_region_reports_are_versioned_by_region_timestamps():
+    jm = hackjohn.ReservationReport.from_mapping({"2021-07-05": {"j19": 3}})
+    ym = hackjohn.ReservationReport.from_mapping({"2021-07-05": {"ymx": 1}})
+    merged, timestamp = hackjohn._merge_region_reports(
+        ["jm", "ym"], [(jm, datetime(2021, 7, 1, 11, 0)), (ym, datetime(2021, 7, 1, 10, 58))], False)
+    assert timestamp == datetime(2021, 7, 1, 11, 0)
+    assert merged.version == "jm=2021-07-01T11:00:00,ym=2021-07-01T10:58:00"
+    assert merged["2021-07-05"] == {"j19": 3, "ymx": 1}
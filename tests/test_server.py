@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+import pytz
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+import hackjohn
+
+PACIFIC = pytz.timezone("US/Pacific")
+TRAILHEADS = {
+    "j19": {"id": "j19", "wpsName": "Sunrise Lakes", "region": "jm", "quota": 9},
+    "j24b": {"id": "j24b", "wpsName": "Lyell Canyon", "region": "jm", "quota": 21},
+    "d01": {"id": "d01", "wpsName": "Donohue Pass exit", "region": "jm", "quota": 20},
+    "d02": {"id": "d02", "wpsName": "Donohue Pass exit (Lyell Canyon)", "region": "jm", "quota": 15},
+}
+
+
+@pytest.fixture(autouse=True)
+def search(monkeypatch):
+    monkeypatch.setattr(config, "REGIONS", {"jm": {"default_exit": "d01", "exits": {"j24b": "d02"}}})
+    monkeypatch.setattr(config, "START_DATE", "2021-06-15")
+    monkeypatch.setattr(config, "END_DATE", "2021-09-30")
+    monkeypatch.setattr(config, "MIN_SPACES", 1)
+    monkeypatch.setattr(config, "EXCLUDE_TRAILHEADS", [])
+
+
+def report(j19: int) -> hackjohn.ReservationReport:
+    return hackjohn.ReservationReport.from_mapping({
+        "2021-07-05": {"j19": j19, "j24b": 19, "d01": 0, "d02": 0},
+        "2021-07-06": {"j19": 9, "j24b": 21, "d01": 0, "d02": 0},
+    })
+
+
+def timestamp(minute: int) -> datetime:
+    return PACIFIC.localize(datetime(2021, 7, 1, 11, minute))
+
+
+def serve(scenario):
+    """Run scenario(server, client) against an AvailabilityServer."""
+    async def run():
+        server = hackjohn.AvailabilityServer()
+        async with TestClient(TestServer(server.app())) as client:
+            await scenario(server, client)
+
+    asyncio.run(run())
+
+
+async def read_event(response) -> dict:
+    """Read the fields of the next Server-Sent Event (or comment) of a stream."""
+    fields = {}
+    while True:
+        line = (await asyncio.wait_for(response.content.readline(), 5)).decode().rstrip("\n")
+        if not line:
+            return fields
+        key, _, value = line.partition(":")
+        fields[key] = value.strip()
+
+
+def test_availability_is_served_with_an_etag():
+    async def scenario(server, client):
+        response = await client.get("/availability")
+        assert response.status == 503
+        server.update(report(5), timestamp(0), TRAILHEADS)
+
+        response = await client.get("/availability")
+        assert response.status == 200
+        body = await response.json()
+        assert body["permits"] == {"2021-07-05": {"j19": 4, "j24b": 2}}
+        assert body["trailheads"] == {"j19": "Sunrise Lakes", "j24b": "Lyell Canyon"}
+        etag = response.headers["ETag"]
+
+        response = await client.get("/availability", headers={"If-None-Match": etag})
+        assert response.status == 304
+        # a new report has a new ETag
+        server.update(report(8), timestamp(1), TRAILHEADS)
+        response = await client.get("/availability", headers={"If-None-Match": etag})
+        assert response.status == 200
+        assert response.headers["ETag"] != etag
+        assert (await response.json())["permits"] == {"2021-07-05": {"j19": 1, "j24b": 2}}
+
+    serve(scenario)
+
+
+def test_availability_query():
+    async def scenario(server, client):
+        server.update(report(5), timestamp(0), TRAILHEADS)
+        response = await client.get("/availability", params=[("trailhead", "Lyell Canyon")])
+        assert (await response.json())["permits"] == {"2021-07-05": {"j24b": 2}}
+        response = await client.get("/availability", params={"min_spaces": "3"})
+        assert (await response.json())["permits"] == {"2021-07-05": {"j19": 4}}
+        response = await client.get("/report", params={"start": "2021-07-06"})
+        assert (await response.json())["reserved"] == {"2021-07-06": {"j19": 9, "j24b": 21, "d01": 0, "d02": 0}}
+
+    serve(scenario)
+
+
+@pytest.mark.parametrize("query", [{"start": "July 5"}, {"end": "2021-07-32"}, {"min_spaces": "many"}])
+def test_invalid_query_is_a_bad_request(query):
+    async def scenario(server, client):
+        server.update(report(5), timestamp(0), TRAILHEADS)
+        response = await client.get("/availability", params=query)
+        assert response.status == 400
+
+    serve(scenario)
+
+
+def test_events_stream_report_updates(monkeypatch):
+    monkeypatch.setattr(config, "SERVE_KEEPALIVE", 0.1)
+
+    async def scenario(server, client):
+        server.update(report(5), timestamp(0), TRAILHEADS)
+        async with client.get("/events", params={"trailhead": "j19"}) as response:
+            assert response.headers["Content-Type"] == "text/event-stream"
+            event = await read_event(response)
+            assert event["event"] == "availability"
+            first_id = event["id"]
+            assert '"j19": 4' in event["data"]
+            assert await read_event(response) == {"": "keepalive"}
+
+            server.update(report(8), timestamp(1), TRAILHEADS)
+            event = await read_event(response)
+            while event.get("event") != "availability":
+                event = await read_event(response)
+            assert event["id"] != first_id
+            assert '"j19": 1' in event["data"]
+
+        # a client that reconnects with the latest id only gets later updates
+        async with client.get("/events", headers={"Last-Event-ID": server.version}) as response:
+            assert await read_event(response) == {"": "keepalive"}
+
+    serve(scenario)
@@ -0,0 +1,50 @@
+import asyncio
+
+import config
+import hackjohn
+
+
+def get_jmt_report(only_if_changed: bool = False):
+    return asyncio.run(hackjohn.get_jmt_report_async(only_if_changed=only_if_changed))
+
+
+def test_session_is_authorized_once(mock_server, mock_state):
+    jmt_report, timestamp = get_jmt_report()
+    assert timestamp.strftime("%Y-%m-%dT%H:%M") == mock_state.timestamp.strftime("%Y-%m-%dT%H:%M")
+    assert len(jmt_report) == len(mock_state.values)
+    get_jmt_report()
+    assert mock_server.solves == 1
+
+
+def test_expired_session_is_reauthorized(mock_server, mock_state):
+    get_jmt_report()
+    mock_state.sessions.clear()
+    mock_state.bump_timestamp()
+    _, timestamp = get_jmt_report()
+    assert timestamp.minute == mock_state.timestamp.minute
+    assert mock_server.solves == 2
+
+
+def test_saved_session_is_shared_between_pollers(mock_server):
+    get_jmt_report()
+    # another poller on this host starts with the saved cookies
+    hackjohn.sessions = hackjohn.SessionManager()
+    get_jmt_report()
+    assert mock_server.solves == 1
+
+
+def test_only_changed_reports_are_returned(mock_server, mock_state):
+    assert get_jmt_report(only_if_changed=True) is not None
+    assert get_jmt_report(only_if_changed=True) is None
+    mock_state.bump_timestamp()
+    assert get_jmt_report(only_if_changed=True) is not None
+
+
+def test_saved_lifetime_is_loaded_as_is(mock_server):
+    get_jmt_report()
+    store = hackjohn.SessionStateStore(config.SESSION_STATE_FILE)
+    state = store.load()
+    store.save(store.cookie_jar(state), state["solved_at"], 5400.0)
+    hackjohn.sessions = hackjohn.SessionManager()
+    get_jmt_report()
+    assert hackjohn.sessions.lifetime == 5400.0
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytz
+
+import benchmark
+import config
+import hackjohn
+
+TIMESTAMP = pytz.timezone("US/Pacific").localize(datetime(2021, 7, 1, 11, 0))
+TRAILHEADS = {
+    **benchmark.make_trailheads(),
+    "j05": {"id": "j05", "wpsName": "Tuolumne Meadows Café", "region": "jm", "quota": 5},
+    "j06": {"id": "j06", "wpsName": "Glacier Point->Little Yosemite Valley", "region": "jm", "quota": 5},
+}
+
+
+def render_sms(permits: dict) -> str:
+    return hackjohn.render_report(TIMESTAMP, permits, TRAILHEADS).sms
+
+
+def test_sms_uses_short_ascii_names():
+    sms = render_sms({"2021-07-05": {"j24b": 2, "j05": 1}, "2021-07-06": {"j19": 3, "j06": 1}})
+    # names from SMS_TRAILHEAD_NAMES, or else the full name cut to 24 characters
+    assert sms == (
+        f"Permits: 7/5 Lyell Cyn 2, Tuolumne Meadows Cafe 1; 7/6 Sunrise Lks 3, Glacier Point->Little Y. 1. "
+        f"Call {config.PERMIT_OFFICE_PHONE}"
+    )
+    assert sms.isascii()
+
+
+def test_sms_fits_in_one_segment():
+    permits = {f"2021-07-{day:02d}": {"j01a": 1, "j19": 2, "j24b": 3} for day in range(5, 25)}
+    sms = render_sms(permits)
+    assert len(sms) <= config.SMS_MAX_LENGTH
+    # the permits that do not fit are counted
+    listed = sms.count("HI->Sunrise") + sms.count("Sunrise Lks") + sms.count("Lyell Cyn")
+    assert sms.endswith(f" +{60 - listed} more. Call {config.PERMIT_OFFICE_PHONE}")
+
+
+def test_sms_segments_are_counted_from_the_max_length(monkeypatch):
+    class Messages:
+        def create(self, **kwargs):
+            pass
+
+    class Client:
+        messages = Messages()
+
+    monkeypatch.setattr(hackjohn.sessions, "twilio_client", lambda: Client())
+    monkeypatch.setattr(config, "TWILIO_COST_PER_SEGMENT", 1)
+    monkeypatch.setattr(config, "SMS_MAX_LENGTH", 70)
+    monkeypatch.setattr(hackjohn, "metrics", hackjohn.Metrics())
+    for length in 70, 71, 126, 127:
+        hackjohn._send_twilio_message("x" * length, "+15555555555", "+15555555556")
+    assert hackjohn.metrics._counters[("spend_usd_total", (("service", "twilio"),))] == 1 + 2 + 2 + 3
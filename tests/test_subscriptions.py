@@ -0,0 +1,86 @@
+import json
+
+import hackjohn
+
+TRAILHEADS = {
+    "j19": {"id": "j19", "wpsName": "Sunrise Lakes"},
+    "j24b": {"id": "j24b", "wpsName": "Lyell Canyon"},
+}
+
+
+def write_subscriptions(tmp_path, entries: list):
+    path = tmp_path / "subscriptions.json"
+    path.write_text(json.dumps(entries))
+    return path
+
+
+def test_load_subscriptions(tmp_path, capsys):
+    path = write_subscriptions(tmp_path, [
+        {
+            "name": "alice",
+            "start_date": "2021-07-01",
+            "end_date": "2021-07-10",
+            "trailheads": ["Lyell Canyon"],
+            "telegram_token": "alice-token",
+            "twilio_to_phone": ["+15555555555"],
+        },
+        {"name": "bob", "start_date": "2021-07-01", "end_date": "2021-07-10", "ifttt_key": "bob-key", "min_space": 2},
+        {"name": "carol", "start_date": "2021-07-01", "end_date": "2021-07-10"},
+    ])
+    alice, bob = hackjohn.load_subscriptions(path)
+    assert alice.trailheads == frozenset({"Lyell Canyon"})
+    assert alice.channels == {
+        "telegram_token": "alice-token", "twilio_to_phone": ["+15555555555"], "subscriber": "alice"}
+    assert bob.min_spaces == 1
+    assert bob.trailheads is None
+    # subscribers are only notified on their own channels
+    assert bob.channels == {"ifttt_key": "bob-key", "subscriber": "bob"}
+    assert hackjohn._get_channels(None, None, None, subscriber="bob") == (None, None, None)
+    output = capsys.readouterr().out
+    assert "unknown keys in subscription 'bob': min_space" in output
+    assert "skipping subscription 'carol'" in output
+
+
+def subscription(name: str, start_date: str, end_date: str, **kwargs) -> hackjohn.Subscription:
+    fields = dict(
+        name=name, start_date=start_date, end_date=end_date, min_spaces=1,
+        trailheads=None, exclude_trailheads=frozenset(), channels={"ifttt_key": name, "subscriber": name},
+    )
+    fields.update(kwargs)
+    return hackjohn.Subscription(**fields)
+
+
+def test_subscription_index_covering():
+    early = subscription("early", "2021-07-01", "2021-07-05")
+    late = subscription("late", "2021-07-05", "2021-07-31")
+    index = hackjohn.SubscriptionIndex([early, late])
+    assert index.start_date == "2021-07-01"
+    assert index.end_date == "2021-07-31"
+    assert index.covering("2021-07-01") == [early]
+    assert index.covering("2021-07-05") == [early, late]
+    assert index.covering("2021-08-01") == []
+
+
+def test_subscription_index_match():
+    lyell = subscription("lyell", "2021-07-01", "2021-07-10", trailheads=frozenset({"Lyell Canyon"}))
+    pairs = subscription("pairs", "2021-07-01", "2021-07-10", min_spaces=2)
+    no_sunrise = subscription("no-sunrise", "2021-07-06", "2021-07-10", exclude_trailheads=frozenset({"Sunrise Lakes"}))
+    index = hackjohn.SubscriptionIndex([lyell, pairs, no_sunrise])
+    flat_permits = {
+        ("2021-07-05", "j24b"): 1,
+        ("2021-07-06", "j19"): 2,
+        ("2021-07-06", "j24b"): 3,
+        ("2021-07-20", "j24b"): 5,
+    }
+    matches = {s.name: permits for s, permits in index.match(flat_permits, TRAILHEADS)}
+    assert matches == {
+        "lyell": {"2021-07-05": {"j24b": 1}, "2021-07-06": {"j24b": 3}},
+        "pairs": {"2021-07-06": {"j19": 2, "j24b": 3}},
+        "no-sunrise": {"2021-07-06": {"j24b": 3}},
+    }
+
+
+def test_empty_subscription_index():
+    index = hackjohn.SubscriptionIndex([])
+    assert index.start_date is None
+    assert index.match({("2021-07-05", "j19"): 1}, TRAILHEADS) == []
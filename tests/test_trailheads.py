@@ -0,0 +1,54 @@
+import json
+import pathlib
+
+import config
+import hackjohn
+
+
+def pull_trailheads(mock_state, **kwargs):
+    """Return the trailhead descriptions and the number of requests made for them."""
+    requests = mock_state.requests
+    trailheads = hackjohn.get_trailhead_descriptions(**kwargs)
+    return trailheads, mock_state.requests - requests
+
+
+def forget_memory():
+    """Start over with only the cache file, like a new process."""
+    hackjohn._trailhead_cache.clear()
+
+
+def test_trailheads_are_cached_in_memory_and_on_disk(mock_server, mock_state):
+    trailheads, requests = pull_trailheads(mock_state)
+    assert trailheads == mock_state.trailheads
+    assert requests > 0
+    assert pull_trailheads(mock_state) == (trailheads, 0)
+    forget_memory()
+    assert pull_trailheads(mock_state) == (trailheads, 0)
+
+
+def test_expired_cache_is_refreshed(mock_server, mock_state, monkeypatch):
+    pull_trailheads(mock_state)
+    monkeypatch.setattr(config, "TRAILHEAD_CACHE_TTL", 0)
+    assert pull_trailheads(mock_state)[1] == 1
+
+
+def test_cache_is_refreshed_for_unknown_trailheads(mock_server, mock_state):
+    pull_trailheads(mock_state)
+    assert pull_trailheads(mock_state, required_ids=["j19"])[1] == 0
+    assert pull_trailheads(mock_state, required_ids=["j19", "new"])[1] == 1
+    assert pull_trailheads(mock_state, force_refresh=True)[1] == 1
+
+
+def test_invalid_cache_file_is_ignored(mock_server, mock_state):
+    pathlib.Path(config.TRAILHEAD_CACHE_FILE).write_text("{not json")
+    trailheads, requests = pull_trailheads(mock_state)
+    assert trailheads == mock_state.trailheads
+    assert requests > 0
+    assert json.loads(pathlib.Path(config.TRAILHEAD_CACHE_FILE).read_text())["trailheads"] == trailheads
+
+
+def test_cache_file_can_be_disabled(mock_server, mock_state, monkeypatch):
+    monkeypatch.setattr(config, "TRAILHEAD_CACHE_FILE", None)
+    pull_trailheads(mock_state)
+    forget_memory()
+    assert pull_trailheads(mock_state)[1] == 1